@@ -2,7 +2,7 @@ from flask import Blueprint, jsonify, session, request
 from datetime import datetime
 
 api = Blueprint('api', __name__)
-from database import get_db
+from cache import make_etag, not_modified, read_versions, with_etag
 
 
 @api.route('/api/thongke')
@@ -16,8 +16,16 @@ def thongke():
         so = "TRU"
     if role != "admin" and so_allowed != "ALL":
         so = (so_allowed or "TRU")
-    data = thong_ke_theo_thang(year, so=so)
-    return jsonify(data)
+    # Bảng tổng hợp tháng chỉ đổi khi records của sở đổi / chốt tháng; tháng hiện tại quyết định số cột
+    now = datetime.now()
+    versions = read_versions([f"records:{so}", f"closes:{so}"])
+    version = [versions[f"records:{so}"], versions[f"closes:{so}"]]
+    etag = make_etag("thongke", so, year, now.month, *version)
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+    data = thong_ke_theo_thang(year, so=so, version=version)
+    return with_etag(jsonify(data), etag)
 
 
 @api.route('/api/top')
@@ -30,5 +38,38 @@ def top():
         so = "TRU"
     if role != "admin" and so_allowed != "ALL":
         so = (so_allowed or "TRU")
-    data = top_nguoi_diem_cao(3, so=so)
-    return jsonify(data)
+    # ?limit=10&chuc_vu=Cảnh sát viên,Đội phó
+    from thongke import TOP_LIMIT_MAX
+    from tinhdiem import CHUC_VU_OPTIONS
+    try:
+        limit = int(request.args.get("limit") or 3)
+    except ValueError:
+        return jsonify(success=False, error="limit không hợp lệ"), 400
+    limit = max(1, min(limit, TOP_LIMIT_MAX))
+    chuc_vu = [x.strip() for x in (request.args.get("chuc_vu") or "").split(",") if x.strip()]
+    invalid = [x for x in chuc_vu if x not in CHUC_VU_OPTIONS]
+    if invalid:
+        return jsonify(success=False, error=f"Chức vụ không hợp lệ: {', '.join(invalid)}"), 400
+    # ?month=YYYY-MM: bảng xếp hạng của tháng đã chốt (đọc bản chụp, không đụng records)
+    month = (request.args.get("month") or "").strip()
+    if month:
+        import chotthang
+        try:
+            nam, thang = chotthang.parse_thang(month)
+        except ValueError as e:
+            return jsonify(success=False, error=str(e)), 400
+        key = chotthang.version_key(so)
+        version = read_versions([key])[key]
+        etag = make_etag("top_thang", so, nam, thang, limit, ",".join(sorted(chuc_vu)), version)
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
+        data = chotthang.top_thang(so, nam, thang, limit, chuc_vu=chuc_vu or None, version=version)
+        return with_etag(jsonify(data), etag)
+    version = read_versions([f"leaderboard:{so}"])[f"leaderboard:{so}"]
+    etag = make_etag("top", so, limit, ",".join(sorted(chuc_vu)), version)
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+    data = top_nguoi_diem_cao(limit, so=so, chuc_vu=chuc_vu or None, version=[version])
+    return with_etag(jsonify(data), etag)
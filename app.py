@@ -1,7 +1,6 @@
-from flask import Flask, render_template, request, redirect, session, jsonify
-import datetime, time, os, sqlite3, json
+from flask import Flask, Response, render_template, request, redirect, session, jsonify, stream_with_context
+import time, os, sqlite3, json
 from pathlib import Path
-from thongke import thong_ke_theo_thang, top_nguoi_diem_cao
 from api import api
 
 
@@ -9,11 +8,35 @@ app = Flask(__name__)
 app.secret_key = "secret_xulyan"
 
 # DB: Neon Postgres (DATABASE_URL) khi deploy, local dùng SQLite
-from database import get_db, init_db as init_db_shared, is_postgres
+from database import (
+    CHUC_VU_RANK_SQL, READ_REPLICA, db_key, db_keys, doc_tu_primary, get_db, init_db as init_db_shared,
+    is_postgres, read_your_writes_window, supports_returning,
+)
+from cache import TTLCache, bump_version, get_version, make_etag, not_modified, read_versions, with_etag
+from caidat import get_setting, get_settings, set_settings
+from nhatky import LOG_PAGE_SIZE, lay_trang_log_dang_nhap, lay_trang_nhat_ky, phien_ban_bang
+import chotthang
+import dinhvi
+import dongbo
+import hangdoighi
+import luutru
+import nhapdulieu
+import nhatky
+import tinhdiem
+import tructiep
+import xuatdulieu
+from tinhdiem import CHUC_VU_OPTIONS
 
 # Thời gian timeout session (giây) - 1 tiếng
 SESSION_TIMEOUT = 60 * 60
+# Request tự động (SSE, đồng bộ bảng) không gia hạn phiên
+BACKGROUND_PATHS = ("/api/stream", "/api/records/changes")
 UPDATE_CONFIG_PATH = Path(__file__).with_name("update.json")
+# Cache role/so_allowed của user trong process (giây); đổi quyền sẽ bump version "users"
+AUTH_CACHE_TTL = float(os.environ.get("AUTH_CACHE_TTL", "30") or 30)
+_auth_cache = TTLCache("users", AUTH_CACHE_TTL)
+# update.json chỉ đọc lại khi file thay đổi (mtime/size)
+_update_config_cache: dict = {"key": None, "cfg": None}
 DEFAULT_UPDATE_CONFIG = {
     "update_mode": False,
     "update_until": "20h ngày 1/3/2026",
@@ -32,6 +55,8 @@ def init_db():
 
 
 init_db()
+# Lưu trữ + dọn logs / login_logs định kỳ (xem luutru.py)
+luutru.start_scheduler()
 
 # Đăng ký Blueprint API
 app.register_blueprint(api)
@@ -57,34 +82,49 @@ def _effective_so_for_session(role: str, so_allowed: str, requested_so: str | No
     return _normalize_so(allowed)
 
 
-def get_setting(key: str, default: str = "") -> str:
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT value FROM settings WHERE key=?", (key,))
-    row = c.fetchone()
-    conn.close()
-    if not row:
-        return default
-    return row["value"] or default
-
-
 def load_update_config() -> dict:
     """
     Đọc cấu hình trạng thái update từ update.json.
     Nếu file thiếu/lỗi thì fallback về mặc định để app luôn chạy.
     """
+    try:
+        st = UPDATE_CONFIG_PATH.stat()
+        key = (st.st_mtime_ns, st.st_size)
+    except OSError:
+        key = None
+    if key is not None and _update_config_cache["key"] == key:
+        return dict(_update_config_cache["cfg"])
+
     cfg = dict(DEFAULT_UPDATE_CONFIG)
     try:
-        if UPDATE_CONFIG_PATH.exists():
+        if key is not None:
             raw = json.loads(UPDATE_CONFIG_PATH.read_text(encoding="utf-8"))
             if isinstance(raw, dict):
                 cfg.update(raw)
     except Exception:
         # fallback mặc định nếu json lỗi
         pass
+    _update_config_cache["key"] = key
+    _update_config_cache["cfg"] = dict(cfg)
     return cfg
 
 
+def _load_auth_user(username: str):
+    """Đọc role/so_allowed của user từ DB (None nếu đã bị xoá)."""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT username, role, so_allowed FROM users WHERE username=?", (username,))
+    row = c.fetchone()
+    conn.close()
+    if not row:
+        return None
+    return {
+        "username": row["username"],
+        "role": row["role"],
+        "so_allowed": row["so_allowed"] if "so_allowed" in row.keys() else None,
+    }
+
+
 def is_root_admin_session() -> bool:
     return (
         bool(session.get("login"))
@@ -93,11 +133,34 @@ def is_root_admin_session() -> bool:
     )
 
 
+_READ_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+@app.before_request
+def route_reads_after_write():
+    """
+    Có replica (DATABASE_READ_URL): request ghi và các request sau của session vừa ghi (kể cả ở worker
+    khác, trong read_your_writes_window() giây) đọc primary -> không thấy lại dữ liệu cũ từ replica còn trễ.
+    """
+    if READ_REPLICA:
+        doc_tu_primary(
+            request.method not in _READ_METHODS
+            or time.time() - session.get("wrote_at", 0) < read_your_writes_window()
+        )
+
+
+@app.after_request
+def mark_session_write(response):
+    if READ_REPLICA and request.method not in _READ_METHODS and response.status_code < 400:
+        session["wrote_at"] = time.time()
+    return response
+
+
 @app.before_request
 def check_session_and_user():
     """
     - Tự động timeout sau SESSION_TIMEOUT nếu không hoạt động.
-    - Mỗi request sẽ refresh lại role từ DB để F5 là cập nhật quyền mới.
+    - Mỗi request sẽ refresh lại role (qua cache ngắn hạn, bị bỏ ngay khi admin đổi quyền).
     - Nếu tài khoản bị xóa, trả về thông báo phù hợp và đưa về trang login.
     """
     # Bỏ qua static, healthcheck và trang heal trắng
@@ -133,19 +196,16 @@ def check_session_and_user():
             return jsonify(success=False, error="Phiên đăng nhập đã hết hạn"), 401
         return redirect("/")
 
-    # Update lại last_active
-    session["last_active"] = now
+    # Update lại last_active (request nền của dashboard không tính là hoạt động)
+    if request.path not in BACKGROUND_PATHS:
+        session["last_active"] = now
 
     username = session.get("username")
     if not username:
         return
 
-    # Kiểm tra user còn tồn tại và lấy lại role từ DB
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT username, role, so_allowed FROM users WHERE username=?", (username,))
-    row = c.fetchone()
-    conn.close()
+    # Kiểm tra user còn tồn tại và lấy lại role (cache theo version "users")
+    row = _auth_cache.get_or_load(username, lambda: _load_auth_user(username))
 
     if not row:
         # Tài khoản đã bị xóa
@@ -164,7 +224,7 @@ def check_session_and_user():
         session["role"] = db_role
 
     # Cập nhật lại so_allowed trong session theo DB
-    db_so_allowed = (row["so_allowed"] or "TRU").strip().upper() if "so_allowed" in row.keys() else "TRU"
+    db_so_allowed = (row["so_allowed"] or "TRU").strip().upper()
     if session.get("role") == "admin" or username == "admin":
         session["so_allowed"] = "ALL"
     else:
@@ -204,45 +264,33 @@ def add_account():
     if not username or not password:
         return jsonify(success=False, error="Thiếu username hoặc password")
     
-    conn = None
-    try:
-        conn = get_db()
-        c = conn.cursor()
-        
+    def job(c):
         # Kiểm tra trước xem username đã tồn tại chưa
         c.execute("SELECT 1 FROM users WHERE username = ?", (username,))
-        existed = c.fetchone() is not None
-        print("[/api/addaccount] username=", username, "existed=", existed)
-        if existed:
-            print("[/api/addaccount] -> reject: existed")
-            return jsonify(success=False, error="Tài khoản đã tồn tại")
-
+        if c.fetchone() is not None:
+            return False
         c.execute(
             "INSERT INTO users(username, password, role, so_allowed) VALUES(?, ?, ?, ?)",
             (username, password, role, "ALL" if role == "admin" else so)
         )
-        print("[/api/addaccount] -> inserted OK, committing...")
-        conn.commit()
+        bump_version(c, "users")
+        return True
+
+    try:
+        # Qua hàng đợi ghi: không còn giành khoá file SQLite với các request ghi khác
+        inserted = hangdoighi.ghi(job)
+        print("[/api/addaccount] username=", username, "inserted=", inserted)
+        if not inserted:
+            return jsonify(success=False, error="Tài khoản đã tồn tại")
     except sqlite3.IntegrityError as e:
         # Chỉ báo "đã tồn tại" nếu thật sự do UNIQUE username
         msg = str(e)
-        if conn:
-            conn.rollback()
         if "users.username" in msg or "UNIQUE constraint failed: users.username" in msg:
             return jsonify(success=False, error="Tài khoản đã tồn tại")
         return jsonify(success=False, error=f"Lỗi dữ liệu: {msg}")
     except Exception as e:
-        if conn:
-            try:
-                conn.rollback()
-            except Exception:
-                pass
-        # Trả lỗi chi tiết để dễ debug (bao gồm database is locked nếu có)
         return jsonify(success=False, error=str(e))
-    finally:
-        if conn:
-            conn.close()
-    
+
     # Ghi log tạo tài khoản bằng connection RIÊNG sau khi đã commit user
     try:
         from nhatky import them_nhat_ky
@@ -261,12 +309,17 @@ def add_account():
 def api_users():
     if not session.get("login") or session.get("role") != "admin":
         return jsonify(success=False, error="Không có quyền (chỉ admin)"), 403
-    conn = get_db()
+    # Mọi thao tác ghi users đều bump version "users" (đọc từ version đã poll, không query DB)
+    etag = make_etag("users", get_version("users"))
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+    conn = get_db(readonly=True)
     c = conn.cursor()
     c.execute("SELECT id, username, password, role, so_allowed FROM users ORDER BY id ASC")
     rows = c.fetchall()
     conn.close()
-    return jsonify(
+    return with_etag(jsonify(
         success=True,
         users=[
             {
@@ -282,7 +335,7 @@ def api_users():
             }
             for r in rows
         ],
-    )
+    ), etag)
 
 @app.post("/api/users/<int:user_id>/role")
 def api_update_user_role(user_id: int):
@@ -292,32 +345,33 @@ def api_update_user_role(user_id: int):
     role = (data.get("role") or "").strip()
     if role not in ["admin", "editer", "user"]:
         return jsonify(success=False, error="Role không hợp lệ"), 400
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT username, role FROM users WHERE id=?", (user_id,))
-    target = c.fetchone()
-    if not target:
-        conn.close()
-        return jsonify(success=False, error="User không tồn tại"), 404
-    target_username = (target["username"] or "").strip()
-    target_role = (target["role"] or "").strip().lower()
-    if target_username == "admin":
-        conn.close()
-        return jsonify(success=False, error="Không thể đổi quyền admin gốc"), 400
-    if target_role == "admin":
-        conn.close()
-        return jsonify(success=False, error="Tài khoản admin không thể chỉnh role"), 400
-    c.execute("UPDATE users SET role=? WHERE id=?", (role, user_id))
-    # Nếu set admin thì cho ALL sở
-    if role == "admin":
-        try:
-            c.execute("UPDATE users SET so_allowed='ALL' WHERE id=?", (user_id,))
-        except Exception:
-            pass
-    conn.commit()
-    conn.close()
-    from nhatky import them_nhat_ky
-    them_nhat_ky("EDIT_ROLE", None, session.get("username", "Admin"), f"Đổi quyền user_id={user_id} -> {role}")
+    admin_name = session.get("username", "Admin")
+
+    def job(c):
+        c.execute("SELECT username, role FROM users WHERE id=?", (user_id,))
+        target = c.fetchone()
+        if not target:
+            return "User không tồn tại", 404
+        target_username = (target["username"] or "").strip()
+        target_role = (target["role"] or "").strip().lower()
+        if target_username == "admin":
+            return "Không thể đổi quyền admin gốc", 400
+        if target_role == "admin":
+            return "Tài khoản admin không thể chỉnh role", 400
+        c.execute("UPDATE users SET role=? WHERE id=?", (role, user_id))
+        # Nếu set admin thì cho ALL sở
+        if role == "admin":
+            try:
+                c.execute("UPDATE users SET so_allowed='ALL' WHERE id=?", (user_id,))
+            except Exception:
+                pass
+        bump_version(c, "users")
+        write_log(c, "EDIT_ROLE", None, admin_name, f"Đổi quyền user_id={user_id} -> {role}", durable=True)
+        return None
+
+    error = hangdoighi.ghi(job)
+    if error:
+        return jsonify(success=False, error=error[0]), error[1]
     return jsonify(success=True)
 
 
@@ -329,50 +383,51 @@ def api_update_user_so(user_id: int):
     so = (data.get("so") or "").strip().upper()
     if so not in ("TRU", "LS", "PS", "ALL"):
         return jsonify(success=False, error="Sở không hợp lệ"), 400
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT username, role FROM users WHERE id=?", (user_id,))
-    row = c.fetchone()
-    if not row:
-        conn.close()
-        return jsonify(success=False, error="User không tồn tại"), 404
-    if row["username"] == "admin":
-        conn.close()
-        return jsonify(success=False, error="Không thể đổi sở của admin"), 400
-    # Admin luôn ALL sở (nếu user là admin thì không cho set TRU/LS)
-    if (row["role"] or "").strip().lower() == "admin":
-        c.execute("UPDATE users SET so_allowed='ALL' WHERE id=?", (user_id,))
-    else:
-        if so == "ALL":
-            conn.close()
-            return jsonify(success=False, error="User thường không thể chọn ALL"), 400
-        c.execute("UPDATE users SET so_allowed=? WHERE id=?", (so, user_id))
-    conn.commit()
-    conn.close()
-    from nhatky import them_nhat_ky
-    them_nhat_ky("EDIT_SO", None, session.get("username", "Admin"), f"Đổi sở user_id={user_id} -> {so}")
+    def job(c):
+        c.execute("SELECT username, role FROM users WHERE id=?", (user_id,))
+        row = c.fetchone()
+        if not row:
+            return "User không tồn tại", 404
+        if row["username"] == "admin":
+            return "Không thể đổi sở của admin", 400
+        # Admin luôn ALL sở (nếu user là admin thì không cho set TRU/LS)
+        if (row["role"] or "").strip().lower() == "admin":
+            c.execute("UPDATE users SET so_allowed='ALL' WHERE id=?", (user_id,))
+        else:
+            if so == "ALL":
+                return "User thường không thể chọn ALL", 400
+            c.execute("UPDATE users SET so_allowed=? WHERE id=?", (so, user_id))
+        bump_version(c, "users")
+        return None
+
+    error = hangdoighi.ghi(job)
+    if error:
+        return jsonify(success=False, error=error[0]), error[1]
+    nhatky.them_nhat_ky("EDIT_SO", None, session.get("username", "Admin"), f"Đổi sở user_id={user_id} -> {so}")
     return jsonify(success=True)
 
 @app.delete("/api/users/<int:user_id>")
 def api_delete_user(user_id: int):
     if not session.get("login") or session.get("role") != "admin":
         return jsonify(success=False, error="Không có quyền (chỉ admin)"), 403
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT username, role FROM users WHERE id=?", (user_id,))
-    row = c.fetchone()
-    if not row:
-        conn.close()
-        return jsonify(success=False, error="User không tồn tại"), 404
-    # Không cho xóa tài khoản admin gốc
-    if row["username"] == "admin":
-        conn.close()
-        return jsonify(success=False, error="Không thể xoá tài khoản admin gốc"), 400
-    c.execute("DELETE FROM users WHERE id=?", (user_id,))
-    conn.commit()
-    conn.close()
-    from nhatky import them_nhat_ky
-    them_nhat_ky("DELETE_USER", None, session.get("username", "Admin"), f"Xóa user {row['username']} (id={user_id})")
+    admin_name = session.get("username", "Admin")
+
+    def job(c):
+        c.execute("SELECT username, role FROM users WHERE id=?", (user_id,))
+        row = c.fetchone()
+        if not row:
+            return "User không tồn tại", 404
+        # Không cho xóa tài khoản admin gốc
+        if row["username"] == "admin":
+            return "Không thể xoá tài khoản admin gốc", 400
+        c.execute("DELETE FROM users WHERE id=?", (user_id,))
+        bump_version(c, "users")
+        write_log(c, "DELETE_USER", None, admin_name, f"Xóa user {row['username']} (id={user_id})", durable=True)
+        return None
+
+    error = hangdoighi.ghi(job)
+    if error:
+        return jsonify(success=False, error=error[0]), error[1]
     return jsonify(success=True)
 
 
@@ -394,12 +449,13 @@ def api_admin_reset_data():
     if so not in ("TRU", "LS", "ALL"):
         return jsonify(success=False, error="Tham số so không hợp lệ"), 400
 
-    conn = get_db()
-    c = conn.cursor()
-    try:
+    admin_name = session.get("username", "Admin")
+
+    def job(c, key):
         if so == "ALL":
             # Xoá logs trước để tránh giữ record_id mồ côi (không bắt buộc, nhưng sạch)
             c.execute("DELETE FROM logs")
+            nhatky.tang_phien_ban(c, "logs", key)
             c.execute("DELETE FROM records")
         else:
             # Xóa logs thuộc records của sở đó
@@ -409,13 +465,18 @@ def api_admin_reset_data():
                 pass
             c.execute("DELETE FROM records WHERE so=?", (so,))
 
-        write_log(c, "RESET_DATA", None, session.get("username", "Admin"), f"Reset dữ liệu so={so}")
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        conn.close()
-        return jsonify(success=False, error=str(e)), 500
-    conn.close()
+        for reset_so in (("TRU", "LS", "PS") if so == "ALL" else (so,)):
+            if db_key(reset_so) == key:
+                dongbo.don_dau_xoa(c, reset_so)
+        if key == db_key(so):
+            write_log(c, "RESET_DATA", None, admin_name, f"Reset dữ liệu so={so}", durable=True, so=so)
+
+    # Shard SQLite: mỗi sở 1 file -> reset trong transaction của từng file (ALL: mọi file)
+    for key in (db_keys() if so == "ALL" else [db_key(so)]):
+        try:
+            hangdoighi.ghi(lambda c, key=key: job(c, key), key)
+        except Exception as e:
+            return jsonify(success=False, error=str(e)), 500
     return jsonify(success=True, so=so)
 
 
@@ -432,9 +493,9 @@ def api_main_reset_scores():
         session.get("so_allowed", "TRU"),
         session.get("current_so", "TRU"),
     )
-    conn = get_db()
-    c = conn.cursor()
-    try:
+    user_name = session.get("username", "Admin")
+
+    def job(c):
         c.execute(
             """
             UPDATE records
@@ -452,16 +513,78 @@ def api_main_reset_scores():
             (so,),
         )
         affected = c.rowcount if c.rowcount is not None else 0
-        write_log(c, "RESET_SCORES", None, session.get("username", "Admin"), f"Reset điểm so={so}")
-        conn.commit()
+        write_log(c, "RESET_SCORES", None, user_name, f"Reset điểm so={so}", durable=True, so=so)
+        return affected
+
+    try:
+        affected = hangdoighi.ghi(job, so)
     except Exception as e:
-        conn.rollback()
-        conn.close()
         return jsonify(success=False, error=str(e)), 500
-    conn.close()
     return jsonify(success=True, so=so, affected=affected, mode="update_only")
 
 
+@app.post("/api/main/close_month")
+def api_main_close_month():
+    """
+    Chốt tháng theo sở hiện tại: chụp số liệu vào records_snapshots, lưu tổng hợp tháng,
+    rồi đưa số liệu về 0 (giữ tên/chức vụ). Body: {"month": "YYYY-MM"} (mặc định tháng hiện tại).
+    """
+    if not can_edit(session):
+        return jsonify(success=False, error="Không có quyền"), 403
+    so = _effective_so_for_session(
+        get_user_role(session),
+        session.get("so_allowed", "TRU"),
+        session.get("current_so", "TRU"),
+    )
+    data = request.get_json(silent=True) or {}
+    try:
+        nam, thang = chotthang.parse_thang(data.get("month") or request.args.get("month"))
+    except ValueError as e:
+        return jsonify(success=False, error=str(e)), 400
+    user_name = session.get("username", "Admin")
+
+    def job(c):
+        close = chotthang.chot_thang(c, so, nam, thang, user_name)
+        write_log(
+            c, "CLOSE_MONTH", None, user_name,
+            f"Chốt tháng {close['month']} so={so}: {close['so_luong']} dòng, tổng án {close['tong_an']}, "
+            f"tổng điểm {close['tong_diem']}",
+            durable=True, so=so,
+        )
+        return close
+
+    try:
+        close = hangdoighi.ghi(job, so)
+    except ValueError as e:
+        return jsonify(success=False, error=str(e)), 409
+    except Exception as e:
+        return jsonify(success=False, error=str(e)), 500
+    return jsonify(success=True, so=so, close=close)
+
+
+@app.get("/api/main/closes")
+def api_main_closes():
+    """Các tháng đã chốt của sở hiện tại (tổng hợp lúc chốt). ?year=YYYY để lọc theo năm."""
+    if not can_view_main(session):
+        return jsonify(success=False, error="Không có quyền"), 403
+    so = _effective_so_for_session(
+        get_user_role(session),
+        session.get("so_allowed", "TRU"),
+        session.get("current_so", "TRU"),
+    )
+    try:
+        nam = int(request.args.get("year") or 0) or None
+    except ValueError:
+        return jsonify(success=False, error="year không hợp lệ"), 400
+    key = chotthang.version_key(so)
+    version = read_versions([key])[key]
+    etag = make_etag("closes", so, nam, version)
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+    return with_etag(jsonify(success=True, so=so, closes=chotthang.ds_thang_da_chot(so, nam)), etag)
+
+
 @app.post("/api/main/reset_all")
 def api_main_reset_all():
     """
@@ -474,79 +597,54 @@ def api_main_reset_all():
         session.get("so_allowed", "TRU"),
         session.get("current_so", "TRU"),
     )
-    conn = get_db()
-    c = conn.cursor()
-    try:
+    user_name = session.get("username", "Admin")
+
+    def job(c):
         try:
             c.execute("DELETE FROM logs WHERE record_id IN (SELECT id FROM records WHERE so=?)", (so,))
         except Exception:
             pass
         c.execute("DELETE FROM records WHERE so=?", (so,))
         affected = c.rowcount if c.rowcount is not None else 0
-        write_log(c, "RESET_ALL", None, session.get("username", "Admin"), f"Reset all so={so}")
-        conn.commit()
+        dongbo.don_dau_xoa(c, so)
+        write_log(c, "RESET_ALL", None, user_name, f"Reset all so={so}", durable=True, so=so)
+        return affected
+
+    try:
+        affected = hangdoighi.ghi(job, so)
     except Exception as e:
-        conn.rollback()
-        conn.close()
         return jsonify(success=False, error=str(e)), 500
-    conn.close()
     return jsonify(success=True, so=so, affected=affected)
 
-def write_log(c, action, record_id, user_name=None, details=None):
-    if user_name is None:
-        user_name = "System"
-    c.execute(
-        "INSERT INTO logs(action,record_id,user_name,time,details) VALUES(?,?,?,?,?)",
-        (action, record_id, user_name,
-         datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S"), details or "")
-    )
+def write_log(c, action, record_id, user_name=None, details=None, durable=False,
+              so=None, field=None, old_value=None, new_value=None):
+    """
+    Ghi 1 nhật ký. Mặc định đưa vào bộ đệm ghi theo lô (nhatky), không thêm INSERT vào transaction
+    -> gọi SAU commit để không ghi log cho thay đổi bị rollback.
+    durable=True: INSERT bằng `c`, commit cùng dữ liệu – chỉ dùng cho thao tác quản trị quan trọng.
+    so / field / old_value / new_value: cột có cấu trúc để tra cứu (details chỉ để hiển thị).
+    """
+    entry = (action, record_id, user_name, details, so, field, old_value, new_value)
+    if durable:
+        nhatky.ghi_nhat_ky(c, [entry])
+    else:
+        nhatky.them_nhieu_nhat_ky([entry])
+
+
+def write_logs(c, entries):
+    """
+    Ghi nhiều log 1 lần (qua bộ đệm, gọi sau commit):
+    entries = [(action, record_id, user_name, details[, so, field, old_value, new_value]), ...]
+    """
+    nhatky.them_nhieu_nhat_ky(entries)
 
 
 def write_login_log(username: str, ip: str | None, user_agent: str | None):
     """
     Ghi log đăng nhập (IP + user-agent + location) vào bảng login_logs.
-    Dùng connection riêng để không ảnh hưởng flow hiện tại.
+    Chỉ đưa vào hàng đợi nền (dinhvi): tra vị trí và INSERT không chặn request đăng nhập.
     """
-    try:
-        # Thử resolve địa chỉ từ IP (city, region, country)
-        location = ""
-        ip_clean = (ip or "").strip()
-        if ip_clean:
-            try:
-                import requests  # type: ignore[import]
-
-                resp = requests.get(
-                    f"http://ip-api.com/json/{ip_clean}?fields=status,message,country,regionName,city,query",
-                    timeout=2,
-                )
-                if resp.ok:
-                    data = resp.json() or {}
-                    if data.get("status") == "success":
-                        parts = [data.get("city") or "", data.get("regionName") or "", data.get("country") or ""]
-                        location = ", ".join([p for p in parts if p]).strip()
-            except Exception:
-                location = ""
-
-        conn = get_db()
-        c = conn.cursor()
-        c.execute(
-            "INSERT INTO login_logs(username, ip, user_agent, location, time) VALUES(?,?,?,?,?)",
-            (
-                username or "",
-                (ip or "").strip(),
-                (user_agent or "")[:512],
-                location,
-                datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S"),
-            ),
-        )
-        conn.commit()
-        conn.close()
-    except Exception as _e:
-        # Không để lỗi log IP làm hỏng luồng đăng nhập
-        try:
-            conn.close()  # type: ignore[has-type]
-        except Exception:
-            pass
+    dinhvi.ghi_log_dang_nhap(username, ip, user_agent)
 
 # Helper function để đảm bảo admin có full quyền
 def get_user_role(session):
@@ -714,9 +812,6 @@ def dashboard():
     if not session.get("login"):
         return redirect("/")
 
-    conn = get_db()
-    c = conn.cursor()
-
     username = session.get("username")
 
     # Xác định sở hiện tại (TRU/LS) theo quyền và query param
@@ -729,11 +824,10 @@ def dashboard():
     if request.method == "POST":
         # Chỉ admin và editer mới được thêm
         if not can_edit(session):
-            conn.close()
             return redirect("/dashboard")
 
         chuc_vu = request.form.get("chuc_vu", "Thực tập").strip()
-        if chuc_vu not in ("Thực tập", "Cảnh sát viên", "Sĩ quan dự bị", "Đội phó"):
+        if chuc_vu not in CHUC_VU_OPTIONS:
             chuc_vu = "Thực tập"
         name = request.form.get("name", "").strip()
 
@@ -741,106 +835,72 @@ def dashboard():
         giao_thong = int(request.form.get("giao_thong", 0) or 0)
         xa_1_4 = int(request.form.get("xa_1_4", 0) or 0)   # Án hình sự khoản 1-5
         xa_5_6 = int(request.form.get("xa_5_6", 0) or 0)   # Án hình sự khoản 6
-        giam_sat_1_5 = int(request.form.get("giam_sat_1_5", 0) or 0)
-        giam_sat_6 = int(request.form.get("giam_sat_6", 0) or 0)
         an_sai = int(request.form.get("an_sai", 0) or 0)
 
-        # Ràng buộc theo chức vụ:
-        # - Thực tập: chỉ tính giao thông + án, không có giám sát -> ép giám sát = 0
-        # - Cảnh sát viên / Sĩ quan dự bị / Đội phó: có thể ghi giao thông nhưng giao thông không cộng điểm
-        if chuc_vu == "Thực tập":
-            giam_sat_1_5 = 0
-            giam_sat_6 = 0
-
-        giam_sat = giam_sat_1_5 + giam_sat_6
-
-        # Tổng hồ sơ án = án 1-5 + án 6 + giám sát 1-5 + giám sát 6
-        tong_an = xa_1_4 + xa_5_6 + giam_sat_1_5 + giam_sat_6
-
-        # Điểm (công thức mới):
-        # - Thực tập:
-        #   + Giao thông: +1 điểm / hồ sơ
-        #   + Án hình sự khoản 1-5: +2 điểm
-        #   + Án hình sự khoản 6: +4 điểm
-        #   + Giám sát: không tính điểm
-        # - Cảnh sát viên / Sĩ quan dự bị / Đội phó:
-        #   + Giao thông: không tính điểm
-        #   + Án hình sự khoản 1-5: +2 điểm
-        #   + Án hình sự khoản 6: +4 điểm
-        #   + Giám sát 1-5: +2 điểm
-        #   + Giám sát 6: +6 điểm
-        # - Án sai: -5 điểm
-        if chuc_vu == "Thực tập":
-            diem = giao_thong * 1 + xa_1_4 * 2 + xa_5_6 * 4 - an_sai * 5
-        else:
-            diem = xa_1_4 * 2 + xa_5_6 * 4 + giam_sat_1_5 * 2 + giam_sat_6 * 6 - an_sai * 5
-
-        if is_postgres():
-            c.execute("""
-            INSERT INTO records
-            (so,chuc_vu,name,giao_thong,xa_1_4,xa_5_6,giam_sat,giam_sat_1_5,giam_sat_6,an_sai,tong_an,diem)
-            VALUES(?,?,?,?,?,?,?,?,?,?,?,?)
-            RETURNING id
-            """,(current_so,chuc_vu,name,giao_thong,xa_1_4,xa_5_6,giam_sat,giam_sat_1_5,giam_sat_6,an_sai,tong_an,diem))
-            new_id_row = c.fetchone()
-            new_id = (new_id_row.get("id") if isinstance(new_id_row, dict) else new_id_row[0]) if new_id_row else None
-        else:
-            c.execute("""
-            INSERT INTO records
-            (so,chuc_vu,name,giao_thong,xa_1_4,xa_5_6,giam_sat,giam_sat_1_5,giam_sat_6,an_sai,tong_an,diem,created_at)
-            VALUES(?,?,?,?,?,?,?,?,?,?,?,?,datetime('now'))
-            """,(current_so,chuc_vu,name,giao_thong,xa_1_4,xa_5_6,giam_sat,giam_sat_1_5,giam_sat_6,an_sai,tong_an,diem))
-            new_id = c.lastrowid
-
+        # Giám sát / tổng / điểm tính theo bộ quy tắc của sở (xem tinhdiem.py)
+        derived = tinhdiem.tinh_diem(
+            {
+                "chuc_vu": chuc_vu,
+                "giao_thong": giao_thong,
+                "xa_1_4": xa_1_4,
+                "xa_5_6": xa_5_6,
+                "giam_sat_1_5": int(request.form.get("giam_sat_1_5", 0) or 0),
+                "giam_sat_6": int(request.form.get("giam_sat_6", 0) or 0),
+                "an_sai": an_sai,
+            },
+            tinhdiem.get_rules(current_so),
+        )
+        giam_sat_1_5 = derived["giam_sat_1_5"]
+        giam_sat_6 = derived["giam_sat_6"]
+        giam_sat = derived["giam_sat"]
+        tong_an = derived["tong_an"]
+        diem = derived["diem"]
+
+        def job(c):
+            if is_postgres():
+                c.execute("""
+                INSERT INTO records
+                (so,chuc_vu,name,giao_thong,xa_1_4,xa_5_6,giam_sat,giam_sat_1_5,giam_sat_6,an_sai,tong_an,diem)
+                VALUES(?,?,?,?,?,?,?,?,?,?,?,?)
+                RETURNING id
+                """,(current_so,chuc_vu,name,giao_thong,xa_1_4,xa_5_6,giam_sat,giam_sat_1_5,giam_sat_6,an_sai,tong_an,diem))
+                new_id_row = c.fetchone()
+                new_id = (new_id_row.get("id") if isinstance(new_id_row, dict) else new_id_row[0]) if new_id_row else None
+            else:
+                c.execute("""
+                INSERT INTO records
+                (so,chuc_vu,name,giao_thong,xa_1_4,xa_5_6,giam_sat,giam_sat_1_5,giam_sat_6,an_sai,tong_an,diem,created_at)
+                VALUES(?,?,?,?,?,?,?,?,?,?,?,?,datetime('now'))
+                """,(current_so,chuc_vu,name,giao_thong,xa_1_4,xa_5_6,giam_sat,giam_sat_1_5,giam_sat_6,an_sai,tong_an,diem))
+                new_id = c.lastrowid
+            return new_id
+
+        new_id = hangdoighi.ghi(job, current_so)
         user_name = session.get("username", "Unknown")
-        write_log(c, "ADD", new_id, user_name, f"Thêm record: {name}")
-        conn.commit()
+        write_log(None, "ADD", new_id, user_name, f"Thêm record: {name}", so=current_so, new_value=name)
 
     can_see_main = can_view_main(session)
     can_see_diem = can_view_diem(session)
-    
-    # Load data cho Main và/hoặc tab Điểm
-    if can_see_main or can_see_diem:
-        c.execute("""
-            SELECT * FROM records
-            WHERE so = ?
-            ORDER BY
-                CASE chuc_vu
-                    WHEN 'Đội phó' THEN 0
-                    WHEN 'Cảnh sát viên' THEN 1
-                    WHEN 'Sĩ quan dự bị' THEN 2
-                    WHEN 'Thực tập' THEN 3
-                    ELSE 4
-                END,
-                diem DESC
-        """, (current_so,))
-        data = c.fetchall()
-    else:
-        data = []
+    # Bảng Main / Tiền / Điểm không render sẵn: mỗi tab tự tải /api/records?view=... khi mở lần đầu
 
-    # Tổng cho Main/Điểm
-    total_giao_thong = sum(int(r["giao_thong"] or 0) for r in data) if data else 0
-    total_hinh_su = (
-        sum(int(r["xa_1_4"] or 0) + int(r["xa_5_6"] or 0) for r in data) if data else 0
-    )
-    total_giam_sat = (
-        sum(int(r["giam_sat_1_5"] or 0) + int(r["giam_sat_6"] or 0) for r in data)
-        if data
-        else 0
-    )
-    total_diem = sum(int(r["diem"] or 0) for r in data) if data else 0
-    total_tong_tien = sum(int(r["tong_tien"] or 0) for r in data) if data else 0
-    
     # Nhật ký load theo phân trang qua API để nhìn gọn hơn
     nhat_ky = []
     can_see_logs = can_view_logs(session)
     can_see_logip = can_view_logip(session)
-    
-    conn.close()
+
+    # Cấu hình tiêu đề/nhãn: 1 lần đọc từ cache settings
+    monthly_default = get_setting("monthly_title", "THỐNG KÊ ĐIỂM THÁNG")
+    texts = get_settings(
+        (f"monthly_title_{current_so}", f"stats_title_{current_so}", f"stats_label_{current_so}"),
+        {
+            f"monthly_title_{current_so}": monthly_default,
+            f"stats_title_{current_so}": f"Thống kê điểm Sở {current_so}",
+            f"stats_label_{current_so}": "Tổng số PS",
+        },
+    )
 
     return render_template(
         "dashboard.html",
-        data=data,
         username=username,
         user_role=user_role,
         can_see_main=can_see_main,
@@ -849,134 +909,382 @@ def dashboard():
         nhat_ky=nhat_ky,
         current_so=current_so,
         so_allowed=so_allowed,
-        monthly_title=get_setting(
-            f"monthly_title_{current_so}",
-            get_setting("monthly_title", "THỐNG KÊ ĐIỂM THÁNG"),
-        ),
+        monthly_title=texts[f"monthly_title_{current_so}"],
         can_edit_title=(user_role == "admin"),
-        stats_title=get_setting(f"stats_title_{current_so}", f"Thống kê điểm Sở {current_so}"),
-        stats_label=get_setting(f"stats_label_{current_so}", "Tổng số PS"),
+        stats_title=texts[f"stats_title_{current_so}"],
+        stats_label=texts[f"stats_label_{current_so}"],
         can_edit_stats=(user_role == "admin"),
-        total_giao_thong=total_giao_thong,
-        total_hinh_su=total_hinh_su,
-        total_giam_sat=total_giam_sat,
-        total_diem=total_diem,
-        total_tong_tien=total_tong_tien,
         can_see_logip=can_see_logip,
     )
 
 
-@app.get("/api/logs")
-def api_logs():
-    if not session.get("login") or session.get("role") != "admin":
-        return jsonify(success=False, error="Không có quyền (chỉ admin)"), 403
+# Cột trả về cho từng tab (chỉ những gì tab đó hiển thị)
+RECORD_VIEWS = {
+    "main": ("id", "chuc_vu", "name", "giao_thong", "xa_1_4", "xa_5_6",
+             "giam_sat_1_5", "giam_sat_6", "an_sai", "tong_an", "diem"),
+    "tien": ("id", "chuc_vu", "name", "tien_khoan_1_2", "tien_khoan_3_5",
+             "tien_khoan_6_truy_na", "tong_an", "diem", "tong_tien"),
+    "diem": ("id", "chuc_vu", "name", "giao_thong", "xa_1_4", "xa_5_6",
+             "giam_sat_1_5", "giam_sat_6", "an_sai", "tong_an", "diem"),
+}
 
-    try:
-        page = int((request.args.get("page") or "1").strip())
-    except Exception:
-        page = 1
-    if page < 1:
-        page = 1
 
-    page_size = 12
-    offset = (page - 1) * page_size
+@app.get("/api/records")
+def api_records():
+    """Dữ liệu 1 tab của dashboard: ?view=main|tien|diem (sở lấy theo session)."""
+    if not session.get("login"):
+        return jsonify(success=False, error="Chưa đăng nhập"), 401
+    view = (request.args.get("view") or "main").strip().lower()
+    columns = RECORD_VIEWS.get(view)
+    if columns is None:
+        return jsonify(success=False, error="view không hợp lệ"), 400
+    allowed = can_view_diem(session) if view == "diem" else can_view_main(session)
+    if not allowed:
+        return jsonify(success=False, error="Không có quyền"), 403
 
-    conn = get_db()
+    current_so = _session_so()
+    conn = get_db(current_so, readonly=True)
     c = conn.cursor()
-    c.execute("SELECT COUNT(1) AS total FROM logs")
-    total_row = c.fetchone()
-    total = int((total_row["total"] if total_row and "total" in total_row.keys() else 0) or 0)
-
+    # Version đọc trước dữ liệu: client dùng làm mốc cho /api/records/changes
+    version = dongbo.phien_ban(c, current_so)
     c.execute(
-        """
-        SELECT id, action, record_id, user_name, time, details
-        FROM logs
-        ORDER BY id DESC
-        LIMIT ? OFFSET ?
+        f"""
+        SELECT {", ".join(columns)} FROM records
+        WHERE so = ?
+        ORDER BY {CHUC_VU_RANK_SQL}, diem DESC
         """,
-        (page_size, offset),
+        (current_so,),
     )
-    rows = c.fetchall()
+    rows = [{k: r[k] for k in columns} for r in c.fetchall()]
     conn.close()
 
-    total_pages = (total + page_size - 1) // page_size if total > 0 else 1
-    data = [
-        {
+    if view == "tien":
+        totals = {"tong_tien": sum(int(r["tong_tien"] or 0) for r in rows)}
+    else:
+        totals = {
+            "giao_thong": sum(int(r["giao_thong"] or 0) for r in rows),
+            "hinh_su": sum(int(r["xa_1_4"] or 0) + int(r["xa_5_6"] or 0) for r in rows),
+            "giam_sat": sum(int(r["giam_sat_1_5"] or 0) + int(r["giam_sat_6"] or 0) for r in rows),
+            "diem": sum(int(r["diem"] or 0) for r in rows),
+        }
+    return jsonify(success=True, so=current_so, view=view, version=version, rows=rows, totals=totals)
+
+
+@app.get("/api/records/changes")
+def api_records_changes():
+    """
+    Các dòng đã đổi / đã xoá của sở hiện tại sau version ?since=<version>.
+    Trả reset=true khi client nên tải lại cả bảng qua /api/records.
+    """
+    if not session.get("login"):
+        return jsonify(success=False, error="Chưa đăng nhập"), 401
+    if not (can_view_main(session) or can_view_diem(session)):
+        return jsonify(success=False, error="Không có quyền"), 403
+    try:
+        since = int(request.args.get("since") or 0)
+    except ValueError:
+        return jsonify(success=False, error="since không hợp lệ"), 400
+
+    current_so = _session_so()
+    conn = get_db(current_so, readonly=True)
+    c = conn.cursor()
+    changes = dongbo.lay_thay_doi(c, current_so, since)
+    conn.close()
+    return jsonify(success=True, so=current_so, **changes)
+
+
+@app.get("/api/stream")
+def api_stream():
+    """SSE: sự kiện records / thongke / top của sở hiện tại (xem tructiep.py)."""
+    if not session.get("login"):
+        return jsonify(success=False, error="Chưa đăng nhập"), 401
+    current_so = _session_so()
+    q = tructiep.subscribe(current_so)
+    if q is None:
+        # Process đã đủ kết nối dài: client quay về đồng bộ định kỳ
+        resp = jsonify(success=False, error="Quá nhiều kết nối trực tiếp")
+        resp.status_code = 503
+        resp.headers["Retry-After"] = "60"
+        return resp
+    return Response(
+        stream_with_context(tructiep.stream(current_so, q)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def _log_page_response(page: dict, etag: str, mapper):
+    page_size = LOG_PAGE_SIZE
+    total = page["total"]
+    return with_etag(jsonify(
+        success=True,
+        logs=[mapper(r) for r in page["rows"]],
+        page_size=page_size,
+        total=total,
+        total_approx=True,
+        total_pages=(total + page_size - 1) // page_size if total > 0 else 1,
+        next_cursor=page["next_cursor"],
+        prev_cursor=page["prev_cursor"],
+    ), etag)
+
+
+@app.get("/api/logs")
+def api_logs():
+    """
+    Nhật ký thao tác, phân trang bằng cursor: ?cursor=<next_cursor|prev_cursor>
+    Lọc: action, user_name, record_id, so, field, from / to (YYYY-MM-DD).
+    """
+    if not session.get("login") or session.get("role") != "admin":
+        return jsonify(success=False, error="Không có quyền (chỉ admin)"), 403
+
+    args = request.args
+    etag = make_etag("logs", *phien_ban_bang("logs"), request.query_string.decode())
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+    try:
+        record_id = args.get("record_id")
+        page = lay_trang_nhat_ky(
+            cursor=(args.get("cursor") or "").strip() or None,
+            action=(args.get("action") or "").strip() or None,
+            user_name=(args.get("user_name") or "").strip() or None,
+            record_id=int(record_id) if record_id not in (None, "") else None,
+            tu_ngay=args.get("from") or None,
+            den_ngay=args.get("to") or None,
+            so=(args.get("so") or "").strip().upper() or None,
+            field=(args.get("field") or "").strip() or None,
+        )
+    except ValueError as e:
+        return jsonify(success=False, error=str(e)), 400
+
+    return _log_page_response(
+        page,
+        etag,
+        lambda r: {
             "id": r["id"],
             "action": r["action"] or "",
             "record_id": r["record_id"],
             "user_name": r["user_name"] or "System",
             "time": r["time"] or "",
             "details": r["details"] or "",
-        }
-        for r in rows
-    ]
-    return jsonify(
-        success=True,
-        logs=data,
-        page=page,
-        page_size=page_size,
-        total=total,
-        total_pages=total_pages,
+            "so": r["so"],
+            "field": r["field"],
+            "old_value": r["old_value"],
+            "new_value": r["new_value"],
+        },
     )
 
 
 @app.get("/api/login_logs")
 def api_login_logs():
-    """API trả danh sách log IP đăng nhập (chỉ admin gốc)."""
+    """API trả danh sách log IP đăng nhập (chỉ admin gốc), phân trang bằng cursor như /api/logs."""
     if not is_root_admin_session():
         return jsonify(success=False, error="Không có quyền (chỉ admin gốc)"), 403
 
+    args = request.args
+    etag = make_etag("login_logs", *phien_ban_bang("login_logs"), request.query_string.decode())
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
     try:
-        page = int((request.args.get("page") or "1").strip())
-    except Exception:
-        page = 1
-    if page < 1:
-        page = 1
-
-    page_size = 12
-    offset = (page - 1) * page_size
-
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT COUNT(1) AS total FROM login_logs")
-    total_row = c.fetchone()
-    total = int((total_row["total"] if total_row and "total" in total_row.keys() else 0) or 0)
-
-    c.execute(
-        """
-        SELECT id, username, ip, user_agent, location, time
-        FROM login_logs
-        ORDER BY id DESC
-        LIMIT ? OFFSET ?
-        """,
-        (page_size, offset),
-    )
-    rows = c.fetchall()
-    conn.close()
+        page = lay_trang_log_dang_nhap(
+            cursor=(args.get("cursor") or "").strip() or None,
+            username=(args.get("username") or "").strip() or None,
+            tu_ngay=args.get("from") or None,
+            den_ngay=args.get("to") or None,
+        )
+    except ValueError as e:
+        return jsonify(success=False, error=str(e)), 400
 
-    total_pages = (total + page_size - 1) // page_size if total > 0 else 1
-    data = [
-        {
+    return _log_page_response(
+        page,
+        etag,
+        lambda r: {
             "id": r["id"],
             "username": r["username"] or "",
             "ip": r["ip"] or "",
             "user_agent": r["user_agent"] or "",
             "location": r["location"] or "",
             "time": r["time"] or "",
-        }
-        for r in rows
-    ]
-    return jsonify(
-        success=True,
-        logs=data,
-        page=page,
-        page_size=page_size,
-        total=total,
-        total_pages=total_pages,
+        },
+    )
+
+def _can_view_archive(table: str) -> bool:
+    # Lưu trữ login_logs: chỉ admin gốc (giống tab log IP)
+    if table == "login_logs":
+        return is_root_admin_session()
+    return bool(session.get("login")) and session.get("role") == "admin"
+
+
+@app.get("/api/admin/archives/<table>")
+def api_archives(table):
+    """Các tháng nhật ký đã lưu trữ của `table` (logs | login_logs)."""
+    if table not in luutru.ARCHIVE_TABLES:
+        return jsonify(success=False, error="Bảng không hợp lệ"), 400
+    if not _can_view_archive(table):
+        return jsonify(success=False, error="Không có quyền"), 403
+    return jsonify(success=True, table=table, months=luutru.ds_luu_tru(table))
+
+
+@app.get("/api/admin/archives/<table>/<month>")
+def api_archive_month(table, month):
+    """Đọc dần 1 tháng lưu trữ dạng NDJSON (mỗi dòng 1 log), không nạp cả file vào RAM."""
+    if table not in luutru.ARCHIVE_TABLES:
+        return jsonify(success=False, error="Bảng không hợp lệ"), 400
+    if not _can_view_archive(table):
+        return jsonify(success=False, error="Không có quyền"), 403
+    try:
+        lines = luutru.doc_luu_tru(table, month)
+    except ValueError as e:
+        return jsonify(success=False, error=str(e)), 404
+    return Response(
+        lines,
+        mimetype="application/x-ndjson",
+        headers={"Content-Disposition": f"attachment; filename={table}-{month}.jsonl"},
     )
 
+
+@app.post("/api/admin/archives/run")
+def api_archive_run():
+    """Chạy lưu trữ ngay (admin gốc), không chờ lịch."""
+    if not is_root_admin_session():
+        return jsonify(success=False, error="Chỉ admin gốc"), 403
+    result = luutru.chay_luu_tru(force=True)
+    if result is None:
+        return jsonify(success=False, error="Đang có tiến trình lưu trữ khác chạy"), 409
+    return jsonify(success=True, moved=result)
+
+
+@app.get("/api/export/<kind>")
+def api_export(kind):
+    """
+    Xuất dữ liệu theo luồng (xem xuatdulieu.py): ?format=csv|ndjson|xlsx
+    - records: sở theo session (admin chọn ?so=), ?month=YYYY-MM tuỳ chọn
+    - logs: lọc như /api/logs; login_logs: lọc như /api/login_logs
+    Client nhận gzip thì CSV / NDJSON được nén ngay trên luồng.
+    """
+    if not session.get("login"):
+        return jsonify(success=False, error="Chưa đăng nhập"), 401
+    args = request.args
+    fmt = (args.get("format") or "csv").strip().lower()
+    if kind == "records":
+        if not can_view_main(session):
+            return jsonify(success=False, error="Không có quyền"), 403
+        loc = {
+            "so": _effective_so_for_session(
+                get_user_role(session),
+                session.get("so_allowed", "TRU"),
+                args.get("so") or session.get("current_so", "TRU"),
+            ),
+            "thang": (args.get("month") or "").strip() or None,
+        }
+    elif kind == "logs":
+        if session.get("role") != "admin":
+            return jsonify(success=False, error="Không có quyền (chỉ admin)"), 403
+        record_id = args.get("record_id")
+        try:
+            record_id = int(record_id) if record_id not in (None, "") else None
+        except ValueError:
+            return jsonify(success=False, error="record_id không hợp lệ"), 400
+        loc = {
+            "action": (args.get("action") or "").strip() or None,
+            "user_name": (args.get("user_name") or "").strip() or None,
+            "record_id": record_id,
+            "so": (args.get("so") or "").strip().upper() or None,
+            "field": (args.get("field") or "").strip() or None,
+            "tu_ngay": args.get("from") or None,
+            "den_ngay": args.get("to") or None,
+        }
+    elif kind == "login_logs":
+        if not is_root_admin_session():
+            return jsonify(success=False, error="Không có quyền (chỉ admin gốc)"), 403
+        loc = {
+            "username": (args.get("username") or "").strip() or None,
+            "tu_ngay": args.get("from") or None,
+            "den_ngay": args.get("to") or None,
+        }
+    else:
+        return jsonify(success=False, error="Loại dữ liệu không hợp lệ"), 404
+
+    use_gzip = fmt != "xlsx" and "gzip" in (request.headers.get("Accept-Encoding") or "").lower()
+    try:
+        chunks, mimetype, filename = xuatdulieu.xuat(kind, fmt, gzip=use_gzip, **loc)
+    except ValueError as e:
+        return jsonify(success=False, error=str(e)), 400
+
+    headers = {"Content-Disposition": f"attachment; filename={filename}", "Vary": "Accept-Encoding"}
+    if use_gzip:
+        headers["Content-Encoding"] = "gzip"
+    return Response(chunks, mimetype=mimetype, headers=headers)
+
+
 # ================= INLINE EDIT (ENTER LƯU) =================
+INLINE_NUMERIC_FIELDS = (
+    "giao_thong",
+    "xa_1_4",
+    "xa_5_6",
+    "giam_sat_1_5",
+    "giam_sat_6",
+    "an_sai",
+    "tien_khoan_1_2",
+    "tien_khoan_3_5",
+    "tien_khoan_6_truy_na",
+)
+INLINE_ALLOWED_FIELDS = {"chuc_vu", "name", *INLINE_NUMERIC_FIELDS}
+
+_INLINE_EDIT_RETURNING = "chuc_vu, giao_thong, giam_sat_1_5, giam_sat_6, tong_an, diem, tong_tien"
+
+
+def _build_inline_edit(field: str, value, so: str, with_old: bool = False) -> tuple[str, list]:
+    """
+    Dựng 1 câu UPDATE cho inline edit: ghi field mới + tính lại cột dẫn xuất
+    theo bộ quy tắc của sở + chặn sở khác. Tham số còn lại: id, sở.
+
+    with_old (Postgres): khoá dòng và lấy giá trị cũ ngay trong câu UPDATE
+    (UPDATE ... FROM (SELECT ... FOR UPDATE)), RETURNING trả thêm cột `old`.
+    """
+    set_sql, params = tinhdiem.recompute_set_sql(tinhdiem.get_rules(so), field, value)
+    if with_old:
+        head = "UPDATE records r SET"
+        where = (f"FROM (SELECT id, {field} AS old FROM records WHERE id = ? FOR UPDATE) o "
+                 "WHERE r.id = o.id AND COALESCE(r.so, 'TRU') = ?")
+    else:
+        head = "UPDATE records SET"
+        where = "WHERE id = ? AND COALESCE(so, 'TRU') = ?"
+    if field in tinhdiem.RECOMPUTED_FIELDS:
+        # giam_sat_1_5 / giam_sat_6 đã được gán trong phần tính lại (Postgres không cho gán 1 cột 2 lần)
+        return f"{head} {set_sql} {where}", params
+    return f"{head} {field} = ?,{set_sql} {where}", [value] + params
+
+
+def _coerce_inline_value(field: str, value):
+    """
+    Chuẩn hoá giá trị gửi lên: cột số ép int >= 0 (xóa hết / lỗi = 0).
+    Trả (value, error).
+    """
+    if field not in INLINE_ALLOWED_FIELDS:
+        return None, "Trường không hợp lệ"
+    if field in INLINE_NUMERIC_FIELDS:
+        raw = (value if value is not None else "").strip() if isinstance(value, str) else value
+        try:
+            value = int(float(str(raw))) if raw not in ("", None) else 0
+        except (ValueError, TypeError):
+            value = 0
+        return max(0, value), None  # Không cho số âm
+    # Chức vụ chỉ cho phép 4 giá trị
+    if field == "chuc_vu" and value not in CHUC_VU_OPTIONS:
+        return None, "Chức vụ không hợp lệ"
+    return value, None
+
+
+def _session_so() -> str:
+    return _normalize_so(_effective_so_for_session(
+        get_user_role(session),
+        session.get("so_allowed", "TRU"),
+        session.get("current_so", "TRU"),
+    ))
+
+
 @app.route("/inline_edit", methods=["POST"])
 def inline_edit():
     # Chỉ admin và editer mới được chỉnh sửa
@@ -989,158 +1297,261 @@ def inline_edit():
     value = data.get("value")
 
     # Ép kiểu số cho các cột số - xóa hết thì mặc định 0
-    saved_value = None
-    numeric_fields = (
-        "giao_thong",
-        "xa_1_4",
-        "xa_5_6",
-        "giam_sat_1_5",
-        "giam_sat_6",
-        "an_sai",
-        "tien_khoan_1_2",
-        "tien_khoan_3_5",
-        "tien_khoan_6_truy_na",
-    )
-    if field in numeric_fields:
-        raw = (value if value is not None else "").strip() if isinstance(value, str) else value
-        try:
-            value = int(float(str(raw))) if raw not in ("", None) else 0
-        except (ValueError, TypeError):
-            value = 0
-        value = max(0, value)  # Không cho số âm
-        saved_value = value
+    value, error = _coerce_inline_value(field, value)
+    if error:
+        return jsonify(success=False, error=error)
+    saved_value = value if field in INLINE_NUMERIC_FIELDS else None
 
-    conn = get_db()
-    c = conn.cursor()
+    # Chặn sửa record khác sở (trừ admin khi đang chọn sở đó) -> nằm luôn trong WHERE
+    current_so = _session_so()
 
-    # Chặn sửa record khác sở (trừ admin khi đang chọn sở đó)
-    current_so = _effective_so_for_session(
-        get_user_role(session),
-        session.get("so_allowed", "TRU"),
-        session.get("current_so", "TRU"),
-    )
-    try:
-        c.execute("SELECT so FROM records WHERE id=?", (rid,))
-        row_so = c.fetchone()
-        if not row_so:
-            conn.close()
+    sql, params = _build_inline_edit(field, value, current_so, with_old=is_postgres())
+    params += [rid, current_so]
+
+    def job(c):
+        if is_postgres():
+            # 1 câu: khoá dòng, lấy giá trị cũ, ghi và trả cột dẫn xuất
+            c.execute(f"{sql} RETURNING o.old, {_INLINE_EDIT_RETURNING}", params)
+            r = c.fetchone()
+            if r:
+                return r["old"], dict(r), True
+            c.execute("SELECT 1 FROM records WHERE id=?", (rid,))
+            return None, None, c.fetchone() is not None
+        # SQLite: đọc giá trị cũ bằng câu riêng vẫn đúng vì hàng đợi ghi chỉ có
+        # 1 thread ghi mỗi file, không job nào chen vào giữa SELECT và UPDATE.
+        c.execute(f"SELECT {field} FROM records WHERE id=?", (rid,))
+        old = c.fetchone()
+        if supports_returning():
+            c.execute(f"{sql} RETURNING {_INLINE_EDIT_RETURNING}", params)
+            r = c.fetchone()
+        else:
+            c.execute(sql, params)
+            r = None
+            if c.rowcount:
+                c.execute(f"SELECT {_INLINE_EDIT_RETURNING} FROM records WHERE id=?", (rid,))
+                r = c.fetchone()
+        return (old[field] if old else None), (dict(r) if r else None), old is not None
+
+    # Ghi qua hàng đợi ghi (SQLite: 1 thread ghi / file, gộp nhiều lần sửa vào 1 commit)
+    old_value, r, exists = hangdoighi.ghi(job, current_so)
+    if not r:
+        # Không cập nhật được: phân biệt record không tồn tại / thuộc sở khác
+        if not exists:
             return jsonify(success=False, error="Record không tồn tại"), 404
-        if _normalize_so(row_so["so"]) != _normalize_so(current_so):
-            conn.close()
-            return jsonify(success=False, error="Không có quyền sửa dữ liệu sở khác"), 403
-    except Exception:
-        # Nếu DB cũ chưa có cột so, bỏ qua
-        pass
+        return jsonify(success=False, error="Không có quyền sửa dữ liệu sở khác"), 403
 
-    allowed_fields = {
-        "chuc_vu",
-        "name",
-        "giao_thong",
-        "xa_1_4",
-        "xa_5_6",
-        "giam_sat_1_5",
-        "giam_sat_6",
-        "an_sai",
-        "tien_khoan_1_2",
-        "tien_khoan_3_5",
-        "tien_khoan_6_truy_na",
+    resp = {
+        "success": True,
+        "tong_an": int(r["tong_an"] or 0),
+        "diem": int(r["diem"] or 0),
+        "giao_thong": int(r["giao_thong"] or 0),
+        "giam_sat_1_5": int(r["giam_sat_1_5"] or 0),
+        "giam_sat_6": int(r["giam_sat_6"] or 0),
+        "chuc_vu": r["chuc_vu"],
+        "tong_tien": int(r["tong_tien"] or 0),
     }
-    if field not in allowed_fields:
-        conn.close()
-        return jsonify(success=False, error="Trường không hợp lệ")
 
-    # Chức vụ chỉ cho phép 4 giá trị
-    if field == "chuc_vu":
-        if value not in ("Thực tập", "Cảnh sát viên", "Sĩ quan dự bị", "Đội phó"):
-            conn.close()
-            return jsonify(success=False, error="Chức vụ không hợp lệ")
-        if value == "Thực tập":
-            c.execute("UPDATE records SET chuc_vu=?, giam_sat_1_5=0, giam_sat_6=0, giam_sat=0 WHERE id=?", (value, rid))
-        else:
-            c.execute("UPDATE records SET chuc_vu=? WHERE id=?", (value, rid))
-    else:
-        c.execute(f"UPDATE records SET {field}=? WHERE id=?", (value, rid))
-
-    c.execute(
-        "SELECT chuc_vu,giao_thong,xa_1_4,xa_5_6,giam_sat_1_5,giam_sat_6,an_sai,"
-        "tien_khoan_1_2,tien_khoan_3_5,tien_khoan_6_truy_na "
-        "FROM records WHERE id=?",
-        (rid,)
+    user_name = session.get("username", "Unknown")
+    write_log(
+        None, "INLINE_EDIT", rid, user_name, f"Chỉnh sửa {field} = {value}",
+        so=current_so, field=field, old_value=old_value, new_value=value,
     )
-    r = c.fetchone()
-
-    chuc_vu = r["chuc_vu"]
-    giao_thong = int(r["giao_thong"] or 0)
-    xa_1_4 = int(r["xa_1_4"] or 0)
-    xa_5_6 = int(r["xa_5_6"] or 0)
-    giam_sat_1_5 = int(r["giam_sat_1_5"] or 0)
-    giam_sat_6 = int(r["giam_sat_6"] or 0)
-    an_sai = int(r["an_sai"] or 0)
-    tien_khoan_1_2 = int(r["tien_khoan_1_2"] or 0)
-    tien_khoan_3_5 = int(r["tien_khoan_3_5"] or 0)
-    tien_khoan_6_truy_na = int(r["tien_khoan_6_truy_na"] or 0)
-
-    # Khi vừa sửa cột giao_thông: dùng luôn giá trị vừa gửi để tính điểm (tránh không cập nhật điểm)
-    if field == "giao_thong" and saved_value is not None:
-        giao_thong = saved_value
-
-    # Ràng buộc theo chức vụ
-    if chuc_vu == "Thực tập":
-        giam_sat_1_5 = 0
-        giam_sat_6 = 0
-        c.execute("UPDATE records SET giam_sat_1_5=0, giam_sat_6=0, giam_sat=0 WHERE id=?", (rid,))
-
-    # Tổng hồ sơ án = án 1-5 + án 6 + giám sát 1-5 + giám sát 6
-    tong_an = xa_1_4 + xa_5_6 + giam_sat_1_5 + giam_sat_6
-
-    # Điểm (công thức mới):
-    # - Thực tập:
-    #   + Giao thông: +1 điểm / hồ sơ
-    #   + Án hình sự khoản 1-5: +2 điểm
-    #   + Án hình sự khoản 6: +4 điểm
-    #   + Giám sát: không tính điểm
-    # - Cảnh sát viên / Sĩ quan dự bị / Đội phó:
-    #   + Giao thông: không tính điểm
-    #   + Án hình sự khoản 1-5: +2 điểm
-    #   + Án hình sự khoản 6: +4 điểm
-    #   + Giám sát 1-5: +2 điểm
-    #   + Giám sát 6: +6 điểm
-    # - Án sai: -5 điểm
-    if chuc_vu == "Thực tập":
-        diem = giao_thong * 1 + xa_1_4 * 2 + xa_5_6 * 4 - an_sai * 5
-    else:
-        diem = xa_1_4 * 2 + xa_5_6 * 4 + giam_sat_1_5 * 2 + giam_sat_6 * 6 - an_sai * 5
 
-    # Tiền xử án: 1-2 (3.000) + 3-5 (6.000) + 6 & truy nã đỏ (10.000)
-    tong_tien = (
-        tien_khoan_1_2 * 3000
-        + tien_khoan_3_5 * 6000
-        + tien_khoan_6_truy_na * 10000
-    )
+    if saved_value is not None:
+        resp["saved_value"] = saved_value
+    return jsonify(resp)
 
-    c.execute(
-        "UPDATE records SET giam_sat=?, tong_an=?, diem=?, tong_tien=? WHERE id=?",
-        (giam_sat_1_5 + giam_sat_6, tong_an, diem, tong_tien, rid)
+
+# Giới hạn số ô trong 1 lần dán
+BATCH_EDIT_MAX = 2000
+
+
+def _batch_edit_log(rid: int, fields: dict, old_row, user_name: str, so: str) -> tuple:
+    """
+    1 nhật ký / dòng cho batch edit, liệt kê mọi ô đã sửa (cũ → mới).
+    Sửa 1 ô: field / old_value / new_value như inline edit; nhiều ô: field = "a,b",
+    old_value / new_value là JSON {cột: giá trị}.
+    """
+    details = "Chỉnh sửa " + ", ".join(f"{f}: {old_row[f]} → {v}" for f, v in fields.items())
+    if len(fields) == 1:
+        (f, v), = fields.items()
+        return ("INLINE_EDIT", rid, user_name, details, so, f, old_row[f], v)
+    return (
+        "INLINE_EDIT", rid, user_name, details, so, ",".join(fields),
+        json.dumps({f: old_row[f] for f in fields}, ensure_ascii=False),
+        json.dumps(fields, ensure_ascii=False),
     )
 
+
+@app.post("/api/records/batch_edit")
+def api_records_batch_edit():
+    """
+    Sửa nhiều ô 1 lần (dán cả cột cuối tháng).
+    Body: {"edits": [{"id", "field", "value"}, ...]}
+    - Cùng quy tắc với /inline_edit (allowed fields, ép số, chức vụ, chặn sở khác).
+    - Ghi qua hàng đợi ghi bằng executemany trong 1 transaction, tính lại cột dẫn xuất 1 lần / dòng,
+      mỗi dòng 1 log (kèm giá trị cũ / mới).
+    Ô lỗi bị bỏ qua và trả về trong `errors`, các ô hợp lệ vẫn được lưu.
+    """
+    if not can_edit(session):
+        return jsonify(success=False, error="Không có quyền"), 403
+    data = request.json or {}
+    edits = data.get("edits") if isinstance(data, dict) else data
+    if not isinstance(edits, list) or not edits:
+        return jsonify(success=False, error="Danh sách edits trống"), 400
+    if len(edits) > BATCH_EDIT_MAX:
+        return jsonify(success=False, error=f"Tối đa {BATCH_EDIT_MAX} ô / lần"), 400
+
+    current_so = _session_so()
+    errors = []
+    # {rid: {field: value}} - cùng 1 ô sửa nhiều lần thì lấy giá trị cuối
+    changes: dict[int, dict] = {}
+    for idx, item in enumerate(edits):
+        try:
+            rid = int(item["id"])
+            field = item["field"]
+        except (KeyError, TypeError, ValueError):
+            errors.append({"index": idx, "error": "Thiếu id/field"})
+            continue
+        value, error = _coerce_inline_value(field, item.get("value"))
+        if error:
+            errors.append({"index": idx, "id": rid, "error": error})
+            continue
+        changes.setdefault(rid, {})[field] = value
+
+    if not changes:
+        return jsonify(success=False, error="Không có ô hợp lệ", errors=errors), 400
+
+    rules = tinhdiem.get_rules(current_so)
+
+    def job(c):
+        # Chặn sở khác: chỉ giữ các id thuộc sở hiện tại (đọc luôn giá trị cũ cho nhật ký)
+        ids = list(changes.keys())
+        placeholders = ",".join("?" * len(ids))
+        edited_fields = sorted({f for fields in changes.values() for f in fields})
+        c.execute(
+            f"SELECT id, {', '.join(edited_fields)} FROM records "
+            f"WHERE id IN ({placeholders}) AND COALESCE(so, 'TRU') = ?",
+            (*ids, current_so),
+        )
+        old_rows = {int(r["id"]): dict(r) for r in c.fetchall()}
+        ids = [rid for rid in ids if rid in old_rows]
+        if not ids:
+            return old_rows, {}
+
+        # 1 executemany cho mỗi cột được sửa
+        by_field: dict[str, list] = {}
+        for rid in ids:
+            for field, value in changes[rid].items():
+                by_field.setdefault(field, []).append((value, rid))
+        for field, rows in by_field.items():
+            c.executemany(f"UPDATE records SET {field} = ? WHERE id = ?", rows)
+
+        # Tính lại cột dẫn xuất 1 lần cho tất cả dòng bị đụng tới
+        placeholders = ",".join("?" * len(ids))
+        set_sql, set_params = tinhdiem.recompute_set_sql(rules)
+        c.execute(f"UPDATE records SET {set_sql} WHERE id IN ({placeholders})", (*set_params, *ids))
+        c.execute(
+            f"SELECT id, {_INLINE_EDIT_RETURNING}, "
+            "tien_khoan_1_2, tien_khoan_3_5, tien_khoan_6_truy_na, xa_1_4, xa_5_6, an_sai, name "
+            f"FROM records WHERE id IN ({placeholders})",
+            ids,
+        )
+        return old_rows, {int(r["id"]): dict(r) for r in c.fetchall()}
+
+    try:
+        old_rows, rows = hangdoighi.ghi(job, current_so)
+    except Exception as e:
+        return jsonify(success=False, error=str(e)), 500
+    for rid in list(changes):
+        if rid not in old_rows:
+            errors.append({"id": rid, "error": "Record không tồn tại hoặc thuộc sở khác"})
+            changes.pop(rid)
+    if not changes:
+        return jsonify(success=False, error="Không có ô hợp lệ", errors=errors), 400
+
     user_name = session.get("username", "Unknown")
-    write_log(c, "INLINE_EDIT", rid, user_name, f"Chỉnh sửa {field} = {value}")
-    conn.commit()
-    conn.close()
+    write_logs(None, [
+        _batch_edit_log(rid, fields, old_rows[rid], user_name, current_so)
+        for rid, fields in changes.items()
+    ])
+
+    result = []
+    for rid in changes:
+        r = rows.get(rid)
+        if r is None:
+            continue
+        item = {"id": rid, "chuc_vu": r["chuc_vu"], "name": r["name"]}
+        for key in (
+            "giao_thong", "xa_1_4", "xa_5_6", "giam_sat_1_5", "giam_sat_6", "an_sai",
+            "tien_khoan_1_2", "tien_khoan_3_5", "tien_khoan_6_truy_na", "tong_an", "diem", "tong_tien",
+        ):
+            item[key] = int(r[key] or 0)
+        result.append(item)
+    return jsonify(success=True, rows=result, errors=errors)
+
+# Giới hạn kích thước file nhập (byte)
+IMPORT_MAX_BYTES = int(os.environ.get("IMPORT_MAX_BYTES", str(5 * 1024 * 1024)) or 0)
+
+
+@app.post("/api/records/import")
+def api_records_import():
+    """
+    Nhập records hàng loạt từ file CSV / XLSX (form field `file`) vào sở hiện tại (xem nhapdulieu.py).
+    ?dry_run=1: chỉ kiểm tra, không ghi. Dòng lỗi / trùng tên được bỏ qua và trả về trong `errors`.
+    """
+    if not can_edit(session):
+        return jsonify(success=False, error="Không có quyền"), 403
+    if IMPORT_MAX_BYTES and (request.content_length or 0) > IMPORT_MAX_BYTES:
+        return jsonify(success=False, error=f"File quá lớn (tối đa {IMPORT_MAX_BYTES // 1024 // 1024}MB)"), 413
+    upload = request.files.get("file")
+    if upload is None or not upload.filename:
+        return jsonify(success=False, error="Thiếu file"), 400
+    dry_run = (request.args.get("dry_run") or request.form.get("dry_run") or "") in ("1", "true")
+
+    current_so = _session_so()
+    try:
+        valid, errors = nhapdulieu.kiem_tra(nhapdulieu.doc_file(upload.stream, upload.filename))
+    except (ValueError, UnicodeDecodeError) as e:
+        msg = "File không phải UTF-8" if isinstance(e, UnicodeDecodeError) else str(e)
+        return jsonify(success=False, error=msg), 400
+
+    def job(c):
+        # Lọc trùng và chèn trong cùng transaction ghi -> không lọt dòng trùng do ghi đồng thời
+        rows, dup_errors = nhapdulieu.loai_trung(c, current_so, valid)
+        inserted = nhapdulieu.chen(c, current_so, rows) if rows else 0
+        return rows, dup_errors, inserted
+
+    try:
+        if dry_run:
+            # Chỉ đọc, không cần xếp hàng ghi
+            conn = get_db(current_so, readonly=True)
+            try:
+                valid, dup_errors = nhapdulieu.loai_trung(conn.cursor(), current_so, valid)
+            finally:
+                conn.close()
+            inserted = 0
+        else:
+            valid, dup_errors, inserted = hangdoighi.ghi(job, current_so)
+    except Exception as e:
+        return jsonify(success=False, error=str(e)), 500
+    errors = sorted(errors + dup_errors, key=lambda e: e["row"])
+
+    if inserted:
+        write_log(
+            None, "IMPORT", None, session.get("username", "Unknown"),
+            f"Nhập {inserted} record từ {upload.filename}", so=current_so, new_value=inserted,
+        )
+    return jsonify(
+        success=True,
+        dry_run=dry_run,
+        so=current_so,
+        valid=len(valid),
+        inserted=inserted,
+        error_count=len(errors),
+        errors=errors[:nhapdulieu.IMPORT_MAX_ERRORS],
+    )
 
-    resp = {
-        "success": True,
-        "tong_an": tong_an,
-        "diem": diem,
-        "giao_thong": giao_thong,
-        "giam_sat_1_5": giam_sat_1_5,
-        "giam_sat_6": giam_sat_6,
-        "chuc_vu": chuc_vu,
-        "tong_tien": tong_tien,
-    }
-    if saved_value is not None:
-        resp["saved_value"] = saved_value
-    return jsonify(resp)
 
 # ================= DELETE =================
 @app.route("/delete/<int:id>")
@@ -1152,31 +1563,30 @@ def delete(id):
     if not can_delete(session):
         return redirect("/dashboard")
 
-    conn = get_db()
-    c = conn.cursor()
-    # Lấy tên record trước khi xóa
-    c.execute("SELECT name, so FROM records WHERE id=?", (id,))
-    record = c.fetchone()
-    record_name = record["name"] if record else "Unknown"
-
-    # Chặn xóa record khác sở
-    try:
-        current_so = _effective_so_for_session(
-            get_user_role(session),
-            session.get("so_allowed", "TRU"),
-            session.get("current_so", "TRU"),
-        )
+    current_so = _effective_so_for_session(
+        get_user_role(session),
+        session.get("so_allowed", "TRU"),
+        session.get("current_so", "TRU"),
+    )
+    def job(c):
+        # Lấy tên record trước khi xóa
+        c.execute("SELECT name, so FROM records WHERE id=?", (id,))
+        record = c.fetchone()
+        # Chặn xóa record khác sở
         if record and _normalize_so(record["so"]) != _normalize_so(current_so):
-            conn.close()
-            return redirect("/dashboard")
-    except Exception:
-        pass
-    
-    c.execute("DELETE FROM records WHERE id=?", (id,))
+            return None, False
+        c.execute("DELETE FROM records WHERE id=?", (id,))
+        return (dict(record) if record else None), True
+
+    record, deleted = hangdoighi.ghi(job, current_so)
+    if not deleted:
+        return redirect("/dashboard")
+    record_name = record["name"] if record else "Unknown"
     user_name = session.get("username", "Unknown")
-    write_log(c, "DELETE", id, user_name, f"Xóa record: {record_name}")
-    conn.commit()
-    conn.close()
+    write_log(
+        None, "DELETE", id, user_name, f"Xóa record: {record_name}",
+        so=_normalize_so(record["so"]) if record else None, old_value=record_name,
+    )
 
     return redirect("/dashboard")
 
@@ -1190,14 +1600,7 @@ def api_set_monthly_title():
     so = _normalize_so(data.get("so") or session.get("current_so") or "TRU")
     if not title:
         return jsonify(success=False, error="Tiêu đề không được để trống"), 400
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "INSERT INTO settings(key,value) VALUES(?,?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
-        (f"monthly_title_{so}", title),
-    )
-    conn.commit()
-    conn.close()
+    hangdoighi.ghi(lambda c: set_settings(c, {f"monthly_title_{so}": title}))
     return jsonify(success=True, title=title, so=so)
 
 
@@ -1213,20 +1616,90 @@ def api_set_stats_settings():
         return jsonify(success=False, error="Tiêu đề không được để trống"), 400
     if not label:
         return jsonify(success=False, error="Nhãn trục không được để trống"), 400
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        "INSERT INTO settings(key,value) VALUES(?,?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
-        (f"stats_title_{so}", title),
-    )
-    c.execute(
-        "INSERT INTO settings(key,value) VALUES(?,?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
-        (f"stats_label_{so}", label),
-    )
-    conn.commit()
-    conn.close()
+    hangdoighi.ghi(lambda c: set_settings(c, {f"stats_title_{so}": title, f"stats_label_{so}": label}))
     return jsonify(success=True, title=title, label=label, so=so)
 
+@app.get("/api/scoring")
+def api_get_scoring():
+    """Bộ quy tắc tính điểm đang áp dụng cho sở."""
+    if not session.get("login"):
+        return jsonify(success=False, error="Chưa đăng nhập"), 401
+    so = _normalize_so(request.args.get("so") or session.get("current_so"))
+    if session.get("role") != "admin":
+        so = _session_so()
+    active = tinhdiem.get_active_rules(so)
+    return jsonify(success=True, so=so, source_so=active["so"], version=active["version"], rules=active["rules"])
+
+
+@app.post("/api/scoring")
+def api_set_scoring():
+    """
+    Lưu bộ quy tắc mới (version mới) cho 1 sở hoặc ALL.
+    rescore=true: tính lại luôn toàn bộ records của sở đó trong cùng transaction.
+    """
+    if not session.get("login") or session.get("role") != "admin":
+        return jsonify(success=False, error="Không có quyền (chỉ admin)"), 403
+    data = request.json or {}
+    so = (data.get("so") or "").strip().upper()
+    if so not in ("TRU", "LS", "PS", "ALL"):
+        return jsonify(success=False, error="Sở không hợp lệ"), 400
+    try:
+        rules = tinhdiem.validate_rules(data.get("rules"))
+    except ValueError as e:
+        return jsonify(success=False, error=str(e)), 400
+    targets = []
+    if data.get("rescore"):
+        for target in (("TRU", "LS", "PS") if so == "ALL" else (so,)):
+            # Sở có bộ quy tắc riêng thì không bị bộ ALL ghi đè
+            if so == "ALL" and tinhdiem.get_active_rules(target)["so"] == target:
+                continue
+            targets.append(target)
+    user_name = session.get("username", "Admin")
+    affected = 0
+    version = None
+    # Quy tắc nằm ở catalog, records ở file của từng sở (shard SQLite) -> mỗi file 1 transaction,
+    # catalog trước; không shard thì chỉ có 1 transaction như cũ
+    def job(c, key):
+        saved = version
+        if key is None:
+            saved = tinhdiem.save_rules(c, so, rules, user_name)
+        rescored = 0
+        for target in targets:
+            if db_key(target) == key:
+                rescored += tinhdiem.rescore(c, target, rules)
+        if key == db_key(so):
+            write_log(c, "SCORING_RULES", None, user_name, f"Quy tắc điểm so={so} v{saved}", durable=True, so=so)
+        return saved, rescored
+
+    for key in dict.fromkeys([None, *(db_key(t) for t in targets), db_key(so)]):
+        try:
+            version, rescored = hangdoighi.ghi(lambda c, key=key: job(c, key), key)
+        except Exception as e:
+            return jsonify(success=False, error=str(e)), 500
+        affected += rescored
+    return jsonify(success=True, so=so, version=version, affected=affected)
+
+
+@app.post("/api/scoring/rescore")
+def api_rescore():
+    """Tính lại điểm / tiền cho toàn bộ records của sở hiện tại theo quy tắc đang áp dụng."""
+    if not can_edit(session):
+        return jsonify(success=False, error="Không có quyền"), 403
+    so = _session_so()
+    user_name = session.get("username", "Admin")
+
+    def job(c):
+        affected = tinhdiem.rescore(c, so)
+        write_log(c, "RESCORE", None, user_name, f"Tính lại điểm so={so}", durable=True, so=so)
+        return affected
+
+    try:
+        affected = hangdoighi.ghi(job, so)
+    except Exception as e:
+        return jsonify(success=False, error=str(e)), 500
+    return jsonify(success=True, so=so, affected=affected)
+
+
 @app.route("/logout")
 def logout():
     session.clear()
@@ -0,0 +1,362 @@
+# cache.py
+"""
+Cache trong process + bộ đếm version dùng chung giữa các worker gunicorn.
+
+- Mỗi nhóm dữ liệu (users, settings, ...) có 1 dòng trong bảng cache_versions.
+- Ghi dữ liệu -> bump_version(cur, name) trong CÙNG transaction.
+- Worker khác đọc lại bảng cache_versions tối đa 1 lần / CACHE_VERSION_POLL giây
+  (1 query cho tất cả nhóm), thấy version đổi thì bỏ cache cũ.
+- Shard SQLite: nhóm theo sở ('records:TRU', ...) nằm trong cache_versions của shard đó
+  (trigger ghi cùng transaction với records), xem database.db_for_version.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response, request
+
+from database import db_for_version, db_keys, fan_out, get_db
+
+# Chu kỳ đọc lại bảng cache_versions (giây) -> thay đổi quyền áp dụng trong vài giây
+CACHE_VERSION_POLL = float(os.environ.get("CACHE_VERSION_POLL", "2") or 2)
+
+_versions: dict[str, int] = {}
+_local_gen: dict[str, int] = {}
+_versions_checked_at = 0.0
+_versions_lock = threading.Lock()
+
+
+def _read_all(key) -> dict:
+    conn = get_db(key, readonly=True)
+    try:
+        c = conn.cursor()
+        c.execute("SELECT name, version FROM cache_versions")
+        rows = c.fetchall()
+    finally:
+        conn.close()
+    # Chỉ nhận nhóm thuộc đúng file này (catalog có thể còn dòng cũ của sở trước khi tách)
+    return {r["name"]: int(r["version"] or 0) for r in rows if db_for_version(r["name"]) == key}
+
+
+def _poll_versions():
+    global _versions, _versions_checked_at
+    try:
+        versions = {}
+        for part in fan_out(_read_all, db_keys()):
+            versions.update(part)
+        _versions = versions
+    except Exception:
+        # Bảng chưa có / DB lỗi: giữ version cũ, lần sau thử lại
+        pass
+    _versions_checked_at = time.monotonic()
+
+
+def get_version(name: str) -> tuple[int, int]:
+    """Trả về token version hiện tại của nhóm `name` (so sánh bằng ==)."""
+    if time.monotonic() - _versions_checked_at >= CACHE_VERSION_POLL:
+        with _versions_lock:
+            if time.monotonic() - _versions_checked_at >= CACHE_VERSION_POLL:
+                _poll_versions()
+    return (_versions.get(name, 0), _local_gen.get(name, 0))
+
+
+def read_versions(names) -> dict:
+    """
+    Đọc thẳng version hiện tại của các nhóm (1 query theo khoá chính / file DB, không chờ chu kỳ poll).
+    Dùng khi cần chắc chắn mới nhất, vd. làm ETag.
+    """
+    names = list(names)
+    if not names:
+        return {}
+    groups: dict = {}
+    for name in names:
+        groups.setdefault(db_for_version(name), []).append(name)
+    found = {}
+    for key, group in groups.items():
+        conn = get_db(key, readonly=True)
+        try:
+            c = conn.cursor()
+            c.execute(
+                f"SELECT name, version FROM cache_versions WHERE name IN ({', '.join('?' for _ in group)})",
+                group,
+            )
+            rows = c.fetchall()
+        finally:
+            conn.close()
+        found.update((r["name"], int(r["version"] or 0)) for r in rows)
+    return {name: found.get(name, 0) for name in names}
+
+
+def bump_version(c, name: str):
+    """
+    Tăng version của nhóm `name` bằng cursor `c` (cùng transaction với thay đổi dữ liệu).
+    Worker hiện tại bỏ cache ngay; worker khác thấy sau tối đa CACHE_VERSION_POLL giây.
+    """
+    global _versions_checked_at
+    c.execute(
+        "INSERT INTO cache_versions(name, version) VALUES(?, 1) "
+        "ON CONFLICT(name) DO UPDATE SET version = cache_versions.version + 1",
+        (name,),
+    )
+    with _versions_lock:
+        _local_gen[name] = _local_gen.get(name, 0) + 1
+        _versions_checked_at = 0.0
+
+
+class TTLCache:
+    """
+    Dict có TTL, gắn với version của 1 nhóm dữ liệu.
+    Khi version nhóm đổi, toàn bộ entry cũ coi như hết hạn.
+    """
+
+    _MISSING = object()
+
+    def __init__(self, group: str, ttl: float, max_size: int = 1024):
+        self.group = group
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data: dict = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        version = get_version(self.group)
+        with self._lock:
+            item = self._data.get(key)
+        if item is None:
+            return default
+        value, ver, expires_at = item
+        if ver != version or time.monotonic() >= expires_at:
+            with self._lock:
+                self._data.pop(key, None)
+            return default
+        return value
+
+    def set(self, key, value, version=None):
+        if version is None:
+            version = get_version(self.group)
+        with self._lock:
+            if len(self._data) >= self.max_size and key not in self._data:
+                self._data.clear()
+            self._data[key] = (value, version, time.monotonic() + self.ttl)
+
+    def get_or_load(self, key, loader):
+        value = self.get(key, self._MISSING)
+        if value is self._MISSING:
+            # Lấy version TRƯỚC khi load để dữ liệu cũ không bị gắn version mới
+            version = get_version(self.group)
+            value = loader()
+            self.set(key, value, version)
+        return value
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+# ================= Cache kết quả query (thống kê / top) =================
+# Backend chọn bằng RESULT_CACHE_BACKEND:
+#   dict   - trong process (mặc định)
+#   sqlite - file SQLite dùng chung giữa các worker cùng máy (RESULT_CACHE_PATH)
+#   redis  - Redis (RESULT_CACHE_URL), cần gói redis; thiếu thì quay về dict
+RESULT_CACHE_BACKEND = (os.environ.get("RESULT_CACHE_BACKEND") or "dict").strip().lower()
+RESULT_CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL", "300") or 300)
+RESULT_CACHE_MAX = int(os.environ.get("RESULT_CACHE_MAX", "512") or 512)
+RESULT_CACHE_PATH = os.environ.get("RESULT_CACHE_PATH") or os.path.join("database", "result_cache.db")
+RESULT_CACHE_URL = os.environ.get("RESULT_CACHE_URL") or "redis://localhost:6379/0"
+
+
+class DictBackend:
+    """LRU + TTL trong process."""
+
+    def __init__(self, max_size: int = RESULT_CACHE_MAX):
+        self.max_size = max_size
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if time.monotonic() >= expires_at:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value, ttl: float):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+
+class SqliteBackend:
+    """LRU + TTL trong 1 file SQLite riêng (không phải database.db), dùng chung giữa các worker."""
+
+    _EVICT_EVERY = 64
+
+    def __init__(self, path: str = RESULT_CACHE_PATH, max_size: int = RESULT_CACHE_MAX):
+        self.path = path
+        self.max_size = max_size
+        self._local = threading.local()
+        self._sets = 0
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            folder = os.path.dirname(self.path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=2, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS result_cache("
+                "key TEXT PRIMARY KEY, value TEXT, expires_at REAL, used_at REAL)"
+            )
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str):
+        now = time.time()
+        try:
+            conn = self._conn()
+            row = conn.execute(
+                "SELECT value FROM result_cache WHERE key = ? AND expires_at > ?", (key, now)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE result_cache SET used_at = ? WHERE key = ?", (now, key))
+            return json.loads(row[0])
+        except sqlite3.Error:
+            return None
+
+    def set(self, key: str, value, ttl: float):
+        now = time.time()
+        try:
+            conn = self._conn()
+            conn.execute(
+                "INSERT INTO result_cache(key, value, expires_at, used_at) VALUES(?,?,?,?) "
+                "ON CONFLICT(key) DO UPDATE SET value=excluded.value, "
+                "expires_at=excluded.expires_at, used_at=excluded.used_at",
+                (key, json.dumps(value, ensure_ascii=False), now + ttl, now),
+            )
+            self._sets += 1
+            if self._sets % self._EVICT_EVERY == 0:
+                conn.execute("DELETE FROM result_cache WHERE expires_at <= ?", (now,))
+                conn.execute(
+                    "DELETE FROM result_cache WHERE key IN ("
+                    "SELECT key FROM result_cache ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_size,),
+                )
+        except sqlite3.Error:
+            # Cache hỏng / bị khoá: bỏ qua, lần sau tính lại
+            pass
+
+
+class RedisBackend:
+    """Redis: TTL bằng SETEX, LRU do Redis lo (maxmemory-policy allkeys-lru)."""
+
+    def __init__(self, url: str = RESULT_CACHE_URL):
+        import redis  # type: ignore[import]
+
+        self._client = redis.Redis.from_url(url, socket_timeout=0.5)
+
+    def get(self, key: str):
+        try:
+            raw = self._client.get(key)
+        except Exception:
+            return None
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key: str, value, ttl: float):
+        try:
+            self._client.setex(key, max(1, int(ttl)), json.dumps(value, ensure_ascii=False))
+        except Exception:
+            pass
+
+
+def make_backend(name: str = RESULT_CACHE_BACKEND):
+    if name == "sqlite":
+        return SqliteBackend()
+    if name == "redis":
+        try:
+            return RedisBackend()
+        except ImportError:
+            return DictBackend()
+    return DictBackend()
+
+
+class ResultCache:
+    """
+    Cache kết quả hàm thuần theo tham số + version dữ liệu nguồn.
+    Entry lưu kèm version; mọi ghi records bump version (trigger) nên entry cũ tự bị bỏ qua,
+    không cần xoá chủ động. Caller truyền version đã đọc (vd. cùng version dùng làm ETag)
+    để dữ liệu và ETag luôn khớp nhau.
+    """
+
+    def __init__(self, namespace: str, ttl: float = RESULT_CACHE_TTL, backend=None):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.backend = backend
+        self._lock = threading.Lock()
+
+    def _backend(self):
+        backend = self.backend
+        if backend is not None:
+            return backend
+        # Nhiều thread cùng gọi lần đầu: chỉ tạo 1 backend (sqlite / redis mở kết nối)
+        with self._lock:
+            if self.backend is None:
+                self.backend = make_backend()
+            return self.backend
+
+    def get_or_load(self, key, version, loader):
+        full_key = f"{self.namespace}:{json.dumps(key, ensure_ascii=False)}"
+        version = json.loads(json.dumps(version))
+        item = self._backend().get(full_key)
+        if item is not None and item.get("v") == version:
+            return item["d"]
+        value = loader()
+        self._backend().set(full_key, {"v": version, "d": value}, self.ttl)
+        return value
+
+
+# ================= HTTP conditional cache (ETag / 304) =================
+# Dữ liệu theo phiên đăng nhập: chỉ trình duyệt được giữ, luôn hỏi lại server (304 rất rẻ)
+PRIVATE_NO_CACHE = "private, no-cache"
+
+
+def make_etag(*parts) -> str:
+    """ETag mạnh từ các phần (tên endpoint, tham số, version...)."""
+    raw = "|".join(str(p) for p in parts)
+    return hashlib.sha1(raw.encode()).hexdigest()[:24]
+
+
+def not_modified(etag: str, cache_control: str = PRIVATE_NO_CACHE):
+    """Trả response 304 nếu If-None-Match của client khớp `etag`, ngược lại None."""
+    if not request.if_none_match.contains(etag):
+        return None
+    resp = Response(status=304)
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = cache_control
+    resp.headers["Vary"] = "Cookie"
+    return resp
+
+
+def with_etag(resp, etag: str, cache_control: str = PRIVATE_NO_CACHE):
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = cache_control
+    resp.headers["Vary"] = "Cookie"
+    return resp
@@ -0,0 +1,47 @@
+# caidat.py
+"""
+Cấu hình (bảng settings) đọc từ cache trong process.
+Bảng rất nhỏ nên load cả bảng 1 lần; ghi qua set_settings() sẽ bump version "settings"
+để mọi worker load lại.
+"""
+import os
+
+from cache import TTLCache, bump_version
+from database import get_db
+
+SETTINGS_CACHE_TTL = float(os.environ.get("SETTINGS_CACHE_TTL", "300") or 300)
+_settings_cache = TTLCache("settings", SETTINGS_CACHE_TTL, max_size=1)
+
+
+def _load_all_settings() -> dict:
+    conn = get_db(readonly=True)
+    c = conn.cursor()
+    c.execute("SELECT key, value FROM settings")
+    rows = c.fetchall()
+    conn.close()
+    return {r["key"]: r["value"] for r in rows}
+
+
+def _all_settings() -> dict:
+    return _settings_cache.get_or_load("all", _load_all_settings)
+
+
+def get_setting(key: str, default: str = "") -> str:
+    return _all_settings().get(key) or default
+
+
+def get_settings(keys, defaults: dict | None = None) -> dict:
+    """Lấy nhiều key cùng lúc: {key: value}, thiếu thì lấy trong defaults (hoặc "")."""
+    data = _all_settings()
+    defaults = defaults or {}
+    return {k: data.get(k) or defaults.get(k, "") for k in keys}
+
+
+def set_settings(c, items: dict):
+    """Ghi nhiều key bằng cursor `c` (caller tự commit)."""
+    for key, value in items.items():
+        c.execute(
+            "INSERT INTO settings(key,value) VALUES(?,?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+            (key, value),
+        )
+    bump_version(c, "settings")
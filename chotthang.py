@@ -0,0 +1,160 @@
+# chotthang.py
+"""
+Chốt tháng: thay cho reset điểm kiểu xoá trắng (mất lịch sử).
+
+chot_thang() trong 1 transaction:
+0. Lần chốt đầu tiên của sở: sao records_monthly sang records_monthly_frozen (bước 3 làm trigger
+   trừ ngược vào các tháng cũ -> thống kê các tháng trước lần chốt đầu đọc bản sao này).
+1. Chụp toàn bộ records của sở vào records_snapshots (chỉ-ghi-thêm, 1 dòng / cán bộ / tháng)
+   bằng 1 câu INSERT ... SELECT.
+2. Tính tổng hợp của tháng (số người, tổng án, điểm, tiền) từ bản chụp -> records_closes.
+3. Đưa số liệu của đúng các dòng vừa chụp về 0 (record thêm sau bước 1 giữ nguyên).
+
+Bảng xếp hạng / biểu đồ của tháng đã chốt chỉ đọc 2 bảng trên, không đụng records.
+"""
+from datetime import datetime
+
+from cache import ResultCache, bump_version, read_versions
+from database import get_db, is_postgres
+from tinhdiem import DIEM_FIELDS, TIEN_FIELDS
+
+# Cột số liệu được chụp lại rồi đưa về 0 khi chốt (giam_sat = giam_sat_1_5 + giam_sat_6 nên không lưu)
+SNAPSHOT_FIELDS = DIEM_FIELDS + ("tong_an", "diem") + TIEN_FIELDS + ("tong_tien",)
+RESET_FIELDS = ("giam_sat",) + SNAPSHOT_FIELDS
+
+CLOSE_COLUMNS = "so, nam, thang, so_luong, tong_an, tong_diem, tong_tien, closed_by, closed_at"
+
+_history_top_cache = ResultCache("top_thang")
+
+
+def version_key(so: str) -> str:
+    return f"closes:{so}"
+
+
+def parse_thang(value: str | None) -> tuple[int, int]:
+    """'YYYY-MM' -> (nam, thang); rỗng = tháng hiện tại. Sai định dạng / tháng tương lai thì ValueError."""
+    now = datetime.now()
+    if not value:
+        return now.year, now.month
+    try:
+        d = datetime.strptime(value.strip(), "%Y-%m")
+    except ValueError:
+        raise ValueError("Tháng không hợp lệ (YYYY-MM)")
+    if (d.year, d.month) > (now.year, now.month):
+        raise ValueError("Không thể chốt tháng chưa tới")
+    return d.year, d.month
+
+
+def _close_dict(row) -> dict:
+    return {
+        "so": row["so"],
+        "month": f"{int(row['nam']):04d}-{int(row['thang']):02d}",
+        "so_luong": int(row["so_luong"] or 0),
+        "tong_an": int(row["tong_an"] or 0),
+        "tong_diem": int(row["tong_diem"] or 0),
+        "tong_tien": int(row["tong_tien"] or 0),
+        "closed_by": row["closed_by"],
+        "closed_at": row["closed_at"],
+    }
+
+
+def chot_thang(c, so: str, nam: int, thang: int, closed_by: str | None = None) -> dict:
+    """
+    Chốt tháng `nam`-`thang` của sở `so` bằng cursor `c`. Caller tự commit (lỗi thì rollback).
+    Tháng đã chốt thì raise ValueError. Trả tổng hợp của tháng (như ds_thang_da_chot).
+    """
+    c.execute("SELECT 1 FROM records_closes WHERE so = ? AND nam = ? AND thang = ?", (so, nam, thang))
+    if c.fetchone():
+        raise ValueError(f"Tháng {thang:02d}/{nam} của sở {so} đã chốt")
+    if is_postgres():
+        # Giữ các dòng tới lúc reset: sửa đồng thời chờ transaction này, không bị reset mà chưa chụp
+        c.execute("SELECT id FROM records WHERE so = ? FOR UPDATE", (so,))
+
+    c.execute("SELECT 1 FROM records_closes WHERE so = ? LIMIT 1", (so,))
+    if c.fetchone() is None:
+        c.execute(
+            """
+            INSERT INTO records_monthly_frozen(so, nam, thang, tong_an, tong_diem, tong_tien, so_luong)
+            SELECT so, nam, thang, tong_an, tong_diem, tong_tien, so_luong FROM records_monthly WHERE so = ?
+            """,
+            (so,),
+        )
+
+    fields = ", ".join(SNAPSHOT_FIELDS)
+    c.execute(
+        f"""
+        INSERT INTO records_snapshots(so, nam, thang, record_id, name, chuc_vu, {fields})
+        SELECT so, ?, ?, id, name, chuc_vu, {fields}
+        FROM records WHERE so = ?
+        """,
+        (nam, thang, so),
+    )
+    closed_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    c.execute(
+        f"""
+        INSERT INTO records_closes({CLOSE_COLUMNS})
+        SELECT ?, ?, ?, COUNT(1), COALESCE(SUM(tong_an), 0), COALESCE(SUM(diem), 0),
+               COALESCE(SUM(tong_tien), 0), ?, ?
+        FROM records_snapshots
+        WHERE so = ? AND nam = ? AND thang = ?
+        """,
+        (so, nam, thang, closed_by, closed_at, so, nam, thang),
+    )
+    reset = ", ".join(f"{f}=0" for f in RESET_FIELDS)
+    c.execute(
+        f"""
+        UPDATE records SET {reset}
+        WHERE so = ? AND id IN (
+            SELECT record_id FROM records_snapshots WHERE so = ? AND nam = ? AND thang = ?
+        )
+        """,
+        (so, so, nam, thang),
+    )
+    bump_version(c, version_key(so))
+    c.execute(f"SELECT {CLOSE_COLUMNS} FROM records_closes WHERE so = ? AND nam = ? AND thang = ?", (so, nam, thang))
+    return _close_dict(c.fetchone())
+
+
+def ds_thang_da_chot(so: str, nam: int | None = None) -> list:
+    """Các tháng đã chốt của sở (tổng hợp lúc chốt), mới nhất trước."""
+    sql = f"SELECT {CLOSE_COLUMNS} FROM records_closes WHERE so = ?"
+    params = [so]
+    if nam:
+        sql += " AND nam = ?"
+        params.append(int(nam))
+    conn = get_db(so, readonly=True)
+    c = conn.cursor()
+    c.execute(sql + " ORDER BY nam DESC, thang DESC", params)
+    rows = [_close_dict(r) for r in c.fetchall()]
+    conn.close()
+    return rows
+
+
+def top_thang(so: str, nam: int, thang: int, limit: int = 3, chuc_vu=None, version=None) -> list:
+    """
+    Bảng xếp hạng của 1 tháng đã chốt, đọc từ records_snapshots (đúng như lúc chốt).
+    Tháng chưa chốt trả []. Cache theo version closes:<sở> (chỉ đổi khi chốt thêm tháng).
+    """
+    chuc_vu = sorted(set(chuc_vu)) if chuc_vu else None
+    if version is None:
+        version = read_versions([version_key(so)])[version_key(so)]
+
+    def load():
+        sql = """
+            SELECT name, SUM(diem) AS score FROM records_snapshots
+            WHERE so = ? AND nam = ? AND thang = ?
+        """
+        params = [so, nam, thang]
+        if chuc_vu:
+            sql += f" AND chuc_vu IN ({', '.join('?' * len(chuc_vu))})"
+            params += chuc_vu
+        sql += " GROUP BY name ORDER BY score DESC, name LIMIT ?"
+        params.append(limit)
+        conn = get_db(so, readonly=True)
+        c = conn.cursor()
+        c.execute(sql, params)
+        rows = [{"name": r["name"], "score": int(r["score"] or 0)} for r in c.fetchall()]
+        conn.close()
+        return rows
+
+    return _history_top_cache.get_or_load([so, nam, thang, limit, chuc_vu], [version], load)
@@ -1,24 +1,81 @@
 import os
+import re
 import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from pathlib import Path
 from typing import Any, Optional, Sequence
 
 
 _RAW_DATABASE_URL = os.environ.get("DATABASE_URL")
 # Render env đôi khi bị dính newline khi paste -> gây lỗi sslmode="require\n"
 DATABASE_URL = (_RAW_DATABASE_URL.strip() if isinstance(_RAW_DATABASE_URL, str) else None) or None
+_RAW_DATABASE_READ_URL = os.environ.get("DATABASE_READ_URL")
+DATABASE_READ_URL = (_RAW_DATABASE_READ_URL.strip() if isinstance(_RAW_DATABASE_READ_URL, str) else None) or None
 
 
 def is_postgres() -> bool:
     return bool(DATABASE_URL)
 
 
-def get_db():
-    """
-    - Render/Prod: dùng Neon Postgres từ env DATABASE_URL (psycopg2)
-    - Local: fallback SQLite database.db
-    """
-    if DATABASE_URL:
-        import psycopg2
+def supports_returning() -> bool:
+    """UPDATE/INSERT ... RETURNING: Postgres luôn có, SQLite từ 3.35."""
+    return bool(DATABASE_URL) or sqlite3.sqlite_version_info >= (3, 35, 0)
+
+
+# ================= CONNECTION POOL =================
+# Mỗi request trước đây mở 1 connection mới (Neon: TLS handshake mỗi lần).
+# Giờ get_db() lấy connection từ pool; conn.close() chỉ trả về pool.
+# Số connection tối đa / process: phải >= số thread của gunicorn (Procfile đặt DB_POOL_MAX
+# theo --threads, cộng chỗ cho các thread nền), nếu không request sẽ chờ DB_POOL_TIMEOUT rồi lỗi.
+DB_POOL_MAX = max(1, int(os.environ.get("DB_POOL_MAX", "5") or 5))
+# Tuổi thọ tối đa của 1 connection (giây) -> hết hạn thì đóng và mở lại
+DB_POOL_MAX_LIFETIME = float(os.environ.get("DB_POOL_MAX_LIFETIME", "1800") or 1800)
+# Thời gian chờ tối đa khi pool đã hết connection rảnh (giây)
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10") or 10)
+# Connection rảnh lâu hơn ngưỡng này sẽ được ping (SELECT 1) trước khi dùng lại
+DB_POOL_HEALTHCHECK_IDLE = float(os.environ.get("DB_POOL_HEALTHCHECK_IDLE", "30") or 30)
+
+SQLITE_PATH = "database.db"
+
+# ================= SHARD THEO SỞ (SQLite) =================
+# SQLite chỉ có 1 khoá ghi / file: mỗi sở 1 file riêng (database/database<sở>.db) chứa records,
+# bảng tổng hợp, chốt tháng và nhật ký của sở đó -> ghi ở 2 sở khác nhau không chặn nhau.
+# database.db (catalog) giữ users, settings, login_logs, scoring_rules, log không thuộc sở nào.
+# Postgres khoá theo dòng nên không cần tách: get_db(so) trả cùng 1 DB.
+SHARD_SO = ("TRU", "LS", "PS")
+SHARD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "database")
+SQLITE_SHARDING = not DATABASE_URL and os.environ.get("SQLITE_SHARDING", "1") != "0"
+# Mỗi shard cấp id records trong khoảng riêng -> id không trùng giữa các sở
+SHARD_ID_SPAN = 1_000_000_000
+
+
+def shard_path(so: str) -> str:
+    return os.path.join(SHARD_DIR, f"database{so}.db")
+
+
+def db_key(so: Optional[str]) -> Optional[str]:
+    """File DB chứa dữ liệu của sở `so`: tên sở khi đang shard, None = catalog."""
+    return so if SQLITE_SHARDING and so in SHARD_SO else None
+
+
+def db_keys() -> list:
+    """Mọi file DB (None = catalog, rồi từng shard) để duyệt / fan-out."""
+    return [None, *SHARD_SO] if SQLITE_SHARDING else [None]
+
+
+def db_for_version(name: str) -> Optional[str]:
+    """File DB giữ dòng cache_versions `name`: 'records:TRU', 'closes:LS', ... nằm ở shard của sở."""
+    return db_key(name.rsplit(":", 1)[-1]) if ":" in name else None
+
+_pg_cursor_factory = None
+
+
+def _get_pg_cursor_factory():
+    global _pg_cursor_factory
+    if _pg_cursor_factory is None:
         import psycopg2.extras
 
         class _AdaptRealDictCursor(psycopg2.extras.RealDictCursor):
@@ -32,18 +89,419 @@ def get_db():
                     query = query.replace("?", "%s")
                 return super().executemany(query, vars_list)
 
-        return psycopg2.connect(
-            DATABASE_URL,
-            sslmode="require",
-            cursor_factory=_AdaptRealDictCursor,
-            connect_timeout=10,
-        )
+        _pg_cursor_factory = _AdaptRealDictCursor
+    return _pg_cursor_factory
+
+
+def _connect_postgres(url: Optional[str] = None):
+    import psycopg2
+
+    return psycopg2.connect(
+        url or DATABASE_URL,
+        sslmode="require",
+        cursor_factory=_get_pg_cursor_factory(),
+        connect_timeout=10,
+    )
 
-    conn = sqlite3.connect("database.db", timeout=15, check_same_thread=False)
+
+def _connect_sqlite(path: str = SQLITE_PATH, readonly: bool = False):
+    if readonly:
+        # mode=ro: connection đọc không bao giờ giành khoá ghi. Không dùng immutable=1 vì file
+        # vẫn đang được ghi (immutable bỏ qua WAL / khoá -> đọc dữ liệu cũ hoặc hỏng)
+        uri = Path(path).absolute().as_uri() + "?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, timeout=15, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA query_only=ON")
+        return conn
+    conn = sqlite3.connect(path, timeout=15, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    # synchronous là cấu hình theo connection (WAL đã bật sẵn trong file khi migrate)
+    conn.execute("PRAGMA synchronous=NORMAL")
     return conn
 
 
+class _Slot:
+    """1 connection thật + thời điểm tạo / lần dùng cuối."""
+
+    __slots__ = ("raw", "created_at", "last_used", "users")
+
+    def __init__(self, raw):
+        now = time.monotonic()
+        self.raw = raw
+        self.created_at = now
+        self.last_used = now
+        self.users = 0
+
+    def expired(self) -> bool:
+        return DB_POOL_MAX_LIFETIME > 0 and time.monotonic() - self.created_at > DB_POOL_MAX_LIFETIME
+
+
+def _safe_close(raw):
+    try:
+        raw.close()
+    except Exception:
+        pass
+
+
+def _ping(raw) -> bool:
+    try:
+        cur = raw.cursor()
+        cur.execute("SELECT 1")
+        cur.fetchone()
+        cur.close()
+        # Postgres: SELECT 1 mở transaction ngầm -> đóng lại cho sạch
+        raw.rollback()
+        return True
+    except Exception:
+        return False
+
+
+class PooledConnection:
+    """
+    Handle trả về từ get_db(). Mọi thuộc tính (cursor, commit, rollback, ...)
+    chuyển thẳng xuống connection thật.
+    - close(): rollback phần chưa commit rồi trả connection về pool (không đóng thật).
+    - with get_db() as conn: commit khi thành công, rollback khi lỗi, rồi trả về pool.
+    """
+
+    _slot = None
+
+    def __init__(self, pool, slot, readonly: bool = False):
+        self._pool = pool
+        self._slot = slot
+        self.readonly = readonly
+
+    @property
+    def raw(self):
+        if self._slot is None:
+            raise RuntimeError("Connection đã được trả về pool")
+        return self._slot.raw
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+    def close(self):
+        slot, self._slot = self._slot, None
+        if slot is not None:
+            self._pool.release(slot)
+
+    @property
+    def closed(self) -> bool:
+        return self._slot is None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if self._slot is not None:
+                if exc_type is None:
+                    self.raw.commit()
+                else:
+                    self.raw.rollback()
+        finally:
+            self.close()
+        return False
+
+    def __del__(self):
+        # Quên close() thì vẫn trả connection về pool khi handle bị GC
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class _PostgresPool:
+    """Pool giới hạn DB_POOL_MAX connection, an toàn đa luồng."""
+
+    def __init__(self, connect, max_size: int):
+        self._connect = connect
+        self._max_size = max_size
+        self._idle: list[_Slot] = []
+        self._opened = 0
+        self._cond = threading.Condition()
+        self._pid = os.getpid()
+
+    def _check_fork(self):
+        # gunicorn fork worker: không dùng lại connection của process cha
+        if self._pid != os.getpid():
+            self._idle = []
+            self._opened = 0
+            self._cond = threading.Condition()
+            self._pid = os.getpid()
+
+    def acquire(self) -> _Slot:
+        self._check_fork()
+        deadline = time.monotonic() + DB_POOL_TIMEOUT
+        with self._cond:
+            while True:
+                while self._idle:
+                    slot = self._idle.pop()
+                    if self._healthy(slot):
+                        slot.last_used = time.monotonic()
+                        return slot
+                    self._opened -= 1
+                    _safe_close(slot.raw)
+                if self._opened < self._max_size:
+                    self._opened += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"Hết connection trong pool (DB_POOL_MAX={self._max_size})")
+                self._cond.wait(remaining)
+        # Mở connection mới ngoài lock để không chặn các thread khác
+        try:
+            return _Slot(self._connect())
+        except Exception:
+            with self._cond:
+                self._opened -= 1
+                self._cond.notify()
+            raise
+
+    def _healthy(self, slot: _Slot) -> bool:
+        if getattr(slot.raw, "closed", 0) or slot.expired():
+            return False
+        if time.monotonic() - slot.last_used > DB_POOL_HEALTHCHECK_IDLE:
+            return _ping(slot.raw)
+        return True
+
+    def release(self, slot: _Slot):
+        raw = slot.raw
+        keep = not getattr(raw, "closed", 0) and not slot.expired()
+        if keep:
+            try:
+                # Không để transaction dở dang lọt sang request sau
+                raw.rollback()
+            except Exception:
+                keep = False
+        if self._pid != os.getpid():
+            return
+        with self._cond:
+            if keep:
+                slot.last_used = time.monotonic()
+                self._idle.append(slot)
+            else:
+                self._opened -= 1
+                _safe_close(raw)
+            self._cond.notify()
+
+    def close_all(self):
+        with self._cond:
+            for slot in self._idle:
+                _safe_close(slot.raw)
+            self._opened -= len(self._idle)
+            self._idle = []
+
+
+class _SqlitePool:
+    """
+    SQLite: mỗi thread giữ 1 connection dùng lại.
+    Gọi get_db() lồng nhau trong cùng thread sẽ dùng chung connection đó
+    (tránh tự khóa file khi 2 connection cùng ghi).
+    """
+
+    def __init__(self, connect):
+        self._connect = connect
+        self._local = threading.local()
+
+    def acquire(self) -> _Slot:
+        slot = getattr(self._local, "slot", None)
+        if slot is not None and slot.users == 0:
+            if slot.expired() or (
+                time.monotonic() - slot.last_used > DB_POOL_HEALTHCHECK_IDLE and not _ping(slot.raw)
+            ):
+                _safe_close(slot.raw)
+                slot = None
+        if slot is None:
+            slot = _Slot(self._connect())
+            self._local.slot = slot
+        slot.users += 1
+        slot.last_used = time.monotonic()
+        return slot
+
+    def release(self, slot: _Slot):
+        slot.users = max(0, slot.users - 1)
+        slot.last_used = time.monotonic()
+        if slot.users == 0 and slot.raw.in_transaction:
+            try:
+                slot.raw.rollback()
+            except Exception:
+                _safe_close(slot.raw)
+                if getattr(self._local, "slot", None) is slot:
+                    self._local.slot = None
+
+    def in_write_transaction(self) -> bool:
+        """Thread hiện tại đang giữ transaction ghi dở dang (chưa commit) trên file này."""
+        slot = getattr(self._local, "slot", None)
+        return slot is not None and slot.users > 0 and slot.raw.in_transaction
+
+    def close_all(self):
+        slot = getattr(self._local, "slot", None)
+        if slot is not None and slot.users == 0:
+            _safe_close(slot.raw)
+            self._local.slot = None
+
+
+_pools: dict = {}
+_pool_lock = threading.Lock()
+
+
+def _get_pool(key: Optional[str] = None, readonly: bool = False):
+    pool = _pools.get((key, readonly))
+    if pool is None:
+        with _pool_lock:
+            pool = _pools.get((key, readonly))
+            if pool is None:
+                if DATABASE_URL:
+                    url = DATABASE_READ_URL if readonly else DATABASE_URL
+                    pool = _PostgresPool(lambda: _connect_postgres(url), DB_POOL_MAX)
+                else:
+                    path = shard_path(key) if key else SQLITE_PATH
+                    pool = _SqlitePool(lambda: _connect_sqlite(path, readonly))
+                _pools[(key, readonly)] = pool
+    return pool
+
+
+# ================= ĐỌC TỪ REPLICA =================
+# get_db(readonly=True): chỗ chỉ đọc (dashboard, thống kê, top, nhật ký, danh sách users...).
+# - Postgres + DATABASE_READ_URL: lấy connection từ pool của replica. Replica trễ so với primary nên
+#   đọc về primary khi: request đang ghi / của session vừa ghi trong read_your_writes_window() giây
+#   (app đánh dấu bằng doc_tu_primary), replica trễ quá READ_REPLICA_MAX_LAG giây, hoặc replica
+#   không kết nối được. Ghi nền (nhật ký, log đăng nhập, hàng đợi ghi) không làm đọc về primary.
+# - SQLite: connection mode=ro riêng; thread đang giữ transaction ghi thì dùng luôn connection đó
+#   (đọc được phần mình vừa ghi, chưa commit).
+READ_REPLICA = bool(DATABASE_URL and DATABASE_READ_URL)
+READ_YOUR_WRITES_WINDOW = float(os.environ.get("READ_YOUR_WRITES_WINDOW", "5") or 5)
+READ_REPLICA_MAX_LAG = float(os.environ.get("READ_REPLICA_MAX_LAG", "30") or 30)
+# Chu kỳ đo độ trễ replica (giây)
+READ_REPLICA_LAG_CHECK = float(os.environ.get("READ_REPLICA_LAG_CHECK", "5") or 5)
+# Replica lỗi kết nối thì bỏ qua replica trong khoảng này (giây)
+READ_REPLICA_RETRY = 30.0
+
+_read_primary: ContextVar = ContextVar("read_primary", default=False)
+_replica_lag = 0.0
+_replica_lag_checked_at = 0.0
+_replica_down_until = 0.0
+_replica_lag_lock = threading.Lock()
+
+
+def doc_tu_primary(flag: bool = True):
+    """Đánh dấu ngữ cảnh hiện tại (1 request) đọc từ primary: session vừa ghi xong."""
+    _read_primary.set(bool(flag))
+
+
+def read_your_writes_window() -> float:
+    """Số giây sau khi ghi mà session vẫn đọc primary: READ_YOUR_WRITES_WINDOW, dài hơn nếu replica đang trễ hơn."""
+    return max(READ_YOUR_WRITES_WINDOW, _replica_lag)
+
+
+def _do_do_tre() -> Optional[float]:
+    """
+    Độ trễ replica (giây), đo lại tối đa 1 lần / READ_REPLICA_LAG_CHECK giây; query đo lỗi thì coi như 0.
+    Không lấy được connection replica thì đánh dấu replica lỗi (READ_REPLICA_RETRY giây) và trả None.
+    """
+    global _replica_lag, _replica_lag_checked_at, _replica_down_until
+    if time.monotonic() - _replica_lag_checked_at < READ_REPLICA_LAG_CHECK:
+        return _replica_lag
+    # Thread khác đang đo thì dùng số cũ, không xếp hàng chờ
+    if not _replica_lag_lock.acquire(blocking=False):
+        return _replica_lag
+    try:
+        pool = _get_pool(None, readonly=True)
+        try:
+            slot = pool.acquire()
+        except Exception:
+            _replica_down_until = time.monotonic() + READ_REPLICA_RETRY
+            return None
+        try:
+            cur = slot.raw.cursor()
+            # Đã phát lại hết WAL nhận được -> không trễ (primary rảnh thì replay_timestamp cũ dần)
+            cur.execute(
+                """
+                SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                       ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+                       END AS lag
+                """
+            )
+            row = cur.fetchone()
+            _replica_lag = float(row["lag"] or 0) if row else 0.0
+        except Exception:
+            _replica_lag = 0.0
+        finally:
+            pool.release(slot)
+        _replica_lag_checked_at = time.monotonic()
+        return _replica_lag
+    finally:
+        _replica_lag_lock.release()
+
+
+def _doc_tu_replica() -> bool:
+    if not READ_REPLICA or _read_primary.get():
+        return False
+    if time.monotonic() < _replica_down_until:
+        return False
+    lag = _do_do_tre()
+    return lag is not None and lag <= READ_REPLICA_MAX_LAG
+
+
+def get_db(so: Optional[str] = None, readonly: bool = False) -> PooledConnection:
+    """
+    - Render/Prod: dùng Neon Postgres từ env DATABASE_URL (psycopg2), qua pool
+    - Local: fallback SQLite database.db (1 connection dùng lại / thread)
+    - get_db(so): DB chứa records / nhật ký của sở `so` (shard SQLite riêng; Postgres và
+      SQLITE_SHARDING=0 thì vẫn là DB chung). so=None / 'ALL' = catalog.
+    - readonly=True: chỗ chỉ đọc -> replica (DATABASE_READ_URL) / connection SQLite mode=ro,
+      tự quay về primary khi cần đọc được dữ liệu vừa ghi (xem phần ĐỌC TỪ REPLICA).
+    conn.close() trả connection về pool; có thể dùng `with get_db() as conn:`.
+    """
+    global _replica_down_until
+    key = db_key(so)
+    if readonly:
+        if DATABASE_URL:
+            if _doc_tu_replica():
+                pool = _get_pool(key, readonly=True)
+                try:
+                    return PooledConnection(pool, pool.acquire(), readonly=True)
+                except Exception:
+                    # Replica lỗi: đọc primary, thử lại replica sau READ_REPLICA_RETRY giây
+                    _replica_down_until = time.monotonic() + READ_REPLICA_RETRY
+        elif not _get_pool(key).in_write_transaction():
+            pool = _get_pool(key, readonly=True)
+            return PooledConnection(pool, pool.acquire(), readonly=True)
+    pool = _get_pool(key)
+    return PooledConnection(pool, pool.acquire())
+
+
+def close_pool():
+    """Đóng các connection đang rảnh (dùng khi tắt worker)."""
+    for pool in list(_pools.values()):
+        pool.close_all()
+
+
+_fan_out_executor = None
+_fan_out_pid = None
+
+
+def fan_out(fn, keys) -> list:
+    """
+    Gọi fn(key) cho từng sở / file DB, trả kết quả theo thứ tự `keys`.
+    Đang shard thì chạy song song (mỗi shard 1 file, đọc không chờ nhau); fn không được dùng
+    request / session của Flask.
+    """
+    global _fan_out_executor, _fan_out_pid
+    keys = list(keys)
+    if not SQLITE_SHARDING or len(keys) <= 1:
+        return [fn(k) for k in keys]
+    if _fan_out_pid != os.getpid():
+        with _pool_lock:
+            if _fan_out_pid != os.getpid():
+                _fan_out_executor = ThreadPoolExecutor(
+                    max_workers=2 * (len(SHARD_SO) + 1), thread_name_prefix="shard-fan-out"
+                )
+                _fan_out_pid = os.getpid()
+    return list(_fan_out_executor.map(fn, keys))
+
+
 def adapt_sql(sql: str) -> str:
     """
     Convert sqlite-style placeholders (?) to psycopg2 style (%s) when using Postgres.
@@ -61,167 +519,77 @@ def execute(cur, sql: str, params: Optional[Sequence[Any]] = None):
     return cur
 
 
-def init_db():
+def iter_rows(conn, sql: str, params: Sequence[Any] = (), chunk: int = 1000):
     """
-    Tạo schema tương thích cả SQLite và Postgres.
+    Duyệt kết quả query theo từng lô `chunk` dòng, không nạp cả kết quả vào RAM.
+    Postgres: server-side cursor (named cursor, cần transaction -> caller rollback/close sau khi xong).
+    SQLite: cursor thường đã đọc dần, chỉ fetchmany.
     """
-    # SQLite mode: tạo folder database/ + 2 file TRU/LS (phục vụ backup / tách sau này)
-    if not DATABASE_URL:
-        try:
-            base_dir = os.path.dirname(os.path.abspath(__file__))
-            db_dir = os.path.join(base_dir, "database")
-            os.makedirs(db_dir, exist_ok=True)
-            for name in ("databaseTRU.db", "databaseLS.db"):
-                path = os.path.join(db_dir, name)
-                if not os.path.exists(path):
-                    tmp = sqlite3.connect(path)
-                    tmp.close()
-        except Exception:
-            pass
+    if DATABASE_URL:
+        cur = conn.cursor(name=f"iter_{id(conn):x}_{time.monotonic_ns():x}")
+        cur.itersize = chunk
+    else:
+        cur = conn.cursor()
+    try:
+        execute(cur, sql, params)
+        while True:
+            rows = cur.fetchmany(chunk)
+            if not rows:
+                return
+            yield from rows
+    finally:
+        cur.close()
 
-    conn = get_db()
-    cur = conn.cursor()
 
+# ================= SCHEMA / MIGRATIONS =================
+# Thứ tự ưu tiên chức vụ khi hiển thị bảng (dùng chung cho ORDER BY và index)
+CHUC_VU_RANK_SQL = (
+    "CASE chuc_vu"
+    " WHEN 'Đội phó' THEN 0"
+    " WHEN 'Cảnh sát viên' THEN 1"
+    " WHEN 'Sĩ quan dự bị' THEN 2"
+    " WHEN 'Thực tập' THEN 3"
+    " ELSE 4 END"
+)
+
+
+def _pk() -> str:
+    return "SERIAL PRIMARY KEY" if DATABASE_URL else "INTEGER PRIMARY KEY AUTOINCREMENT"
+
+
+def _column_exists(cur, table: str, column: str) -> bool:
     if DATABASE_URL:
         execute(
             cur,
-            """
-            CREATE TABLE IF NOT EXISTS users(
-                id SERIAL PRIMARY KEY,
-                username TEXT UNIQUE,
-                password TEXT,
-                role TEXT DEFAULT 'user',
-                so_allowed TEXT DEFAULT 'TRU'
-            );
-            """,
-        )
-        execute(
-            cur,
-            """
-            CREATE TABLE IF NOT EXISTS records(
-                id SERIAL PRIMARY KEY,
-                so TEXT DEFAULT 'TRU',
-                chuc_vu TEXT,
-                name TEXT,
-                giao_thong INTEGER DEFAULT 0,
-                xa_1_4 INTEGER DEFAULT 0,
-                xa_5_6 INTEGER DEFAULT 0,
-                giam_sat INTEGER DEFAULT 0,
-                giam_sat_1_5 INTEGER DEFAULT 0,
-                giam_sat_6 INTEGER DEFAULT 0,
-                an_sai INTEGER DEFAULT 0,
-                tong_an INTEGER DEFAULT 0,
-                diem INTEGER DEFAULT 0,
-                -- Tiền xử án
-                tien_khoan_1_2 INTEGER DEFAULT 0,
-                tien_khoan_3_5 INTEGER DEFAULT 0,
-                tien_khoan_6_truy_na INTEGER DEFAULT 0,
-                tong_tien INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT NOW()
-            );
-            """,
-        )
-        execute(
-            cur,
-            """
-            CREATE TABLE IF NOT EXISTS logs(
-                id SERIAL PRIMARY KEY,
-                action TEXT,
-                record_id INTEGER,
-                user_name TEXT,
-                time TEXT,
-                details TEXT
-            );
-            """,
-        )
-        execute(
-            cur,
-            """
-            CREATE TABLE IF NOT EXISTS login_logs(
-                id SERIAL PRIMARY KEY,
-                username TEXT,
-                ip TEXT,
-                user_agent TEXT,
-                location TEXT,
-                time TEXT
-            );
-            """,
+            "SELECT 1 FROM information_schema.columns WHERE table_name=? AND column_name=?",
+            (table, column),
         )
-        execute(
-            cur,
-            """
-            CREATE TABLE IF NOT EXISTS settings(
-                key TEXT PRIMARY KEY,
-                value TEXT
-            );
-            """,
-        )
-        execute(
-            cur,
-            """
-            INSERT INTO settings(key,value) VALUES('monthly_title','THỐNG KÊ ĐIỂM THÁNG')
-            ON CONFLICT(key) DO NOTHING;
-            """,
-        )
-        execute(
-            cur,
-            """
-            INSERT INTO settings(key,value) VALUES('monthly_title_TRU','THỐNG KÊ ĐIỂM THÁNG')
-            ON CONFLICT(key) DO NOTHING;
-            """,
-        )
-        execute(
-            cur,
-            """
-            INSERT INTO settings(key,value) VALUES('monthly_title_LS','THỐNG KÊ ĐIỂM THÁNG')
-            ON CONFLICT(key) DO NOTHING;
-            """,
-        )
-        execute(
-            cur,
-            """
-            INSERT INTO settings(key,value) VALUES('monthly_title_PS','THỐNG KÊ ĐIỂM THÁNG')
-            ON CONFLICT(key) DO NOTHING;
-            """,
-        )
-        # Tài khoản admin mặc định dùng mật khẩu admin123
-        execute(
-            cur,
-            """
-            INSERT INTO users(username,password,role,so_allowed)
-            VALUES('admin','admin123','admin','ALL')
-            ON CONFLICT(username) DO NOTHING;
-            """,
-        )
-        # Nếu DB cũ còn để mật khẩu admin thì tự động nâng lên admin123
-        execute(
-            cur,
-            "UPDATE users SET password='admin123', role='admin', so_allowed='ALL' WHERE username='admin' AND password='admin';",
-        )
-        execute(cur, "UPDATE users SET role='admin', so_allowed='ALL' WHERE username='admin';")
-        execute(cur, "ALTER TABLE records ADD COLUMN IF NOT EXISTS an_sai INTEGER DEFAULT 0;")
-        execute(cur, "ALTER TABLE records ADD COLUMN IF NOT EXISTS tong_an INTEGER DEFAULT 0;")
-        execute(cur, "ALTER TABLE records ADD COLUMN IF NOT EXISTS diem INTEGER DEFAULT 0;")
-        execute(cur, "ALTER TABLE records ADD COLUMN IF NOT EXISTS giam_sat_1_5 INTEGER DEFAULT 0;")
-        execute(cur, "ALTER TABLE records ADD COLUMN IF NOT EXISTS giam_sat_6 INTEGER DEFAULT 0;")
-        # Các cột phục vụ tab Tiền xử án
-        execute(cur, "ALTER TABLE records ADD COLUMN IF NOT EXISTS tien_khoan_1_2 INTEGER DEFAULT 0;")
-        execute(cur, "ALTER TABLE records ADD COLUMN IF NOT EXISTS tien_khoan_3_5 INTEGER DEFAULT 0;")
-        execute(cur, "ALTER TABLE records ADD COLUMN IF NOT EXISTS tien_khoan_6_truy_na INTEGER DEFAULT 0;")
-        execute(cur, "ALTER TABLE records ADD COLUMN IF NOT EXISTS tong_tien INTEGER DEFAULT 0;")
-        execute(cur, "ALTER TABLE login_logs ADD COLUMN IF NOT EXISTS location TEXT;")
-        conn.commit()
-        conn.close()
-        return
+        return cur.fetchone() is not None
+    execute(cur, f"PRAGMA table_info({table})")
+    return any(r["name"] == column for r in cur.fetchall())
+
 
-    # SQLite
-    execute(cur, "PRAGMA journal_mode=WAL;")
-    execute(cur, "PRAGMA synchronous=NORMAL;")
+def add_column_if_missing(cur, table: str, column: str, decl: str):
+    if DATABASE_URL:
+        execute(cur, f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {decl}")
+    elif not _column_exists(cur, table, column):
+        execute(cur, f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def insert_ignore(table: str, columns: str, conflict: str) -> str:
+    """INSERT bỏ qua nếu trùng khoá (cú pháp chung SQLite >= 3.24 và Postgres)."""
+    n = len(columns.split(","))
+    return f"INSERT INTO {table}({columns}) VALUES({','.join('?' * n)}) ON CONFLICT({conflict}) DO NOTHING"
+
+
+def _m001_baseline(cur):
+    """Schema gốc (idempotent để chạy được trên DB cũ chưa có schema_version)."""
+    created_at = "TIMESTAMP DEFAULT NOW()" if DATABASE_URL else "TEXT DEFAULT (datetime('now'))"
     execute(
         cur,
-        """
+        f"""
         CREATE TABLE IF NOT EXISTS users(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id {_pk()},
             username TEXT UNIQUE,
             password TEXT,
             role TEXT DEFAULT 'user',
@@ -231,35 +599,35 @@ def init_db():
     )
     execute(
         cur,
-        """
+        f"""
         CREATE TABLE IF NOT EXISTS records(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id {_pk()},
             so TEXT DEFAULT 'TRU',
             chuc_vu TEXT,
             name TEXT,
-            giao_thong INTEGER,
-            xa_1_4 INTEGER,
-            xa_5_6 INTEGER,
-            giam_sat INTEGER,
+            giao_thong INTEGER DEFAULT 0,
+            xa_1_4 INTEGER DEFAULT 0,
+            xa_5_6 INTEGER DEFAULT 0,
+            giam_sat INTEGER DEFAULT 0,
             giam_sat_1_5 INTEGER DEFAULT 0,
             giam_sat_6 INTEGER DEFAULT 0,
-            an_sai INTEGER,
-            tong_an INTEGER,
-            diem INTEGER,
+            an_sai INTEGER DEFAULT 0,
+            tong_an INTEGER DEFAULT 0,
+            diem INTEGER DEFAULT 0,
             -- Tiền xử án
             tien_khoan_1_2 INTEGER DEFAULT 0,
             tien_khoan_3_5 INTEGER DEFAULT 0,
             tien_khoan_6_truy_na INTEGER DEFAULT 0,
             tong_tien INTEGER DEFAULT 0,
-            created_at TEXT DEFAULT (datetime('now'))
+            created_at {created_at}
         )
         """,
     )
     execute(
         cur,
-        """
+        f"""
         CREATE TABLE IF NOT EXISTS logs(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id {_pk()},
             action TEXT,
             record_id INTEGER,
             user_name TEXT,
@@ -270,9 +638,9 @@ def init_db():
     )
     execute(
         cur,
-        """
+        f"""
         CREATE TABLE IF NOT EXISTS login_logs(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id {_pk()},
             username TEXT,
             ip TEXT,
             user_agent TEXT,
@@ -290,25 +658,46 @@ def init_db():
         )
         """,
     )
+    # Bộ đếm version cho cache trong process (xem cache.py)
     execute(
         cur,
-        "INSERT OR IGNORE INTO settings(key,value) VALUES(?,?)",
-        ("monthly_title", "THỐNG KÊ ĐIỂM THÁNG"),
-    )
-    execute(
-        cur,
-        "INSERT OR IGNORE INTO settings(key,value) VALUES(?,?)",
-        ("monthly_title_TRU", "THỐNG KÊ ĐIỂM THÁNG"),
+        """
+        CREATE TABLE IF NOT EXISTS cache_versions(
+            name TEXT PRIMARY KEY,
+            version INTEGER DEFAULT 0
+        )
+        """,
     )
+    # Bộ quy tắc tính điểm theo version (xem tinhdiem.py)
     execute(
         cur,
-        "INSERT OR IGNORE INTO settings(key,value) VALUES(?,?)",
-        ("monthly_title_LS", "THỐNG KÊ ĐIỂM THÁNG"),
+        f"""
+        CREATE TABLE IF NOT EXISTS scoring_rules(
+            id {_pk()},
+            so TEXT,
+            version INTEGER,
+            rules TEXT,
+            created_by TEXT,
+            created_at TEXT,
+            UNIQUE(so, version)
+        )
+        """,
     )
+    # DB cũ: bổ sung các cột thêm sau này
+    for column in ("an_sai", "tong_an", "diem", "giam_sat_1_5", "giam_sat_6"):
+        add_column_if_missing(cur, "records", column, "INTEGER DEFAULT 0")
+    # Các cột phục vụ tab Tiền xử án
+    for column in ("tien_khoan_1_2", "tien_khoan_3_5", "tien_khoan_6_truy_na", "tong_tien"):
+        add_column_if_missing(cur, "records", column, "INTEGER DEFAULT 0")
+    add_column_if_missing(cur, "login_logs", "location", "TEXT")
+
+    for key in ("monthly_title", "monthly_title_TRU", "monthly_title_LS", "monthly_title_PS"):
+        execute(cur, insert_ignore("settings", "key,value", "key"), (key, "THỐNG KÊ ĐIỂM THÁNG"))
     # Tài khoản admin mặc định dùng mật khẩu admin123
     execute(
         cur,
-        "INSERT OR IGNORE INTO users(username,password,role,so_allowed) VALUES('admin','admin123','admin','ALL')",
+        insert_ignore("users", "username,password,role,so_allowed", "username"),
+        ("admin", "admin123", "admin", "ALL"),
     )
     # Nếu DB cũ còn để mật khẩu admin thì tự động nâng lên admin123
     execute(
@@ -316,54 +705,852 @@ def init_db():
         "UPDATE users SET password='admin123', role='admin', so_allowed='ALL' WHERE username='admin' AND password='admin'",
     )
     execute(cur, "UPDATE users SET role='admin', so_allowed='ALL' WHERE username='admin'")
-    # Khởi tạo thêm cấu hình cho Sở PS (nếu dùng)
+
+
+def _m002_indexes(cur):
+    """Index cho các query nóng (bảng dashboard, top, thống kê, xoá logs theo record)."""
     execute(
         cur,
-        "INSERT OR IGNORE INTO settings(key,value) VALUES(?,?)",
-        ("monthly_title_PS", "THỐNG KÊ ĐIỂM THÁNG"),
+        f"CREATE INDEX IF NOT EXISTS idx_records_so_rank_diem ON records(so, ({CHUC_VU_RANK_SQL}), diem DESC)",
     )
+    execute(cur, "CREATE INDEX IF NOT EXISTS idx_records_so_name ON records(so, name)")
+    execute(cur, "CREATE INDEX IF NOT EXISTS idx_records_so_created_at ON records(so, created_at)")
+    execute(cur, "CREATE INDEX IF NOT EXISTS idx_logs_record_id ON logs(record_id)")
+
+
+def _m003_records_monthly(cur):
+    """
+    Bảng tổng hợp theo (sở, năm, tháng) cho tab Thống kê, cập nhật bằng trigger
+    nên mọi đường ghi records (thêm, sửa, xoá, reset, tính lại điểm) đều tự đồng bộ.
+    """
+    execute(
+        cur,
+        """
+        CREATE TABLE IF NOT EXISTS records_monthly(
+            so TEXT NOT NULL,
+            nam INTEGER NOT NULL,
+            thang INTEGER NOT NULL,
+            tong_an INTEGER DEFAULT 0,
+            tong_diem INTEGER DEFAULT 0,
+            tong_tien INTEGER DEFAULT 0,
+            so_luong INTEGER DEFAULT 0,
+            PRIMARY KEY(so, nam, thang)
+        )
+        """,
+    )
+    if DATABASE_URL:
+        execute(
+            cur,
+            """
+            CREATE OR REPLACE FUNCTION records_monthly_apply() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                    INSERT INTO records_monthly(so, nam, thang, tong_an, tong_diem, tong_tien, so_luong)
+                    VALUES(
+                        COALESCE(OLD.so, 'TRU'),
+                        COALESCE(EXTRACT(YEAR FROM OLD.created_at)::int, 0),
+                        COALESCE(EXTRACT(MONTH FROM OLD.created_at)::int, 0),
+                        -COALESCE(OLD.tong_an, 0), -COALESCE(OLD.diem, 0), -COALESCE(OLD.tong_tien, 0), -1
+                    )
+                    ON CONFLICT(so, nam, thang) DO UPDATE SET
+                        tong_an = records_monthly.tong_an + EXCLUDED.tong_an,
+                        tong_diem = records_monthly.tong_diem + EXCLUDED.tong_diem,
+                        tong_tien = records_monthly.tong_tien + EXCLUDED.tong_tien,
+                        so_luong = records_monthly.so_luong + EXCLUDED.so_luong;
+                END IF;
+                IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                    INSERT INTO records_monthly(so, nam, thang, tong_an, tong_diem, tong_tien, so_luong)
+                    VALUES(
+                        COALESCE(NEW.so, 'TRU'),
+                        COALESCE(EXTRACT(YEAR FROM NEW.created_at)::int, 0),
+                        COALESCE(EXTRACT(MONTH FROM NEW.created_at)::int, 0),
+                        COALESCE(NEW.tong_an, 0), COALESCE(NEW.diem, 0), COALESCE(NEW.tong_tien, 0), 1
+                    )
+                    ON CONFLICT(so, nam, thang) DO UPDATE SET
+                        tong_an = records_monthly.tong_an + EXCLUDED.tong_an,
+                        tong_diem = records_monthly.tong_diem + EXCLUDED.tong_diem,
+                        tong_tien = records_monthly.tong_tien + EXCLUDED.tong_tien,
+                        so_luong = records_monthly.so_luong + EXCLUDED.so_luong;
+                END IF;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+            """,
+        )
+        execute(cur, "DROP TRIGGER IF EXISTS trg_records_monthly ON records")
+        execute(
+            cur,
+            """
+            CREATE TRIGGER trg_records_monthly
+            AFTER INSERT OR DELETE OR UPDATE OF so, created_at, tong_an, diem, tong_tien ON records
+            FOR EACH ROW EXECUTE FUNCTION records_monthly_apply()
+            """,
+        )
+    else:
+        add_row = """
+            INSERT INTO records_monthly(so, nam, thang, tong_an, tong_diem, tong_tien, so_luong)
+            VALUES(
+                COALESCE({r}.so, 'TRU'),
+                COALESCE(CAST(strftime('%Y', {r}.created_at) AS INTEGER), 0),
+                COALESCE(CAST(strftime('%m', {r}.created_at) AS INTEGER), 0),
+                {sign}COALESCE({r}.tong_an, 0), {sign}COALESCE({r}.diem, 0), {sign}COALESCE({r}.tong_tien, 0), {sign}1
+            )
+            ON CONFLICT(so, nam, thang) DO UPDATE SET
+                tong_an = tong_an + excluded.tong_an,
+                tong_diem = tong_diem + excluded.tong_diem,
+                tong_tien = tong_tien + excluded.tong_tien,
+                so_luong = so_luong + excluded.so_luong;
+        """
+        add_new = add_row.format(r="NEW", sign="")
+        sub_old = add_row.format(r="OLD", sign="-")
+        execute(
+            cur,
+            f"CREATE TRIGGER IF NOT EXISTS trg_records_monthly_ins AFTER INSERT ON records BEGIN {add_new} END",
+        )
+        execute(
+            cur,
+            f"CREATE TRIGGER IF NOT EXISTS trg_records_monthly_del AFTER DELETE ON records BEGIN {sub_old} END",
+        )
+        execute(
+            cur,
+            "CREATE TRIGGER IF NOT EXISTS trg_records_monthly_upd "
+            "AFTER UPDATE OF so, created_at, tong_an, diem, tong_tien ON records "
+            f"BEGIN {sub_old} {add_new} END",
+        )
+    # Đổ dữ liệu cũ vào bảng tổng hợp (SQL viết sẵn ở đây: migration không gọi hàm của module đang chạy)
+    if DATABASE_URL:
+        nam_sql = "COALESCE(EXTRACT(YEAR FROM created_at)::int, 0)"
+        thang_sql = "COALESCE(EXTRACT(MONTH FROM created_at)::int, 0)"
+    else:
+        nam_sql = "COALESCE(CAST(strftime('%Y', created_at) AS INTEGER), 0)"
+        thang_sql = "COALESCE(CAST(strftime('%m', created_at) AS INTEGER), 0)"
+    execute(cur, "DELETE FROM records_monthly")
+    execute(
+        cur,
+        f"""
+        INSERT INTO records_monthly(so, nam, thang, tong_an, tong_diem, tong_tien, so_luong)
+        SELECT
+            COALESCE(so, 'TRU'),
+            {nam_sql},
+            {thang_sql},
+            COALESCE(SUM(tong_an), 0),
+            COALESCE(SUM(diem), 0),
+            COALESCE(SUM(tong_tien), 0),
+            COUNT(1)
+        FROM records
+        GROUP BY 1, 2, 3
+        """,
+    )
+
+
+def _m004_records_leaderboard(cur):
+    """
+    Tổng điểm theo (sở, tên, chức vụ) cho bảng xếp hạng, cập nhật bằng trigger.
+    Trigger chỉ chạy khi so/name/chuc_vu/diem thay đổi, và bump version
+    'leaderboard:<sở>' trong cache_versions để các worker bỏ cache top.
+
+    Bump mọi lần đổi điểm chứ không chỉ khi chạm ngưỡng top-N: top được lọc theo tập
+    chức vụ tuỳ ý và cộng dồn qua các sở (ALL), nên không có 1 ngưỡng chung đúng cho mọi
+    cách xem. Giá của việc bỏ cache chỉ là 1 lần đọc lại bảng tổng hợp nhỏ này
+    (1 dòng / người, không quét records) khi có người mở top.
+    """
+    execute(
+        cur,
+        """
+        CREATE TABLE IF NOT EXISTS records_leaderboard(
+            so TEXT NOT NULL,
+            name TEXT NOT NULL,
+            chuc_vu TEXT NOT NULL,
+            tong_diem INTEGER DEFAULT 0,
+            so_luong INTEGER DEFAULT 0,
+            PRIMARY KEY(so, name, chuc_vu)
+        )
+        """,
+    )
+    if DATABASE_URL:
+        execute(
+            cur,
+            """
+            CREATE OR REPLACE FUNCTION records_leaderboard_apply() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'UPDATE'
+                    AND OLD.so IS NOT DISTINCT FROM NEW.so
+                    AND OLD.name IS NOT DISTINCT FROM NEW.name
+                    AND OLD.chuc_vu IS NOT DISTINCT FROM NEW.chuc_vu
+                    AND OLD.diem IS NOT DISTINCT FROM NEW.diem THEN
+                    RETURN NULL;
+                END IF;
+                IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                    INSERT INTO records_leaderboard(so, name, chuc_vu, tong_diem, so_luong)
+                    VALUES(COALESCE(OLD.so, 'TRU'), COALESCE(OLD.name, ''), COALESCE(OLD.chuc_vu, ''),
+                           -COALESCE(OLD.diem, 0), -1)
+                    ON CONFLICT(so, name, chuc_vu) DO UPDATE SET
+                        tong_diem = records_leaderboard.tong_diem + EXCLUDED.tong_diem,
+                        so_luong = records_leaderboard.so_luong + EXCLUDED.so_luong;
+                    DELETE FROM records_leaderboard
+                    WHERE so = COALESCE(OLD.so, 'TRU') AND name = COALESCE(OLD.name, '')
+                      AND chuc_vu = COALESCE(OLD.chuc_vu, '') AND so_luong <= 0;
+                    INSERT INTO cache_versions(name, version) VALUES('leaderboard:' || COALESCE(OLD.so, 'TRU'), 1)
+                    ON CONFLICT(name) DO UPDATE SET version = cache_versions.version + 1;
+                END IF;
+                IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                    INSERT INTO records_leaderboard(so, name, chuc_vu, tong_diem, so_luong)
+                    VALUES(COALESCE(NEW.so, 'TRU'), COALESCE(NEW.name, ''), COALESCE(NEW.chuc_vu, ''),
+                           COALESCE(NEW.diem, 0), 1)
+                    ON CONFLICT(so, name, chuc_vu) DO UPDATE SET
+                        tong_diem = records_leaderboard.tong_diem + EXCLUDED.tong_diem,
+                        so_luong = records_leaderboard.so_luong + EXCLUDED.so_luong;
+                    IF TG_OP = 'INSERT' OR OLD.so IS DISTINCT FROM NEW.so THEN
+                        INSERT INTO cache_versions(name, version) VALUES('leaderboard:' || COALESCE(NEW.so, 'TRU'), 1)
+                        ON CONFLICT(name) DO UPDATE SET version = cache_versions.version + 1;
+                    END IF;
+                END IF;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+            """,
+        )
+        execute(cur, "DROP TRIGGER IF EXISTS trg_records_leaderboard ON records")
+        execute(
+            cur,
+            """
+            CREATE TRIGGER trg_records_leaderboard
+            AFTER INSERT OR DELETE OR UPDATE OF so, name, chuc_vu, diem ON records
+            FOR EACH ROW EXECUTE FUNCTION records_leaderboard_apply()
+            """,
+        )
+    else:
+        add_row = """
+            INSERT INTO records_leaderboard(so, name, chuc_vu, tong_diem, so_luong)
+            VALUES(COALESCE({r}.so, 'TRU'), COALESCE({r}.name, ''), COALESCE({r}.chuc_vu, ''),
+                   {sign}COALESCE({r}.diem, 0), {sign}1)
+            ON CONFLICT(so, name, chuc_vu) DO UPDATE SET
+                tong_diem = tong_diem + excluded.tong_diem,
+                so_luong = so_luong + excluded.so_luong;
+        """
+        cleanup_old = """
+            DELETE FROM records_leaderboard
+            WHERE so = COALESCE(OLD.so, 'TRU') AND name = COALESCE(OLD.name, '')
+              AND chuc_vu = COALESCE(OLD.chuc_vu, '') AND so_luong <= 0;
+        """
+        bump = """
+            INSERT INTO cache_versions(name, version) VALUES('leaderboard:' || COALESCE({r}.so, 'TRU'), 1)
+            ON CONFLICT(name) DO UPDATE SET version = version + 1;
+        """
+        add_new = add_row.format(r="NEW", sign="") + bump.format(r="NEW")
+        sub_old = add_row.format(r="OLD", sign="-") + cleanup_old + bump.format(r="OLD")
+        execute(
+            cur,
+            f"CREATE TRIGGER IF NOT EXISTS trg_records_leaderboard_ins AFTER INSERT ON records BEGIN {add_new} END",
+        )
+        execute(
+            cur,
+            f"CREATE TRIGGER IF NOT EXISTS trg_records_leaderboard_del AFTER DELETE ON records BEGIN {sub_old} END",
+        )
+        execute(
+            cur,
+            "CREATE TRIGGER IF NOT EXISTS trg_records_leaderboard_upd "
+            "AFTER UPDATE OF so, name, chuc_vu, diem ON records "
+            "WHEN OLD.so IS NOT NEW.so OR OLD.name IS NOT NEW.name "
+            "OR OLD.chuc_vu IS NOT NEW.chuc_vu OR OLD.diem IS NOT NEW.diem "
+            f"BEGIN {sub_old} {add_new} END",
+        )
+    execute(cur, "DELETE FROM records_leaderboard")
+    execute(
+        cur,
+        """
+        INSERT INTO records_leaderboard(so, name, chuc_vu, tong_diem, so_luong)
+        SELECT
+            COALESCE(so, 'TRU'),
+            COALESCE(name, ''),
+            COALESCE(chuc_vu, ''),
+            COALESCE(SUM(diem), 0),
+            COUNT(1)
+        FROM records
+        GROUP BY 1, 2, 3
+        """,
+    )
+
+
+# "dd-mm-YYYY HH:MM:SS" (cột time cũ) -> "YYYY-MM-DD HH:MM:SS" (sắp xếp / so sánh được)
+_LOG_TIME_TO_ISO_SQL = "substr(time, 7, 4) || '-' || substr(time, 4, 2) || '-' || substr(time, 1, 2) || substr(time, 11)"
+_LOG_TIME_TO_TIMESTAMP_SQL = "to_timestamp(time, 'DD-MM-YYYY HH24:MI:SS')::timestamp"
+
+
+def _m005_logs_paging(cur):
+    """
+    Cột created_at cho logs / login_logs (Postgres: TIMESTAMP như records.created_at; SQLite: chuỗi ISO,
+    so sánh được) + index cho phân trang theo id và các bộ lọc action / user_name / username / khoảng thời gian.
+    Dòng cũ được điền created_at từ cột time SAU migration, theo lô (xem _b005_created_at).
+    """
+    created_at = "TIMESTAMP" if DATABASE_URL else "TEXT"
+    for table in ("logs", "login_logs"):
+        add_column_if_missing(cur, table, "created_at", created_at)
+    execute(cur, "CREATE INDEX IF NOT EXISTS idx_logs_action_id ON logs(action, id)")
+    execute(cur, "CREATE INDEX IF NOT EXISTS idx_logs_user_name_id ON logs(user_name, id)")
+    execute(cur, "CREATE INDEX IF NOT EXISTS idx_logs_created_at ON logs(created_at)")
+    execute(cur, "CREATE INDEX IF NOT EXISTS idx_login_logs_username_id ON login_logs(username, id)")
+    execute(cur, "CREATE INDEX IF NOT EXISTS idx_login_logs_created_at ON login_logs(created_at)")
+
+
+def _m006_records_changes(cur):
+    """
+    Version thay đổi theo sở cho đồng bộ delta (xem dongbo.py):
+    - cache_versions 'records:<sở>' tăng 1 cho mỗi dòng records được thêm / sửa / xoá
+    - records.change_version = version tại lần ghi cuối của dòng đó
+    - records_deleted: dòng đã xoá (hoặc chuyển sang sở khác) kèm version lúc xoá
+    Khoá dòng cache_versions giữ tới khi commit nên thứ tự version = thứ tự commit.
+    """
+    add_column_if_missing(cur, "records", "change_version", "INTEGER DEFAULT 0")
+    execute(
+        cur,
+        f"""
+        CREATE TABLE IF NOT EXISTS records_deleted(
+            id {_pk()},
+            so TEXT NOT NULL,
+            record_id INTEGER NOT NULL,
+            change_version INTEGER NOT NULL
+        )
+        """,
+    )
+    execute(cur, "CREATE INDEX IF NOT EXISTS idx_records_so_change_version ON records(so, change_version)")
+    execute(
+        cur,
+        "CREATE INDEX IF NOT EXISTS idx_records_deleted_so_version ON records_deleted(so, change_version)",
+    )
+    if DATABASE_URL:
+        execute(
+            cur,
+            """
+            CREATE OR REPLACE FUNCTION records_change_version() RETURNS trigger AS $$
+            DECLARE
+                v INTEGER;
+            BEGIN
+                IF TG_OP = 'DELETE' OR (TG_OP = 'UPDATE' AND OLD.so IS DISTINCT FROM NEW.so) THEN
+                    INSERT INTO cache_versions(name, version) VALUES('records:' || COALESCE(OLD.so, 'TRU'), 1)
+                    ON CONFLICT(name) DO UPDATE SET version = cache_versions.version + 1
+                    RETURNING version INTO v;
+                    INSERT INTO records_deleted(so, record_id, change_version)
+                    VALUES(COALESCE(OLD.so, 'TRU'), OLD.id, v);
+                END IF;
+                IF TG_OP = 'DELETE' THEN
+                    RETURN OLD;
+                END IF;
+                INSERT INTO cache_versions(name, version) VALUES('records:' || COALESCE(NEW.so, 'TRU'), 1)
+                ON CONFLICT(name) DO UPDATE SET version = cache_versions.version + 1
+                RETURNING version INTO v;
+                NEW.change_version := v;
+                RETURN NEW;
+            END
+            $$ LANGUAGE plpgsql
+            """,
+        )
+        execute(cur, "DROP TRIGGER IF EXISTS trg_records_change_version ON records")
+        execute(
+            cur,
+            """
+            CREATE TRIGGER trg_records_change_version
+            BEFORE INSERT OR UPDATE OR DELETE ON records
+            FOR EACH ROW EXECUTE FUNCTION records_change_version()
+            """,
+        )
+    else:
+        bump = """
+            INSERT INTO cache_versions(name, version) VALUES('records:' || COALESCE({r}.so, 'TRU'), 1)
+            ON CONFLICT(name) DO UPDATE SET version = version + 1;
+        """
+        current = "(SELECT version FROM cache_versions WHERE name = 'records:' || COALESCE({r}.so, 'TRU'))"
+        stamp_new = bump.format(r="NEW") + (
+            f"UPDATE records SET change_version = {current.format(r='NEW')} WHERE id = NEW.id;"
+        )
+        tombstone_old = bump.format(r="OLD") + (
+            "INSERT INTO records_deleted(so, record_id, change_version) "
+            f"VALUES(COALESCE(OLD.so, 'TRU'), OLD.id, {current.format(r='OLD')});"
+        )
+        execute(
+            cur,
+            f"CREATE TRIGGER IF NOT EXISTS trg_records_version_ins AFTER INSERT ON records BEGIN {stamp_new} END",
+        )
+        # Chỉ chạy khi change_version chưa đổi -> câu UPDATE đóng dấu bên trong không kích hoạt lại
+        execute(
+            cur,
+            "CREATE TRIGGER IF NOT EXISTS trg_records_version_upd AFTER UPDATE ON records "
+            f"WHEN OLD.change_version IS NEW.change_version BEGIN {stamp_new} END",
+        )
+        execute(
+            cur,
+            "CREATE TRIGGER IF NOT EXISTS trg_records_version_move AFTER UPDATE OF so ON records "
+            f"WHEN OLD.so IS NOT NEW.so BEGIN {tombstone_old} END",
+        )
+        execute(
+            cur,
+            f"CREATE TRIGGER IF NOT EXISTS trg_records_version_del AFTER DELETE ON records BEGIN {tombstone_old} END",
+        )
+
+
+def _m007_records_notify(cur):
+    """
+    Postgres: NOTIFY records_changes sau mỗi câu lệnh ghi records (gửi khi commit)
+    để hub SSE (tructiep.py) thức dậy ngay. SQLite: hub tự đọc cache_versions, không cần gì thêm.
+    """
+    if not DATABASE_URL:
+        return
+    execute(
+        cur,
+        """
+        CREATE OR REPLACE FUNCTION records_notify() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('records_changes', '');
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+    )
+    execute(cur, "DROP TRIGGER IF EXISTS trg_records_notify ON records")
+    execute(
+        cur,
+        """
+        CREATE TRIGGER trg_records_notify
+        AFTER INSERT OR UPDATE OR DELETE ON records
+        FOR EACH STATEMENT EXECUTE FUNCTION records_notify()
+        """,
+    )
+
+
+def _m008_logs_structured(cur):
+    """
+    Cột có cấu trúc cho nhật ký: so, field, old_value, new_value (trước đây chỉ nằm trong
+    chuỗi details) + index cho truy vấn theo record / sở trong khoảng thời gian.
+    Log cũ được tách lại từ details SAU migration, theo lô (xem _b008_logs_structured).
+    """
+    for column in ("so", "field", "old_value", "new_value"):
+        add_column_if_missing(cur, "logs", column, "TEXT")
+    execute(cur, "CREATE INDEX IF NOT EXISTS idx_logs_record_id_created_at ON logs(record_id, created_at)")
+    execute(cur, "CREATE INDEX IF NOT EXISTS idx_logs_so_created_at ON logs(so, created_at)")
+    # (record_id, created_at) đã bao index cũ chỉ theo record_id
+    execute(cur, "DROP INDEX IF EXISTS idx_logs_record_id")
+
+
+def _m009_records_snapshots(cur):
+    """
+    Chốt tháng (xem chotthang.py):
+    - records_snapshots: bản chụp chỉ-ghi-thêm, 1 dòng / cán bộ / tháng đã chốt (chỉ cột số liệu)
+    - records_closes: tổng hợp của tháng đã chốt (tính lúc chốt), khoá (so, nam, thang)
+    Bảng xếp hạng / biểu đồ tháng cũ chỉ đọc 2 bảng này, không đụng records.
+    """
+    execute(
+        cur,
+        f"""
+        CREATE TABLE IF NOT EXISTS records_snapshots(
+            id {_pk()},
+            so TEXT NOT NULL,
+            nam INTEGER NOT NULL,
+            thang INTEGER NOT NULL,
+            record_id INTEGER NOT NULL,
+            name TEXT,
+            chuc_vu TEXT,
+            giao_thong INTEGER DEFAULT 0,
+            xa_1_4 INTEGER DEFAULT 0,
+            xa_5_6 INTEGER DEFAULT 0,
+            giam_sat_1_5 INTEGER DEFAULT 0,
+            giam_sat_6 INTEGER DEFAULT 0,
+            an_sai INTEGER DEFAULT 0,
+            tong_an INTEGER DEFAULT 0,
+            diem INTEGER DEFAULT 0,
+            tien_khoan_1_2 INTEGER DEFAULT 0,
+            tien_khoan_3_5 INTEGER DEFAULT 0,
+            tien_khoan_6_truy_na INTEGER DEFAULT 0,
+            tong_tien INTEGER DEFAULT 0
+        )
+        """,
+    )
+    execute(
+        cur,
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_records_snapshots_month "
+        "ON records_snapshots(so, nam, thang, record_id)",
+    )
+    execute(
+        cur,
+        """
+        CREATE TABLE IF NOT EXISTS records_closes(
+            so TEXT NOT NULL,
+            nam INTEGER NOT NULL,
+            thang INTEGER NOT NULL,
+            so_luong INTEGER DEFAULT 0,
+            tong_an INTEGER DEFAULT 0,
+            tong_diem INTEGER DEFAULT 0,
+            tong_tien INTEGER DEFAULT 0,
+            closed_by TEXT,
+            closed_at TEXT,
+            PRIMARY KEY(so, nam, thang)
+        )
+        """,
+    )
+
+
+def _m010_records_monthly_frozen(cur):
+    """
+    records_monthly_frozen: bản sao records_monthly của 1 sở lúc chốt tháng lần đầu.
+    Chốt tháng đưa records về 0 nên trigger trừ ngược vào records_monthly của các tháng trước;
+    tháng trước lần chốt đầu được đọc từ bản sao này để không bị đổi sau khi chốt.
+    Sở đã chốt trước migration này không có bản sao -> vẫn đọc records_monthly như cũ.
+    """
+    execute(
+        cur,
+        """
+        CREATE TABLE IF NOT EXISTS records_monthly_frozen(
+            so TEXT NOT NULL,
+            nam INTEGER NOT NULL,
+            thang INTEGER NOT NULL,
+            tong_an INTEGER DEFAULT 0,
+            tong_diem INTEGER DEFAULT 0,
+            tong_tien INTEGER DEFAULT 0,
+            so_luong INTEGER DEFAULT 0,
+            PRIMARY KEY(so, nam, thang)
+        )
+        """,
+    )
+
+
+def _b005_created_at(table: str):
+    """Backfill created_at (từ cột time "dd-mm-YYYY HH:MM:SS") cho 1 lô dòng cũ của `table`."""
+    def fill(cur, last_id: int, chunk: int) -> Optional[int]:
+        execute(
+            cur,
+            f"SELECT id FROM {table} WHERE id > ? AND created_at IS NULL ORDER BY id LIMIT ?",
+            (last_id, chunk),
+        )
+        rows = cur.fetchall()
+        if not rows:
+            return None
+        end_id = int(rows[-1]["id"])
+        from_time = _LOG_TIME_TO_TIMESTAMP_SQL if DATABASE_URL else _LOG_TIME_TO_ISO_SQL
+        execute(
+            cur,
+            f"UPDATE {table} SET created_at = {from_time} "
+            "WHERE id > ? AND id <= ? AND created_at IS NULL AND length(time) >= 10 AND substr(time, 3, 1) = '-'",
+            (last_id, end_id),
+        )
+        return end_id
+
+    return fill
+
+
+# Cột có thể xuất hiện trong log "Chỉnh sửa <cột> = <giá trị>" kiểu cũ (cố định lúc viết migration 8:
+# backfill không import module của app, sửa app sau này không đổi cách tách log cũ)
+_B008_LOG_FIELDS = (
+    "chuc_vu", "name", "giao_thong", "xa_1_4", "xa_5_6", "giam_sat_1_5", "giam_sat_6", "an_sai",
+    "tien_khoan_1_2", "tien_khoan_3_5", "tien_khoan_6_truy_na",
+)
+_B008_RE_SUA = re.compile(r"^Chỉnh sửa (\w+) = (.*)$", re.S)
+_B008_RE_SUA_NHIEU = re.compile(r", (" + "|".join(_B008_LOG_FIELDS) + r") = ")
+_B008_RE_SO = re.compile(r"\bso=(\w+)")
+
+
+def _b008_tach_chi_tiet(action, details) -> dict:
+    """Tách field / old_value / new_value / so từ chuỗi details kiểu cũ (không khớp thì bỏ trống)."""
+    details = details or ""
+    out = {}
+    if action == "INLINE_EDIT":
+        m = _B008_RE_SUA.match(details)
+        # Log gộp nhiều cột ("Chỉnh sửa a = 1, b = 2") không tách được chắc chắn -> bỏ qua
+        if m and m.group(1) in _B008_LOG_FIELDS and not _B008_RE_SUA_NHIEU.search(m.group(2)):
+            out["field"] = m.group(1)
+            out["new_value"] = m.group(2)
+    elif action == "ADD" and details.startswith("Thêm record: "):
+        out["new_value"] = details[len("Thêm record: "):]
+    elif action == "DELETE" and details.startswith("Xóa record: "):
+        out["old_value"] = details[len("Xóa record: "):]
+    elif action in ("RESET_DATA", "RESET_SCORES", "RESET_ALL", "SCORING_RULES", "RESCORE"):
+        m = _B008_RE_SO.search(details)
+        if m:
+            out["so"] = m.group(1)
+    return out
+
+
+def _b008_so_cua_record(cur, record_ids: set) -> dict:
+    """Sở của các record (còn trong records, hoặc đã xoá nhưng còn dấu xoá)."""
+    if not record_ids:
+        return {}
+    ids = list(record_ids)
+    placeholders = ",".join("?" * len(ids))
+    execute(cur, f"SELECT record_id AS id, so FROM records_deleted WHERE record_id IN ({placeholders})", ids)
+    result = {int(r["id"]): r["so"] for r in cur.fetchall()}
+    execute(cur, f"SELECT id, COALESCE(so, 'TRU') AS so FROM records WHERE id IN ({placeholders})", ids)
+    result.update({int(r["id"]): r["so"] for r in cur.fetchall()})
+    return result
+
+
+def _b008_logs_structured(cur, last_id: int, chunk: int) -> Optional[int]:
+    """Điền so/field/old_value/new_value cho 1 lô log cũ sau id `last_id`. Trả id cuối của lô."""
+    execute(
+        cur,
+        """
+        SELECT id, action, record_id, details FROM logs
+        WHERE id > ? AND so IS NULL AND field IS NULL AND old_value IS NULL AND new_value IS NULL
+        ORDER BY id
+        LIMIT ?
+        """,
+        (last_id, chunk),
+    )
+    rows = cur.fetchall()
+    if not rows:
+        return None
+    so_map = _b008_so_cua_record(cur, {int(r["record_id"]) for r in rows if r["record_id"] is not None})
+    params = []
+    for r in rows:
+        parsed = _b008_tach_chi_tiet(r["action"], r["details"])
+        if r["record_id"] is not None and "so" not in parsed:
+            parsed["so"] = so_map.get(int(r["record_id"]))
+        if any(v is not None for v in parsed.values()):
+            params.append((
+                parsed.get("so"), parsed.get("field"), parsed.get("old_value"), parsed.get("new_value"), r["id"],
+            ))
+    if params:
+        cur.executemany(
+            adapt_sql("UPDATE logs SET so = ?, field = ?, old_value = ?, new_value = ? WHERE id = ?"), params
+        )
+    return int(rows[-1]["id"])
+
+
+# (version, tên, hàm). Chỉ THÊM migration mới vào cuối, không sửa migration đã phát hành.
+MIGRATIONS = [
+    (1, "baseline", _m001_baseline),
+    (2, "indexes", _m002_indexes),
+    (3, "records_monthly", _m003_records_monthly),
+    (4, "records_leaderboard", _m004_records_leaderboard),
+    (5, "logs_paging", _m005_logs_paging),
+    (6, "records_changes", _m006_records_changes),
+    (7, "records_notify", _m007_records_notify),
+    (8, "logs_structured", _m008_logs_structured),
+    (9, "records_snapshots", _m009_records_snapshots),
+    (10, "records_monthly_frozen", _m010_records_monthly_frozen),
+]
+
+# Khoá advisory (Postgres) để nhiều worker khởi động cùng lúc không chạy migration chồng nhau
+_MIGRATION_LOCK_ID = 72700101
+
+
+def _current_schema_version(cur) -> int:
     try:
-        execute(cur, "ALTER TABLE records ADD COLUMN an_sai INTEGER DEFAULT 0")
-    except Exception:
-        pass
-    try:
-        execute(cur, "ALTER TABLE records ADD COLUMN tong_an INTEGER DEFAULT 0")
-    except Exception:
-        pass
-    try:
-        execute(cur, "ALTER TABLE records ADD COLUMN diem INTEGER DEFAULT 0")
-    except Exception:
-        pass
-    try:
-        execute(cur, "ALTER TABLE records ADD COLUMN giam_sat_1_5 INTEGER DEFAULT 0")
-    except Exception:
-        pass
-    try:
-        execute(cur, "ALTER TABLE records ADD COLUMN giam_sat_6 INTEGER DEFAULT 0")
-    except Exception:
-        pass
-    # Các cột phục vụ tab Tiền xử án
-    try:
-        execute(cur, "ALTER TABLE records ADD COLUMN tien_khoan_1_2 INTEGER DEFAULT 0")
+        execute(cur, "SELECT MAX(version) AS v FROM schema_version")
+        row = cur.fetchone()
+        return int((row["v"] if row else 0) or 0)
     except Exception:
-        pass
+        return 0
+
+
+def _migrate(conn):
+    """Chạy các migration còn thiếu trên 1 file DB / 1 database Postgres."""
+    latest = MIGRATIONS[-1][0]
+    cur = conn.cursor()
     try:
-        execute(cur, "ALTER TABLE records ADD COLUMN tien_khoan_3_5 INTEGER DEFAULT 0")
+        if _current_schema_version(cur) >= latest:
+            return
+        conn.rollback()
+
+        if DATABASE_URL:
+            execute(cur, "SELECT pg_advisory_xact_lock(?)", (_MIGRATION_LOCK_ID,))
+        else:
+            execute(cur, "PRAGMA journal_mode=WAL;")
+            execute(cur, "PRAGMA synchronous=NORMAL;")
+            # Giữ khoá ghi suốt quá trình migrate
+            execute(cur, "BEGIN IMMEDIATE")
+        execute(
+            cur,
+            """
+            CREATE TABLE IF NOT EXISTS schema_version(
+                version INTEGER PRIMARY KEY,
+                name TEXT,
+                applied_at TEXT
+            )
+            """,
+        )
+        # Đọc lại sau khi có khoá: worker khác có thể vừa migrate xong
+        current = _current_schema_version(cur)
+        for version, name, fn in MIGRATIONS:
+            if version <= current:
+                continue
+            fn(cur)
+            execute(
+                cur,
+                "INSERT INTO schema_version(version, name, applied_at) VALUES(?,?,?)",
+                (version, name, time.strftime("%Y-%m-%d %H:%M:%S")),
+            )
+        conn.commit()
     except Exception:
-        pass
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+# ================= BACKFILL SAU MIGRATION =================
+# Migration chạy trong 1 transaction giữ khoá ghi suốt lúc khởi động -> không cập nhật cả bảng log
+# (không bao giờ dọn, lớn dần) ở đó. Điền dữ liệu cũ chạy SAU migration theo lô id (keyset),
+# mỗi lô 1 transaction ngắn; id đã xử lý lưu trong cache_versions('backfill:<tên>') cùng commit
+# với lô -> chết giữa chừng thì lần khởi động sau chạy tiếp, xong rồi thì chỉ tốn 1 query / file.
+LOG_BACKFILL_CHUNK = int(os.environ.get("LOG_BACKFILL_CHUNK", "500") or 500)
+_BACKFILL_DONE = -1
+
+# (tên, version migration tạo cột, hàm(cur, last_id, chunk) -> id cuối của lô hoặc None khi hết).
+# Chỉ THÊM vào cuối.
+BACKFILLS = [
+    ("logs_created_at", 5, _b005_created_at("logs")),
+    ("login_logs_created_at", 5, _b005_created_at("login_logs")),
+    ("logs_structured", 8, _b008_logs_structured),
+]
+
+
+def _run_backfills(key, chunk: Optional[int] = None):
+    """Chạy các backfill chưa xong trên 1 file DB (key như get_db) / database Postgres."""
+    chunk = chunk or LOG_BACKFILL_CHUNK
+    conn = get_db(key)
+    cur = conn.cursor()
     try:
-        execute(cur, "ALTER TABLE records ADD COLUMN tien_khoan_6_truy_na INTEGER DEFAULT 0")
+        current = _current_schema_version(cur)
+        names = [f"backfill:{name}" for name, _, _ in BACKFILLS]
+        execute(
+            cur,
+            f"SELECT name, version FROM cache_versions WHERE name IN ({','.join('?' * len(names))})",
+            names,
+        )
+        progress = {r["name"]: int(r["version"] or 0) for r in cur.fetchall()}
+        conn.rollback()
+        for (_, version, fn), marker in zip(BACKFILLS, names):
+            if version > current:
+                continue
+            last_id = progress.get(marker, 0)
+            while last_id != _BACKFILL_DONE:
+                if not DATABASE_URL:
+                    execute(cur, "BEGIN IMMEDIATE")
+                end_id = fn(cur, last_id, chunk)
+                last_id = _BACKFILL_DONE if end_id is None else end_id
+                execute(
+                    cur,
+                    "INSERT INTO cache_versions(name, version) VALUES(?, ?) "
+                    "ON CONFLICT(name) DO UPDATE SET version = excluded.version",
+                    (marker, last_id),
+                )
+                conn.commit()
     except Exception:
-        pass
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+# Bảng theo sở: chuyển từ catalog sang shard khi bật shard (cột so lọc theo sở)
+SHARD_TABLES = (
+    "records", "records_deleted", "records_snapshots", "records_closes", "records_monthly_frozen", "logs",
+)
+# records_monthly / records_leaderboard do trigger của shard tự dựng lại khi chép records
+_SHARD_MOVED_KEY = "shard_moved"
+
+
+def _columns(cur, table: str, skip: tuple = ()) -> str:
+    execute(cur, f"PRAGMA table_info({table})")
+    return ", ".join(r["name"] for r in cur.fetchall() if r["name"] not in skip)
+
+
+def _shard_where(table: str) -> str:
+    """
+    Điều kiện chọn dòng của 1 sở khi chuyển sang shard. records cũ không có so là của TRU;
+    log không có so (tài khoản, quản trị...) không thuộc sở nào -> ở lại catalog.
+    """
+    return "so = ?" if table == "logs" else "COALESCE(so, 'TRU') = ?"
+
+
+def _move_to_shard(so: str):
+    """
+    Chuyển dữ liệu cũ của sở `so` từ database.db sang shard (1 lần, an toàn khi chạy lại):
+    1. Trong 1 transaction của shard: chép các bảng theo sở (giữ id) + version đồng bộ,
+       đặt mốc id records riêng, ghi dấu 'shard_moved'.
+    2. Xoá bản cũ ở catalog (chết giữa chừng thì lần khởi động sau xoá tiếp).
+    """
+    conn = get_db(so)
+    cur = conn.cursor()
     try:
-        execute(cur, "ALTER TABLE records ADD COLUMN tong_tien INTEGER DEFAULT 0")
-    except Exception:
-        pass
-    # Đảm bảo bảng login_logs cũ có cột location
+        execute(cur, "SELECT 1 FROM cache_versions WHERE name = ?", (_SHARD_MOVED_KEY,))
+        moved = cur.fetchone() is not None
+        conn.rollback()
+        if not moved:
+            execute(cur, "ATTACH DATABASE ? AS catalog", (SQLITE_PATH,))
+            try:
+                execute(cur, "BEGIN IMMEDIATE")
+                # Đọc lại sau khi có khoá: worker khác có thể vừa chuyển xong
+                execute(cur, "SELECT 1 FROM cache_versions WHERE name = ?", (_SHARD_MOVED_KEY,))
+                if cur.fetchone() is None:
+                    # Version đồng bộ tiếp nối bản cũ: client đang giữ version cũ không bị lùi mốc
+                    keys = (f"records:{so}", f"leaderboard:{so}", f"closes:{so}", f"records_pruned:{so}")
+                    execute(
+                        cur,
+                        "INSERT INTO cache_versions(name, version) "
+                        "SELECT name, version FROM catalog.cache_versions WHERE name IN (?, ?, ?, ?) "
+                        "ON CONFLICT(name) DO UPDATE SET version = excluded.version",
+                        keys,
+                    )
+                    for table in SHARD_TABLES:
+                        columns = _columns(cur, table)
+                        execute(
+                            cur,
+                            f"INSERT INTO {table}({columns}) SELECT {columns} FROM catalog.{table} "
+                            f"WHERE {_shard_where(table)}",
+                            (so,),
+                        )
+                    execute(cur, "SELECT COALESCE(MAX(id), 0) AS m FROM catalog.records")
+                    start = max(int(cur.fetchone()["m"]), SHARD_SO.index(so) * SHARD_ID_SPAN)
+                    execute(cur, "DELETE FROM sqlite_sequence WHERE name = 'records'")
+                    execute(cur, "INSERT INTO sqlite_sequence(name, seq) VALUES('records', ?)", (start,))
+                    execute(cur, "INSERT INTO cache_versions(name, version) VALUES(?, 1)", (_SHARD_MOVED_KEY,))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                execute(cur, "DETACH DATABASE catalog")
+    finally:
+        conn.close()
+
+    conn = get_db()
+    cur = conn.cursor()
     try:
-        execute(cur, "ALTER TABLE login_logs ADD COLUMN location TEXT")
+        left = []
+        for table in SHARD_TABLES + ("records_monthly", "records_leaderboard"):
+            execute(cur, f"SELECT 1 FROM {table} WHERE {_shard_where(table)} LIMIT 1", (so,))
+            if cur.fetchone():
+                left.append(table)
+        conn.rollback()
+        if left:
+            execute(cur, "BEGIN IMMEDIATE")
+            for table in SHARD_TABLES:
+                execute(cur, f"DELETE FROM {table} WHERE {_shard_where(table)}", (so,))
+            # Dấu xoá / dòng tổng hợp do trigger của catalog sinh ra khi xoá records ở trên
+            for table in ("records_deleted", "records_monthly", "records_leaderboard"):
+                execute(cur, f"DELETE FROM {table} WHERE so = ?", (so,))
+            conn.commit()
     except Exception:
-        pass
-    conn.commit()
-    conn.close()
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
 
+
+def init_db():
+    """
+    Tạo / nâng cấp schema (SQLite và Postgres) bằng các migration có đánh số.
+    Mỗi migration chỉ chạy 1 lần, ghi lại trong bảng schema_version.
+    Worker khởi động khi schema đã mới nhất chỉ tốn 1 query / file.
+    SQLite shard: catalog và mọi shard có cùng schema; dữ liệu cũ theo sở được chuyển sang shard.
+    Sau migration: điền dữ liệu cũ theo lô (BACKFILLS), chạy tiếp được nếu bị dừng giữa chừng.
+    """
+    if SQLITE_SHARDING:
+        os.makedirs(SHARD_DIR, exist_ok=True)
+    _migrate(get_db())
+    _run_backfills(None)
+    if not SQLITE_SHARDING:
+        return
+    for so in SHARD_SO:
+        _migrate(get_db(so))
+        _move_to_shard(so)
+        _run_backfills(so)
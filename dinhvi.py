@@ -0,0 +1,234 @@
+# dinhvi.py
+"""
+Ghi log đăng nhập nền + tra vị trí (city, region, country) từ IP.
+
+Request đăng nhập chỉ bỏ 1 phần tử vào hàng đợi (ghi_log_dang_nhap) rồi trả về ngay;
+1 thread nền mỗi process tra vị trí rồi INSERT vào login_logs.
+
+Tra vị trí đi qua chuỗi resolver (GEOIP_RESOLVERS, mặc định "cidr,http"):
+- Cache LRU + TTL phía trước nên IP lặp lại không tra lần nào nữa; không tra được (rỗng / lỗi)
+  chỉ cache GEOIP_MISS_TTL giây để lần sau thử lại.
+- "cidr": bảng dải IP offline (file CSV GEOIP_CIDR_FILE: network,city,region,country), không cần mạng.
+- "http": ip-api.com, chỉ dùng khi các bước trước không có kết quả.
+IP nội bộ / không hợp lệ thì bỏ qua, không tra. Log còn trong hàng đợi được ghi nốt khi tắt process.
+"""
+import atexit
+import bisect
+import csv
+import datetime
+import ipaddress
+import os
+import queue
+import threading
+import time
+
+import hangdoighi
+from cache import DictBackend
+from nhatky import tang_phien_ban
+
+GEOIP_RESOLVERS = os.environ.get("GEOIP_RESOLVERS", "cidr,http")
+GEOIP_CIDR_FILE = os.environ.get("GEOIP_CIDR_FILE", os.path.join("database", "geoip_cidr.csv"))
+GEOIP_HTTP_TIMEOUT = float(os.environ.get("GEOIP_HTTP_TIMEOUT", "2") or 2)
+GEOIP_CACHE_TTL = float(os.environ.get("GEOIP_CACHE_TTL", "86400") or 86400)
+GEOIP_MISS_TTL = float(os.environ.get("GEOIP_MISS_TTL", "300") or 300)
+GEOIP_CACHE_MAX = int(os.environ.get("GEOIP_CACHE_MAX", "4096") or 4096)
+LOGIN_LOG_QUEUE_MAX = int(os.environ.get("LOGIN_LOG_QUEUE_MAX", "1000") or 1000)
+
+_geo_cache = DictBackend(GEOIP_CACHE_MAX)
+
+
+class CidrResolver:
+    """Tra trong bảng dải IP offline (CSV: network,city,region,country), nạp 1 lần rồi tìm nhị phân."""
+
+    def __init__(self, path: str = GEOIP_CIDR_FILE):
+        self.path = path
+        self._ranges = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        ranges = {4: [], 6: []}
+        if os.path.exists(self.path):
+            with open(self.path, newline="", encoding="utf-8") as f:
+                for row in csv.reader(f):
+                    if len(row) < 2 or row[0].startswith("#"):
+                        continue
+                    try:
+                        net = ipaddress.ip_network(row[0].strip(), strict=False)
+                    except ValueError:
+                        # Bỏ dòng tiêu đề / dòng hỏng
+                        continue
+                    location = ", ".join(p.strip() for p in row[1:] if p.strip())
+                    ranges[net.version].append(
+                        (int(net.network_address), int(net.broadcast_address), location)
+                    )
+        for items in ranges.values():
+            items.sort()
+        return {v: ([r[0] for r in items], items) for v, items in ranges.items()}
+
+    def lookup(self, ip) -> str | None:
+        if self._ranges is None:
+            with self._lock:
+                if self._ranges is None:
+                    self._ranges = self._load()
+        starts, items = self._ranges[ip.version]
+        i = bisect.bisect_right(starts, int(ip)) - 1
+        if i >= 0 and int(ip) <= items[i][1]:
+            return items[i][2]
+        return None
+
+
+class HttpResolver:
+    """ip-api.com (giới hạn lượt gọi, chậm) – chỉ dùng khi không có nguồn nào khác."""
+
+    def __init__(self, timeout: float = GEOIP_HTTP_TIMEOUT):
+        self.timeout = timeout
+
+    def lookup(self, ip) -> str | None:
+        import requests  # type: ignore[import]
+
+        resp = requests.get(
+            f"http://ip-api.com/json/{ip}?fields=status,message,country,regionName,city,query",
+            timeout=self.timeout,
+        )
+        if not resp.ok:
+            return None
+        data = resp.json() or {}
+        if data.get("status") != "success":
+            return None
+        parts = [data.get("city") or "", data.get("regionName") or "", data.get("country") or ""]
+        return ", ".join([p for p in parts if p]).strip()
+
+
+RESOLVER_TYPES = {"cidr": CidrResolver, "http": HttpResolver}
+
+
+def make_resolvers(names: str = GEOIP_RESOLVERS) -> list:
+    return [RESOLVER_TYPES[n.strip()]() for n in names.split(",") if n.strip() in RESOLVER_TYPES]
+
+
+_resolvers = make_resolvers()
+
+
+def tra_vi_tri(ip_text: str | None) -> str:
+    """
+    Vị trí của IP ("" nếu không rõ). Có kết quả thì cache GEOIP_CACHE_TTL giây,
+    rỗng / resolver lỗi (mạng, hết lượt gọi) chỉ cache GEOIP_MISS_TTL giây.
+    """
+    try:
+        ip = ipaddress.ip_address((ip_text or "").strip())
+    except ValueError:
+        return ""
+    if not ip.is_global:
+        return ""
+    key = str(ip)
+    cached = _geo_cache.get(key)
+    if cached is not None:
+        return cached
+    location = ""
+    for resolver in _resolvers:
+        try:
+            location = resolver.lookup(ip) or ""
+        except Exception:
+            location = ""
+        if location:
+            break
+    _geo_cache.set(key, location, GEOIP_CACHE_TTL if location else GEOIP_MISS_TTL)
+    return location
+
+
+_queue: queue.Queue = queue.Queue(maxsize=LOGIN_LOG_QUEUE_MAX)
+_lock = threading.Lock()
+_worker_pid = None
+
+
+def _ghi(item: tuple):
+    username, ip, user_agent, now = item
+    location = tra_vi_tri(ip)
+    row = (
+        username,
+        ip,
+        user_agent,
+        location,
+        now.strftime("%d-%m-%Y %H:%M:%S"),
+        now.strftime("%Y-%m-%d %H:%M:%S"),
+    )
+
+    def job(c):
+        c.execute(
+            "INSERT INTO login_logs(username, ip, user_agent, location, time, created_at) VALUES(?,?,?,?,?,?)", row
+        )
+        tang_phien_ban(c, "login_logs")
+
+    hangdoighi.ghi(job)
+
+
+def _worker_loop():
+    while True:
+        item = _queue.get()
+        try:
+            _ghi(item)
+        except Exception:
+            # Không để 1 log lỗi làm dừng thread ghi log
+            pass
+        finally:
+            _queue.task_done()
+
+
+def flush_log_dang_nhap(timeout: float = 5.0) -> bool:
+    """
+    Ghi ngay các log đăng nhập còn trong hàng đợi của process này (khi tắt process).
+    Trả False nếu quá `timeout` giây mà vẫn còn log chưa ghi.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            item = _queue.get_nowait()
+        except queue.Empty:
+            return True
+        try:
+            _ghi(item)
+        except Exception:
+            pass
+        finally:
+            _queue.task_done()
+    return _queue.empty()
+
+
+def _flush_khi_thoat():
+    if _worker_pid == os.getpid():
+        flush_log_dang_nhap()
+
+
+atexit.register(_flush_khi_thoat)
+
+
+def _ensure_worker():
+    """Khởi động thread ghi log (1 lần / process, kể cả sau khi gunicorn fork)."""
+    global _worker_pid
+    pid = os.getpid()
+    if _worker_pid == pid:
+        return
+    with _lock:
+        if _worker_pid == pid:
+            return
+        _worker_pid = pid
+    threading.Thread(target=_worker_loop, name="login-log", daemon=True).start()
+
+
+def ghi_log_dang_nhap(username: str, ip: str | None, user_agent: str | None) -> bool:
+    """
+    Đưa 1 log đăng nhập vào hàng đợi nền (không chờ tra vị trí / ghi DB).
+    Trả False nếu hàng đợi đầy (log bị bỏ, không chặn đăng nhập).
+    """
+    item = (
+        username or "",
+        (ip or "").strip(),
+        (user_agent or "")[:512],
+        datetime.datetime.now(),
+    )
+    _ensure_worker()
+    try:
+        _queue.put_nowait(item)
+    except queue.Full:
+        return False
+    return True
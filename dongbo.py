@@ -0,0 +1,95 @@
+# dongbo.py
+"""
+Đồng bộ delta bảng records theo sở.
+
+Trigger (migration 6) tăng cache_versions 'records:<sở>' cho mỗi dòng được ghi,
+đóng dấu records.change_version và ghi dòng đã xoá vào records_deleted.
+Client giữ version lần tải gần nhất rồi hỏi /api/records/changes?since=<version>
+để nhận đúng các dòng đã đổi / đã xoá thay vì tải lại cả sở.
+"""
+import os
+
+# Quá số dòng này thì bảo client tải lại cả bảng (rẻ hơn vá từng dòng)
+CHANGES_MAX = int(os.environ.get("RECORDS_CHANGES_MAX", "500") or 500)
+# Giữ dấu xoá cho TOMBSTONE_KEEP version gần nhất của mỗi sở
+TOMBSTONE_KEEP = int(os.environ.get("RECORDS_TOMBSTONE_KEEP", "20000") or 20000)
+
+# Cột trả về cho 1 dòng đã đổi (đủ cho mọi tab Main / Tiền / Điểm)
+CHANGE_COLUMNS = (
+    "id", "chuc_vu", "name", "giao_thong", "xa_1_4", "xa_5_6", "giam_sat_1_5", "giam_sat_6",
+    "an_sai", "tong_an", "diem", "tien_khoan_1_2", "tien_khoan_3_5", "tien_khoan_6_truy_na",
+    "tong_tien", "change_version",
+)
+
+
+def _get_version(c, name: str) -> int:
+    c.execute("SELECT version FROM cache_versions WHERE name = ?", (name,))
+    row = c.fetchone()
+    return int((row["version"] if row else 0) or 0)
+
+
+def phien_ban(c, so: str) -> int:
+    """Version thay đổi hiện tại của sở `so` (0 nếu chưa có ghi nào)."""
+    return _get_version(c, f"records:{so}")
+
+
+def lay_thay_doi(c, so: str, since: int) -> dict:
+    """
+    Các thay đổi của sở `so` sau version `since`:
+    {"version", "reset", "changed": [dòng], "deleted": [id]}.
+    reset=True nghĩa là client phải tải lại cả bảng (since quá cũ hoặc quá nhiều thay đổi).
+    Đọc version TRƯỚC rồi mới đọc dòng: có thể trả dư thay đổi mới hơn, không bao giờ thiếu.
+    """
+    version = phien_ban(c, so)
+    result = {"version": version, "reset": False, "changed": [], "deleted": []}
+    if since >= version:
+        return result
+    if since < _get_version(c, f"records_pruned:{so}"):
+        result["reset"] = True
+        return result
+
+    c.execute(
+        f"""
+        SELECT {", ".join(CHANGE_COLUMNS)} FROM records
+        WHERE so = ? AND change_version > ?
+        ORDER BY change_version
+        LIMIT ?
+        """,
+        (so, since, CHANGES_MAX + 1),
+    )
+    changed = c.fetchall()
+    if len(changed) > CHANGES_MAX:
+        result["reset"] = True
+        return result
+    c.execute(
+        """
+        SELECT DISTINCT record_id FROM records_deleted
+        WHERE so = ? AND change_version > ?
+        LIMIT ?
+        """,
+        (so, since, CHANGES_MAX + 1),
+    )
+    deleted = [int(r["record_id"]) for r in c.fetchall()]
+    if len(deleted) > CHANGES_MAX:
+        result["reset"] = True
+        return result
+
+    result["changed"] = [{k: r[k] for k in CHANGE_COLUMNS} for r in changed]
+    result["deleted"] = deleted
+    return result
+
+
+def don_dau_xoa(c, so: str):
+    """
+    Xoá dấu xoá cũ hơn TOMBSTONE_KEEP version và ghi lại mốc đã dọn
+    (client hỏi since < mốc sẽ nhận reset). Caller tự commit.
+    """
+    floor = phien_ban(c, so) - TOMBSTONE_KEEP
+    if floor <= 0:
+        return
+    c.execute("DELETE FROM records_deleted WHERE so = ? AND change_version <= ?", (so, floor))
+    c.execute(
+        "INSERT INTO cache_versions(name, version) VALUES(?, ?) "
+        "ON CONFLICT(name) DO UPDATE SET version = excluded.version",
+        (f"records_pruned:{so}", floor),
+    )
@@ -0,0 +1,142 @@
+# hangdoighi.py
+"""
+Hàng đợi ghi cho SQLite (1 thread ghi / file DB / process).
+
+SQLite chỉ cho 1 transaction ghi / file: trước đây mỗi thread tự mở transaction và giành khoá file
+(timeout 15 giây) -> nhiều người sửa cùng lúc thì có request chờ rất lâu / "database is locked".
+Giờ mọi chỗ ghi của app (sửa ô, thêm / xoá / nhập record, chốt tháng, reset, tài khoản, cài đặt, quy tắc
+điểm, nhật ký, log đăng nhập, lưu trữ nhật ký) gửi job vào hàng đợi:
+- Thread ghi của file đó lấy mọi job đang chờ (tối đa WRITE_BATCH_MAX), chạy trong 1 transaction
+  BEGIN IMMEDIATE, mỗi job 1 SAVEPOINT (job lỗi chỉ rollback phần của nó), rồi 1 commit cho cả lô.
+- Kết quả / exception của từng job trả qua Future sau khi commit xong (đọc lại là thấy ngay).
+Thread đọc vẫn dùng connection WAL riêng như cũ, không chờ hàng đợi.
+
+Postgres (khoá theo dòng) hoặc SQLITE_WRITE_QUEUE=0: ghi() chạy job ngay trong `with get_db(so)`.
+Ngoại lệ ghi thẳng: init_db() (migration, chạy trước khi phục vụ request) và lệnh CLI ở process riêng
+(`python thongke.py rebuild`) - hàng đợi chỉ tuần tự hoá trong 1 process.
+"""
+import os
+import queue
+import threading
+from concurrent.futures import Future
+
+from database import DATABASE_URL, db_key, get_db
+
+SQLITE_WRITE_QUEUE = not DATABASE_URL and os.environ.get("SQLITE_WRITE_QUEUE", "1") != "0"
+# Số job tối đa gộp vào 1 transaction
+WRITE_BATCH_MAX = max(1, int(os.environ.get("WRITE_BATCH_MAX", "64") or 64))
+# Thời gian chờ tối đa kết quả 1 job (giây)
+WRITE_QUEUE_TIMEOUT = float(os.environ.get("WRITE_QUEUE_TIMEOUT", "30") or 30)
+
+_queues: dict = {}
+_lock = threading.Lock()
+_pid = None
+# Thread ghi đang chạy job: {"key", "cursor"} -> job gọi lồng ghi() cùng file thì chạy luôn
+_local = threading.local()
+
+
+def _chay_lo(key, jobs: list):
+    """Chạy 1 lô job trong 1 transaction trên file DB `key`, rồi trả kết quả qua Future."""
+    results = []
+    conn = get_db(key)
+    try:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        _local.key, _local.cursor = key, c
+        for i, (job, future) in enumerate(jobs):
+            if not future.set_running_or_notify_cancel():
+                continue
+            c.execute(f"SAVEPOINT job_{i}")
+            try:
+                results.append((future, job(c), None))
+                c.execute(f"RELEASE job_{i}")
+            except Exception as e:
+                c.execute(f"ROLLBACK TO job_{i}")
+                c.execute(f"RELEASE job_{i}")
+                results.append((future, None, e))
+        conn.commit()
+    except Exception as e:
+        # BEGIN / SAVEPOINT / commit lỗi: cả lô coi như chưa ghi
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        for job, future in jobs:
+            if not future.done():
+                if future.running():
+                    future.set_exception(e)
+                elif future.set_running_or_notify_cancel():
+                    future.set_exception(e)
+        return
+    finally:
+        _local.key = _local.cursor = None
+        conn.close()
+    for future, value, error in results:
+        if error is None:
+            future.set_result(value)
+        else:
+            future.set_exception(error)
+
+
+def _writer_loop(key, q: queue.Queue):
+    while True:
+        jobs = [q.get()]
+        # Gộp các job đang chờ (không đợi thêm: lô tự lớn lên khi đang bận ghi lô trước)
+        while len(jobs) < WRITE_BATCH_MAX:
+            try:
+                jobs.append(q.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            _chay_lo(key, jobs)
+        except Exception:
+            # Không để 1 lô lỗi làm dừng thread ghi
+            pass
+
+
+def _hang_doi(key) -> queue.Queue:
+    """Hàng đợi + thread ghi của file DB `key` (tạo 1 lần / process, kể cả sau khi gunicorn fork)."""
+    global _pid
+    pid = os.getpid()
+    q = _queues.get(key) if _pid == pid else None
+    if q is not None:
+        return q
+    with _lock:
+        if _pid != pid:
+            # Hàng đợi kế thừa từ process cha (trước fork) không có thread ghi ở process này
+            _queues.clear()
+            _pid = pid
+        q = _queues.get(key)
+        if q is None:
+            q = _queues[key] = queue.Queue()
+            threading.Thread(
+                target=_writer_loop, args=(key, q), name=f"sqlite-writer-{key or 'catalog'}", daemon=True
+            ).start()
+    return q
+
+
+def gui_ghi(job, so=None) -> Future:
+    """
+    Gửi job(c) vào hàng đợi ghi của file DB chứa sở `so` (None = catalog), trả Future.
+    job chỉ dùng cursor `c` được truyền vào, không commit / rollback, không dùng request / session
+    của Flask (chạy trên thread ghi).
+    """
+    future = Future()
+    if not SQLITE_WRITE_QUEUE:
+        future.set_running_or_notify_cancel()
+        try:
+            with get_db(so) as conn:
+                future.set_result(job(conn.cursor()))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+    _hang_doi(db_key(so)).put((job, future))
+    return future
+
+
+def ghi(job, so=None, timeout: float = WRITE_QUEUE_TIMEOUT):
+    """Chạy job(c) trong transaction ghi của sở `so`, chờ commit rồi trả kết quả (hoặc raise lỗi của job)."""
+    if SQLITE_WRITE_QUEUE and getattr(_local, "cursor", None) is not None and _local.key == db_key(so):
+        # Gọi lồng từ 1 job trên chính thread ghi này: chạy luôn trong transaction hiện tại
+        return job(_local.cursor)
+    return gui_ghi(job, so).result(timeout)
@@ -0,0 +1,306 @@
+# luutru.py
+"""
+Lưu trữ + dọn bảng nhật ký (logs, login_logs).
+
+Dòng cũ hơn LOG_RETENTION_DAYS / LOGIN_LOG_RETENTION_DAYS ngày (theo created_at) được chuyển sang
+file nén chỉ-ghi-thêm database/archive/<bảng>-YYYY-MM.jsonl.gz (mỗi dòng 1 JSON), rồi xoá khỏi bảng
+theo từng lô LOG_ARCHIVE_CHUNK dòng (mỗi lô 1 job ngắn trên hàng đợi ghi, nghỉ giữa các lô) để không chặn ghi.
+Ghi nối file (gzip + fsync) làm ngoài hàng đợi ghi, job chỉ xoá dòng + lưu kích thước file.
+
+An toàn khi chết giữa chừng: kích thước đã commit của mỗi file được lưu trong cache_versions
+('archive:<file>') CÙNG transaction với lệnh xoá. Lần chạy sau cắt bỏ phần đuôi chưa commit
+trước khi ghi tiếp, nên mỗi dòng nằm trong file đúng 1 lần; người đọc cũng chỉ đọc tới kích thước đó.
+Shard SQLite: logs của từng file DB lần lượt ghi nối vào cùng file lưu trữ, mỗi file DB lưu kích thước
+sau lần ghi của nó -> kích thước đã commit = lớn nhất trong các file DB.
+
+Chạy: `python luutru.py run` (cron / scheduler), hoặc thread nền mỗi LOG_ARCHIVE_INTERVAL giây
+(0 = tắt); nhiều worker cùng lúc thì chỉ 1 worker chạy (khoá + mốc lần chạy cuối).
+"""
+import datetime
+import gzip
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import hangdoighi
+from database import db_keys, fan_out, get_db, is_postgres
+from nhatky import tang_phien_ban
+
+LOG_RETENTION_DAYS = int(os.environ.get("LOG_RETENTION_DAYS", "90") or 0)
+LOGIN_LOG_RETENTION_DAYS = int(os.environ.get("LOGIN_LOG_RETENTION_DAYS", "90") or 0)
+LOG_ARCHIVE_CHUNK = int(os.environ.get("LOG_ARCHIVE_CHUNK", "1000") or 1000)
+LOG_ARCHIVE_PAUSE = float(os.environ.get("LOG_ARCHIVE_PAUSE", "0.05") or 0)
+LOG_ARCHIVE_INTERVAL = float(os.environ.get("LOG_ARCHIVE_INTERVAL", "86400") or 0)
+ARCHIVE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "database", "archive")
+
+ARCHIVE_TABLES = {
+    "logs": (
+        "id, action, record_id, user_name, time, created_at, details, so, field, old_value, new_value",
+        lambda: LOG_RETENTION_DAYS,
+    ),
+    "login_logs": (
+        "id, username, ip, user_agent, location, time, created_at",
+        lambda: LOGIN_LOG_RETENTION_DAYS,
+    ),
+}
+# Bảng có ở mọi file DB (shard theo sở); bảng còn lại chỉ ở catalog
+_SHARDED_TABLES = ("logs",)
+
+# Khoá advisory (Postgres) cho job lưu trữ, khác khoá migration
+_ARCHIVE_LOCK_ID = 72700102
+_LAST_RUN_KEY = "archive_last_run"
+
+
+def _file_name(table: str, thang: str) -> str:
+    return f"{table}-{thang}.jsonl.gz"
+
+
+def _size_key(file_name: str) -> str:
+    return f"archive:{file_name}"
+
+
+def _keys(table: str) -> list:
+    return db_keys() if table in _SHARDED_TABLES else [None]
+
+
+def _committed_size(file_name: str) -> int:
+    def load(key):
+        conn = get_db(key)
+        c = conn.cursor()
+        c.execute("SELECT version FROM cache_versions WHERE name = ?", (_size_key(file_name),))
+        row = c.fetchone()
+        conn.close()
+        return int((row["version"] if row else 0) or 0)
+
+    return max(fan_out(load, db_keys()))
+
+
+def _set_value(c, name: str, value: int):
+    c.execute(
+        "INSERT INTO cache_versions(name, version) VALUES(?, ?) "
+        "ON CONFLICT(name) DO UPDATE SET version = excluded.version",
+        (name, int(value)),
+    )
+
+
+def _append(path: str, rows: list, committed: int) -> int:
+    """Ghi thêm 1 gzip member vào cuối file (sau khi cắt phần chưa commit). Trả kích thước mới."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "ab") as raw:
+        if raw.tell() > committed:
+            raw.truncate(committed)
+            raw.seek(committed)
+        with gzip.GzipFile(fileobj=raw, mode="ab") as gz:
+            for row in rows:
+                gz.write((json.dumps(row, ensure_ascii=False) + "\n").encode("utf-8"))
+        raw.flush()
+        os.fsync(raw.fileno())
+        return raw.tell()
+
+
+@contextmanager
+def _job_lock():
+    """True nếu giành được quyền chạy job (không chờ nếu worker khác đang chạy)."""
+    if is_postgres():
+        conn = get_db()
+        c = conn.cursor()
+        c.execute("SELECT pg_try_advisory_lock(?) AS ok", (_ARCHIVE_LOCK_ID,))
+        ok = bool(c.fetchone()["ok"])
+        conn.commit()
+        try:
+            yield ok
+        finally:
+            if ok:
+                c.execute("SELECT pg_advisory_unlock(?)", (_ARCHIVE_LOCK_ID,))
+                conn.commit()
+            conn.close()
+        return
+    import fcntl
+
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    with open(os.path.join(ARCHIVE_DIR, ".lock"), "w") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def luu_tru_bang(table: str, days: int, chunk: int = LOG_ARCHIVE_CHUNK) -> int:
+    """Chuyển dòng cũ hơn `days` ngày của `table` (mọi file DB) sang file lưu trữ. Trả số dòng đã chuyển."""
+    return sum(_luu_tru_file(table, days, chunk, key) for key in _keys(table))
+
+
+def _luu_tru_file(table: str, days: int, chunk: int, key) -> int:
+    columns, _ = ARCHIVE_TABLES[table]
+    cutoff = (datetime.datetime.now() - datetime.timedelta(days=days)).strftime("%Y-%m-%d")
+    moved = 0
+    while True:
+        # Đọc từ primary (không qua replica): replica trễ có thể trả lại lô vừa xoá -> ghi trùng
+        conn = get_db(key)
+        try:
+            c = conn.cursor()
+            c.execute(
+                f"SELECT {columns} FROM {table} WHERE created_at < ? ORDER BY id LIMIT ?",
+                (cutoff, chunk),
+            )
+            rows = [dict(r) for r in c.fetchall()]
+        finally:
+            conn.close()
+        if not rows:
+            return moved
+        by_month: dict[str, list] = {}
+        for row in rows:
+            # Postgres: created_at là TIMESTAMP -> ghi ra file cùng dạng chuỗi như SQLite
+            row["created_at"] = str(row["created_at"])
+            by_month.setdefault(row["created_at"][:7], []).append(row)
+        sizes = {}
+        for thang, items in by_month.items():
+            name = _file_name(table, thang)
+            sizes[name] = _append(os.path.join(ARCHIVE_DIR, name), items, _committed_size(name))
+        ids = [r["id"] for r in rows]
+
+        def job(c):
+            c.execute(f"DELETE FROM {table} WHERE id IN ({','.join('?' * len(ids))})", ids)
+            tang_phien_ban(c, table, key)
+            for name, size in sizes.items():
+                _set_value(c, _size_key(name), size)
+
+        hangdoighi.ghi(job, key)
+        moved += len(rows)
+        if len(rows) < chunk:
+            return moved
+        # Nhường khoá ghi cho request giữa các lô
+        time.sleep(LOG_ARCHIVE_PAUSE)
+
+
+def chay_luu_tru(force: bool = False) -> dict | None:
+    """
+    Chạy job cho mọi bảng. Trả {bảng: số dòng đã chuyển}, hoặc None nếu worker khác đang chạy /
+    chưa tới hạn (force=True bỏ qua mốc lần chạy cuối).
+    """
+    with _job_lock() as ok:
+        if not ok:
+            return None
+        conn = get_db()
+        c = conn.cursor()
+        c.execute("SELECT version FROM cache_versions WHERE name = ?", (_LAST_RUN_KEY,))
+        row = c.fetchone()
+        conn.close()
+        last_run = int((row["version"] if row else 0) or 0)
+        if not force and LOG_ARCHIVE_INTERVAL and time.time() - last_run < LOG_ARCHIVE_INTERVAL:
+            return None
+
+        result = {}
+        for table, (_, days) in ARCHIVE_TABLES.items():
+            if days() > 0:
+                result[table] = luu_tru_bang(table, days())
+
+        hangdoighi.ghi(lambda c: _set_value(c, _LAST_RUN_KEY, int(time.time())))
+        for table, moved in result.items():
+            if moved:
+                # Cập nhật thống kê cho planner sau khi xoá nhiều dòng
+                for key in _keys(table):
+                    hangdoighi.ghi(lambda c: c.execute(f"ANALYZE {table}"), key)
+        return result
+
+
+def ds_luu_tru(table: str) -> list:
+    """Các tháng đã lưu trữ của `table`: [{"month", "size"}], mới nhất trước."""
+    if table not in ARCHIVE_TABLES:
+        raise ValueError("Bảng không hợp lệ")
+    prefix, suffix = f"{table}-", ".jsonl.gz"
+    result = []
+    for name in sorted(os.listdir(ARCHIVE_DIR) if os.path.isdir(ARCHIVE_DIR) else [], reverse=True):
+        if name.startswith(prefix) and name.endswith(suffix):
+            size = _committed_size(name)
+            if size:
+                result.append({"month": name[len(prefix):-len(suffix)], "size": size})
+    return result
+
+
+class _LimitedReader:
+    """Chỉ đọc `limit` byte đầu file (bỏ phần đuôi chưa commit)."""
+
+    def __init__(self, f, limit: int):
+        self._f = f
+        self._left = limit
+
+    def read(self, size=-1):
+        if self._left <= 0:
+            return b""
+        if size is None or size < 0 or size > self._left:
+            size = self._left
+        data = self._f.read(size)
+        self._left -= len(data)
+        return data
+
+
+def doc_luu_tru(table: str, thang: str):
+    """
+    Generator đọc dần 1 tháng lưu trữ (từng dòng JSON dạng str, không nạp cả file vào RAM).
+    Tháng sai định dạng / không có thì raise ValueError.
+    """
+    try:
+        datetime.datetime.strptime(thang, "%Y-%m")
+    except ValueError:
+        raise ValueError("Tháng không hợp lệ (YYYY-MM)")
+    if table not in ARCHIVE_TABLES:
+        raise ValueError("Bảng không hợp lệ")
+    name = _file_name(table, thang)
+    size = _committed_size(name)
+    path = os.path.join(ARCHIVE_DIR, name)
+    if not size or not os.path.exists(path):
+        raise ValueError("Không có dữ liệu lưu trữ tháng này")
+
+    def lines():
+        with open(path, "rb") as raw:
+            with gzip.GzipFile(fileobj=_LimitedReader(raw, size), mode="rb") as gz:
+                for line in gz:
+                    yield line.decode("utf-8")
+
+    return lines()
+
+
+_lock = threading.Lock()
+_scheduler_pid = None
+
+
+def _scheduler_loop():
+    # Lệch giờ khởi động để các worker không cùng tranh khoá ngay lúc deploy
+    time.sleep(60)
+    while True:
+        try:
+            chay_luu_tru()
+        except Exception as e:
+            print("[luutru] lỗi:", e)
+        time.sleep(min(LOG_ARCHIVE_INTERVAL, 3600))
+
+
+def start_scheduler():
+    """Khởi động thread lưu trữ định kỳ (1 lần / process); LOG_ARCHIVE_INTERVAL=0 thì không chạy."""
+    global _scheduler_pid
+    if not LOG_ARCHIVE_INTERVAL:
+        return
+    pid = os.getpid()
+    with _lock:
+        if _scheduler_pid == pid:
+            return
+        _scheduler_pid = pid
+    threading.Thread(target=_scheduler_loop, name="log-archive", daemon=True).start()
+
+
+if __name__ == "__main__":
+    # python luutru.py run  -> lưu trữ + dọn logs / login_logs ngay (bỏ qua mốc lần chạy cuối)
+    import sys
+
+    if len(sys.argv) >= 2 and sys.argv[1] == "run":
+        print(chay_luu_tru(force=True) or "Worker khác đang chạy lưu trữ")
+    else:
+        print("Cách dùng: python luutru.py run")
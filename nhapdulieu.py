@@ -0,0 +1,174 @@
+# nhapdulieu.py
+"""
+Nhập danh sách records hàng loạt từ file CSV / XLSX (VD: danh sách cán bộ đầu tháng).
+
+- Đọc file theo dòng (csv.reader / openpyxl read_only), kiểm tra chức vụ + cột số, báo lỗi theo dòng.
+- Ghi bằng INSERT ... SELECT từ 1 bảng VALUES nhiều dòng (IMPORT_BATCH dòng / câu lệnh):
+  giam_sat / tong_an / diem / tong_tien tính ngay trong câu lệnh bằng đúng biểu thức SQL của
+  bộ quy tắc (tinhdiem.recompute_select_sql), mỗi dòng chỉ ghi 1 lần.
+- Cả file trong 1 transaction: lỗi giữa chừng thì không dòng nào được ghi. dry_run chỉ kiểm tra.
+Cột nhận: name (bắt buộc), chuc_vu, các cột số nhập tay; cột khác (id, so, diem, ... của file xuất) bỏ qua.
+"""
+import csv
+import io
+import os
+
+import tinhdiem
+from database import is_postgres
+from tinhdiem import CHUC_VU_OPTIONS, DIEM_FIELDS, TIEN_FIELDS
+
+IMPORT_MAX_ROWS = int(os.environ.get("IMPORT_MAX_ROWS", "5000") or 5000)
+IMPORT_BATCH = int(os.environ.get("IMPORT_BATCH", "200") or 200)
+# Trả tối đa bấy nhiêu lỗi (file hỏng cả nghìn dòng thì không cần liệt kê hết)
+IMPORT_MAX_ERRORS = 200
+
+NUMERIC_FIELDS = DIEM_FIELDS + TIEN_FIELDS
+INPUT_FIELDS = ("chuc_vu", "name") + NUMERIC_FIELDS
+DEFAULT_CHUC_VU = "Thực tập"
+
+
+def _iter_csv(stream):
+    # utf-8-sig: bỏ BOM của file xuất / Excel
+    yield from csv.reader(io.TextIOWrapper(stream, encoding="utf-8-sig", newline=""))
+
+
+def _iter_xlsx(stream):
+    from openpyxl import load_workbook  # type: ignore[import]
+
+    wb = load_workbook(stream, read_only=True, data_only=True)
+    try:
+        for row in wb.active.iter_rows(values_only=True):
+            yield ["" if v is None else v for v in row]
+    finally:
+        wb.close()
+
+
+def doc_file(stream, filename: str):
+    """Generator các dòng (list ô) của file tải lên theo đuôi file. Sai định dạng thì raise ValueError."""
+    ext = os.path.splitext(filename or "")[1].lower()
+    if ext == ".csv":
+        return _iter_csv(stream)
+    if ext == ".xlsx":
+        try:
+            import openpyxl  # type: ignore[import]  # noqa: F401
+        except ImportError:
+            raise ValueError("Máy chủ chưa cài openpyxl, hãy dùng file CSV")
+        return _iter_xlsx(stream)
+    raise ValueError("Chỉ nhận file .csv hoặc .xlsx")
+
+
+def _parse_int(value):
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return 0
+    if isinstance(value, bool):
+        raise ValueError
+    if isinstance(value, float):
+        if not value.is_integer():
+            raise ValueError
+        value = int(value)
+    n = int(str(value).strip())
+    if n < 0:
+        raise ValueError
+    return n
+
+
+def kiem_tra(rows) -> tuple[list, list]:
+    """
+    Kiểm tra các dòng (dòng đầu là tiêu đề). Trả (dòng hợp lệ [dict], lỗi [{"row", "error"}]).
+    Số dòng tính như trong file (tiêu đề = dòng 1).
+    """
+    rows = iter(rows)
+    header = next(rows, None)
+    if not header:
+        raise ValueError("File trống")
+    index = {}
+    for i, h in enumerate(header):
+        key = str(h or "").strip().lower()
+        if key in INPUT_FIELDS and key not in index:
+            index[key] = i
+    if "name" not in index:
+        raise ValueError("Thiếu cột name")
+
+    valid, errors, seen = [], [], set()
+    for line_no, row in enumerate(rows, start=2):
+        if not any(str(v).strip() for v in row):
+            continue
+        if len(valid) + len(errors) >= IMPORT_MAX_ROWS:
+            raise ValueError(f"Tối đa {IMPORT_MAX_ROWS} dòng / lần")
+
+        def cell(key):
+            i = index.get(key)
+            return row[i] if i is not None and i < len(row) else ""
+
+        name = str(cell("name") or "").strip()
+        chuc_vu = str(cell("chuc_vu") or "").strip() or DEFAULT_CHUC_VU
+        item = {"name": name, "chuc_vu": chuc_vu}
+        problems = []
+        if not name:
+            problems.append("Thiếu tên")
+        elif name in seen:
+            problems.append("Trùng tên trong file")
+        if chuc_vu not in CHUC_VU_OPTIONS:
+            problems.append(f"Chức vụ không hợp lệ: {chuc_vu}")
+        for field in NUMERIC_FIELDS:
+            try:
+                item[field] = _parse_int(cell(field))
+            except (TypeError, ValueError):
+                problems.append(f"{field} phải là số nguyên >= 0")
+        if problems:
+            errors.append({"row": line_no, "error": "; ".join(problems)})
+            continue
+        seen.add(name)
+        item["row"] = line_no
+        valid.append(item)
+    return valid, errors
+
+
+def loai_trung(c, so: str, valid: list) -> tuple[list, list]:
+    """Bỏ các dòng trùng tên với record đã có trong sở (nhập lại cùng file không tạo bản sao)."""
+    existing = set()
+    names = [v["name"] for v in valid]
+    for i in range(0, len(names), IMPORT_BATCH):
+        part = names[i:i + IMPORT_BATCH]
+        c.execute(
+            f"SELECT name FROM records WHERE so = ? AND name IN ({','.join('?' * len(part))})",
+            (so, *part),
+        )
+        existing.update(r["name"] for r in c.fetchall())
+    kept, errors = [], []
+    for v in valid:
+        if v["name"] in existing:
+            errors.append({"row": v["row"], "error": "Đã có record cùng tên trong sở"})
+        else:
+            kept.append(v)
+    return kept, errors
+
+
+def chen(c, so: str, valid: list) -> int:
+    """INSERT các dòng hợp lệ theo lô, tính cột dẫn xuất ngay trong câu lệnh. Caller tự commit."""
+    if not valid:
+        return 0
+    derived = tinhdiem.recompute_select_sql(tinhdiem.get_rules(so))
+    raw_cols = ("name", "chuc_vu") + tuple(f for f in NUMERIC_FIELDS if f not in ("giam_sat_1_5", "giam_sat_6"))
+    insert_cols = ("so",) + raw_cols + tuple(name for name, _ in derived) + ("created_at",)
+    select_cols = ["?"] + list(raw_cols) + [expr for _, expr in derived]
+    select_cols.append("NOW()" if is_postgres() else "datetime('now')")
+    row_sql = "(" + ", ".join("?" * len(INPUT_FIELDS)) + ")"
+
+    inserted = 0
+    for i in range(0, len(valid), IMPORT_BATCH):
+        batch = valid[i:i + IMPORT_BATCH]
+        params = []
+        for item in batch:
+            params.extend(item[f] for f in INPUT_FIELDS)
+        params.append(so)
+        c.execute(
+            f"""
+            WITH v({", ".join(INPUT_FIELDS)}) AS (VALUES {", ".join([row_sql] * len(batch))})
+            INSERT INTO records({", ".join(insert_cols)})
+            SELECT {", ".join(select_cols)} FROM v
+            """,
+            params,
+        )
+        inserted += len(batch)
+    return inserted
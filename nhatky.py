@@ -1,62 +1,526 @@
 # nhatky.py
-from datetime import datetime
+import atexit
+import base64
+import heapq
+import os
+import threading
+import time
+from datetime import datetime, timedelta
 
-from database import get_db
+import hangdoighi
+from cache import TTLCache, bump_version, get_version
+from database import db_key, db_keys, fan_out, get_db, is_postgres
 
+# Phân trang nhật ký theo id (keyset): mỗi trang chỉ đọc page_size + 1 dòng qua index,
+# không OFFSET và không COUNT(*) toàn bảng mỗi lần bấm trang.
+# Shard SQLite: log của 1 sở nằm trong file của sở đó (cùng transaction với records), log không
+# thuộc sở nào ở catalog; xem tất cả thì đọc song song mọi file và gộp theo (created_at, nguồn, id).
+LOG_PAGE_SIZE = 12
+# Tổng số dòng chỉ để hiển thị -> cache LOG_COUNT_TTL giây (số gần đúng)
+LOG_COUNT_TTL = float(os.environ.get("LOG_COUNT_TTL", "60") or 60)
+# Postgres: bảng lớn hơn ngưỡng này thì lấy số ước lượng từ pg_class thay vì COUNT(*)
+LOG_COUNT_ESTIMATE_MIN = 100000
+_count_cache = TTLCache("log_counts", LOG_COUNT_TTL, max_size=64)
 
-def lay_nhat_ky(limit=50):
-    """Lấy danh sách nhật ký"""
-    conn = get_db()
-    c = conn.cursor()
-    
-    c.execute("""
-        SELECT 
-            id,
-            action,
-            record_id,
-            user_name,
-            time,
-            details
-        FROM logs
-        ORDER BY id DESC
-        LIMIT ?
-    """, (limit,))
-    
-    rows = c.fetchall()
-    conn.close()
-    
-    result = []
-    for row in rows:
-        result.append({
-            "id": row['id'],
-            "action": row['action'],
-            "record_id": row['record_id'],
-            "user_name": row['user_name'] or "System",
-            "time": row['time'],
-            "details": row['details'] or ""
-        })
-    
-    return result
-
-
-def them_nhat_ky(action, record_id=None, user_name=None, details=None):
-    """Thêm nhật ký mới"""
-    conn = get_db()
-    c = conn.cursor()
-    
-    if user_name is None:
-        user_name = "System"
-    
-    c.execute("""
-        INSERT INTO logs(action, record_id, user_name, time, details)
-        VALUES(?, ?, ?, ?, ?)
-    """, (
+# Ghi nhật ký theo lô (group commit): them_nhat_ky chỉ đưa vào bộ đệm, 1 thread nền mỗi process
+# ghi cả lô bằng 1 executemany + 1 commit khi đủ AUDIT_FLUSH_SIZE dòng hoặc sau AUDIT_FLUSH_INTERVAL giây.
+# AUDIT_LOG_SYNC=1: tắt bộ đệm, ghi ngay như trước.
+AUDIT_LOG_SYNC = os.environ.get("AUDIT_LOG_SYNC", "0") == "1"
+AUDIT_FLUSH_SIZE = int(os.environ.get("AUDIT_FLUSH_SIZE", "100") or 100)
+AUDIT_FLUSH_INTERVAL = float(os.environ.get("AUDIT_FLUSH_INTERVAL", "1") or 1)
+# Quá ngưỡng này (DB lỗi kéo dài) thì bỏ log mới thay vì ăn hết RAM
+AUDIT_BUFFER_MAX = int(os.environ.get("AUDIT_BUFFER_MAX", "10000") or 10000)
+
+_LOG_INSERT_SQL = (
+    "INSERT INTO logs(action, record_id, user_name, time, created_at, details, so, field, old_value, new_value) "
+    "VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+_buffer: list = []
+_inflight = 0
+_cond = threading.Condition()
+_writer_pid = None
+
+
+LOG_COLUMNS = "id, action, record_id, user_name, time, created_at, details, so, field, old_value, new_value"
+
+
+def _log_dict(row) -> dict:
+    return {
+        "id": row["id"],
+        "action": row["action"],
+        "record_id": row["record_id"],
+        "user_name": row["user_name"] or "System",
+        "time": row["time"],
+        # Postgres: TIMESTAMP -> cùng dạng chuỗi "YYYY-MM-DD HH:MM:SS" như SQLite
+        "created_at": _text(row["created_at"]),
+        "details": row["details"] or "",
+        "so": row["so"],
+        "field": row["field"],
+        "old_value": row["old_value"],
+        "new_value": row["new_value"],
+    }
+
+
+def lay_nhat_ky(limit=50, record_id=None, so=None, field=None, tu_ngay=None, den_ngay=None):
+    """
+    Lấy danh sách nhật ký mới nhất, lọc theo record / sở / cột và khoảng ngày (created_at).
+    VD "ai sửa dòng 12 tuần trước": lay_nhat_ky(record_id=12, tu_ngay="2026-10-05", den_ngay="2026-10-11")
+    -> đi thẳng index (record_id, created_at), không LIKE trên details.
+    """
+    filters = loc_nhat_ky(record_id=record_id, so=so, field=field, tu_ngay=tu_ngay, den_ngay=den_ngay)
+    where = ("WHERE " + " AND ".join(sql for sql, _ in filters)) if filters else ""
+    keys = _nguon("logs", so)
+    # Lọc theo thời gian thì sắp theo created_at để dùng index (record_id|so, created_at);
+    # gộp nhiều file thì id không so được giữa các file -> cũng theo created_at
+    order = "created_at DESC, id DESC" if (tu_ngay or den_ngay or len(keys) > 1) else "id DESC"
+
+    def load(key):
+        conn = get_db(key, readonly=True)
+        c = conn.cursor()
+        c.execute(
+            f"SELECT {LOG_COLUMNS} FROM logs {where} ORDER BY {order} LIMIT ?",
+            (*[p for _, p in filters], int(limit)),
+        )
+        rows = [_log_dict(r) for r in c.fetchall()]
+        conn.close()
+        return rows
+
+    parts = fan_out(load, keys)
+    if len(parts) == 1:
+        return parts[0]
+    return heapq.nlargest(int(limit), (r for part in parts for r in part),
+                          key=lambda r: (r["created_at"] or "", r["id"]))
+
+
+def _text(value):
+    return None if value is None else str(value)
+
+
+def _log_row(now: datetime, action, record_id, user_name, details,
+             so=None, field=None, old_value=None, new_value=None) -> tuple:
+    return (
         action,
         record_id,
-        user_name,
-        datetime.now().strftime("%d-%m-%Y %H:%M:%S"),
-        details or ""
-    ))
-    
-    conn.commit()
+        user_name or "System",
+        now.strftime("%d-%m-%Y %H:%M:%S"),
+        now.strftime("%Y-%m-%d %H:%M:%S"),
+        details or "",
+        so,
+        field,
+        _text(old_value),
+        _text(new_value),
+    )
+
+
+def ghi_nhat_ky(c, entries):
+    """
+    INSERT ngay các nhật ký bằng cursor `c` (caller tự commit, cùng transaction với dữ liệu).
+    entries = [(action, record_id, user_name, details[, so, field, old_value, new_value]), ...]
+    """
+    now = datetime.now()
+    rows = [_log_row(now, *e) for e in entries]
+    c.executemany(_LOG_INSERT_SQL, rows)
+    for key in _theo_file(rows):
+        tang_phien_ban(c, "logs", key)
+
+
+def _theo_file(rows: list) -> dict:
+    """Chia các dòng log theo file DB chứa chúng (cột so, xem database.db_key)."""
+    groups: dict = {}
+    for row in rows:
+        groups.setdefault(db_key(row[6]), []).append(row)
+    return groups
+
+
+def _job_ghi(rows: list, key=None):
+    def job(c):
+        c.executemany(_LOG_INSERT_SQL, rows)
+        tang_phien_ban(c, "logs", key)
+
+    return job
+
+
+def _ghi_lo(rows: list) -> list:
+    """Ghi 1 lô: mỗi file DB 1 executemany + 1 commit. Trả các dòng chưa ghi được."""
+    failed = []
+    for key, group in _theo_file(rows).items():
+        try:
+            hangdoighi.ghi(_job_ghi(group, key), key)
+        except Exception:
+            failed.extend(group)
+    return failed
+
+
+def _lay_lo(limit=None) -> list:
+    """Lấy 1 lô khỏi bộ đệm (gọi khi đang giữ _cond)."""
+    global _inflight
+    rows = _buffer[:limit] if limit else _buffer[:]
+    del _buffer[:len(rows)]
+    if rows:
+        _inflight += 1
+    return rows
+
+
+def _xong_lo(failed: list):
+    global _inflight
+    with _cond:
+        _inflight -= 1
+        if failed:
+            # Trả phần lỗi về đầu bộ đệm để lần sau ghi lại (giữ thứ tự)
+            _buffer[:0] = failed[:max(AUDIT_BUFFER_MAX - len(_buffer), 0)]
+        _cond.notify_all()
+
+
+def _writer_loop():
+    while True:
+        with _cond:
+            while not _buffer:
+                _cond.wait()
+            # Gom thêm tới khi đủ lô hoặc hết AUDIT_FLUSH_INTERVAL giây
+            deadline = time.monotonic() + AUDIT_FLUSH_INTERVAL
+            while len(_buffer) < AUDIT_FLUSH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                _cond.wait(remaining)
+            rows = _lay_lo(AUDIT_FLUSH_SIZE * 10)
+        if not rows:
+            continue
+        failed = _ghi_lo(rows)
+        _xong_lo(failed)
+        if failed:
+            time.sleep(AUDIT_FLUSH_INTERVAL)
+
+
+def _ensure_writer():
+    """Khởi động thread ghi nhật ký (1 lần / process, kể cả sau khi gunicorn fork)."""
+    global _writer_pid, _inflight
+    pid = os.getpid()
+    if _writer_pid == pid:
+        return
+    with _cond:
+        if _writer_pid == pid:
+            return
+        _writer_pid = pid
+        # Bộ đệm kế thừa từ process cha (trước fork) không thuộc process này
+        _buffer.clear()
+        _inflight = 0
+    threading.Thread(target=_writer_loop, name="audit-log", daemon=True).start()
+
+
+def them_nhieu_nhat_ky(entries, sync: bool = False):
+    """
+    Thêm nhiều nhật ký: entries = [(action, record_id, user_name, details[, so, field, old_value, new_value]), ...].
+    Mặc định chỉ đưa vào bộ đệm ghi theo lô; sync=True (hoặc AUDIT_LOG_SYNC) thì ghi + commit ngay.
+    """
+    entries = list(entries)
+    if not entries:
+        return
+    now = datetime.now()
+    rows = [_log_row(now, *e) for e in entries]
+    if sync or AUDIT_LOG_SYNC:
+        for key, group in _theo_file(rows).items():
+            hangdoighi.ghi(_job_ghi(group, key), key)
+        return
+    _ensure_writer()
+    with _cond:
+        room = AUDIT_BUFFER_MAX - len(_buffer)
+        _buffer.extend(rows[:max(room, 0)])
+        _cond.notify_all()
+
+
+def them_nhat_ky(action, record_id=None, user_name=None, details=None, sync=False,
+                 so=None, field=None, old_value=None, new_value=None):
+    """Thêm nhật ký mới (qua bộ đệm ghi theo lô, sync=True thì ghi ngay)"""
+    them_nhieu_nhat_ky([(action, record_id, user_name, details, so, field, old_value, new_value)], sync=sync)
+
+
+def flush_nhat_ky(timeout: float = 5.0) -> bool:
+    """
+    Ghi ngay mọi nhật ký đang đệm của process này (khi tắt process, hoặc trước khi đọc lại).
+    Chờ lô thread nền đang ghi xong. Trả False nếu quá `timeout` giây mà vẫn còn log chưa ghi.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        with _cond:
+            while _inflight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                _cond.wait(remaining)
+            rows = _lay_lo()
+        if not rows:
+            return True
+        failed = _ghi_lo(rows)
+        _xong_lo(failed)
+        if failed:
+            return False
+
+
+def _flush_khi_thoat():
+    if _writer_pid == os.getpid():
+        flush_nhat_ky()
+
+
+atexit.register(_flush_khi_thoat)
+
+
+def encode_cursor(direction: str, row_id: int) -> str:
+    """Cursor "mờ" cho client: 'b' = trang cũ hơn (id < row_id), 'a' = trang mới hơn (id > row_id)."""
+    raw = f"{direction}:{int(row_id)}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(token: str) -> tuple[str, int]:
+    """Giải cursor, sai định dạng thì raise ValueError."""
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode()
+        direction, row_id = raw.split(":", 1)
+        row_id = int(row_id)
+    except Exception:
+        raise ValueError("Cursor không hợp lệ")
+    if direction not in ("a", "b"):
+        raise ValueError("Cursor không hợp lệ")
+    return direction, row_id
+
+
+def _parse_ngay(value: str) -> datetime:
+    for fmt in ("%Y-%m-%d", "%d-%m-%Y"):
+        try:
+            return datetime.strptime(value.strip(), fmt)
+        except ValueError:
+            pass
+    raise ValueError(f"Ngày không hợp lệ: {value}")
+
+
+def _loc_thoi_gian(tu_ngay=None, den_ngay=None) -> list:
+    """Điều kiện created_at theo khoảng ngày (đến ngày tính cả ngày đó)."""
+    filters = []
+    if tu_ngay:
+        filters.append(("created_at >= ?", _parse_ngay(tu_ngay).strftime("%Y-%m-%d")))
+    if den_ngay:
+        het_ngay = _parse_ngay(den_ngay) + timedelta(days=1)
+        filters.append(("created_at < ?", het_ngay.strftime("%Y-%m-%d")))
+    return filters
+
+
+def _nguon(table: str, so=None) -> list:
+    """File DB cần đọc cho bảng log: logs theo sở nằm ở shard của sở đó, login_logs chỉ ở catalog."""
+    if table != "logs":
+        return [None]
+    return [db_key(so)] if so else db_keys()
+
+
+def _dem_dong_cache(table: str, where: str, params: list, key=None) -> tuple:
+    """
+    (khoá cache, số dòng đã cache hoặc None, version) - gọi TRƯỚC khi mượn connection:
+    kiểm tra version cache có thể mượn thêm connection của pool (giữ 2 cái cùng lúc -> cạn pool).
+    """
+    cache_key = (key, table, where, tuple(params))
+    # Lấy version TRƯỚC khi đếm để số cũ không bị gắn version mới
+    version = get_version(_count_cache.group)
+    return cache_key, _count_cache.get(cache_key), version
+
+
+def _dem_dong(c, table: str, where: str, params: list, cached: tuple) -> int:
+    """Số dòng (gần đúng) bằng cursor `c` đang mở; `cached` lấy từ _dem_dong_cache()."""
+    cache_key, total, version = cached
+    if total is not None:
+        return total
+    total = None
+    if not where and is_postgres():
+        c.execute("SELECT reltuples::bigint AS n FROM pg_class WHERE oid = to_regclass(?)", (table,))
+        row = c.fetchone()
+        if row and int(row["n"] or 0) >= LOG_COUNT_ESTIMATE_MIN:
+            total = int(row["n"])
+    if total is None:
+        c.execute(f"SELECT COUNT(1) AS n FROM {table} {where}", params)
+        row = c.fetchone()
+        total = int((row["n"] if row else 0) or 0)
+    _count_cache.set(cache_key, total, version)
+    return total
+
+
+def ten_phien_ban(table: str, key=None) -> str:
+    """Tên version (cache_versions) của bảng log trong file DB `key`: 'logs' ở catalog, 'logs:TRU' ở shard TRU."""
+    return table if key is None else f"{table}:{key}"
+
+
+def tang_phien_ban(c, table: str, key=None):
+    """Bump version bảng log của file `key` - gọi trong job mỗi lần thêm / xoá dòng log."""
+    bump_version(c, ten_phien_ban(table, key))
+
+
+def phien_ban_bang(table: str) -> tuple:
+    """
+    Version của bảng log (mọi file chứa bảng) để làm ETag: lấy từ cache.get_version
+    (poll định kỳ trong process), không query DB mỗi request.
+    """
+    return tuple(get_version(ten_phien_ban(table, key)) for key in _nguon(table))
+
+
+def _lay_trang(table: str, columns: str, filters: list, cursor=None, page_size=LOG_PAGE_SIZE, key=None) -> dict:
+    """
+    Đọc 1 trang của bảng log theo keyset (id giảm dần).
+    Trả {"rows", "next_cursor", "prev_cursor", "total"}; total là số gần đúng (cache).
+    """
+    direction, anchor = decode_cursor(cursor) if cursor else ("b", None)
+    conds = [sql for sql, _ in filters]
+    params = [p for _, p in filters]
+    where = ("WHERE " + " AND ".join(conds)) if conds else ""
+
+    page_conds = list(conds)
+    page_params = list(params)
+    if anchor is not None:
+        page_conds.append("id < ?" if direction == "b" else "id > ?")
+        page_params.append(anchor)
+    page_where = ("WHERE " + " AND ".join(page_conds)) if page_conds else ""
+    order = "DESC" if direction == "b" else "ASC"
+
+    cached = _dem_dong_cache(table, where, params, key)
+    conn = get_db(key, readonly=True)
+    c = conn.cursor()
+    c.execute(
+        f"SELECT {columns} FROM {table} {page_where} ORDER BY id {order} LIMIT ?",
+        (*page_params, page_size + 1),
+    )
+    rows = c.fetchall()
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if direction == "a":
+        rows.reverse()
+    total = _dem_dong(c, table, where, params, cached)
     conn.close()
+
+    next_cursor = prev_cursor = None
+    if rows:
+        if has_more or direction == "a":
+            next_cursor = encode_cursor("b", rows[-1]["id"])
+        if (has_more and direction == "a") or (anchor is not None and direction == "b"):
+            prev_cursor = encode_cursor("a", rows[0]["id"])
+    return {"rows": rows, "next_cursor": next_cursor, "prev_cursor": prev_cursor, "total": total}
+
+
+def _ma_vi_tri(direction: str, pos: tuple) -> str:
+    created_at, source, row_id = pos
+    raw = f"{direction}:{int(source)}:{int(row_id)}:{created_at}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _giai_vi_tri(token: str, sources: int) -> tuple[str, tuple]:
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode()
+        direction, source, row_id, created_at = raw.split(":", 3)
+        pos = (created_at, int(source), int(row_id))
+    except Exception:
+        raise ValueError("Cursor không hợp lệ")
+    if direction not in ("a", "b") or not 0 <= pos[1] < sources:
+        raise ValueError("Cursor không hợp lệ")
+    return direction, pos
+
+
+def _lay_trang_gop(table: str, columns: str, filters: list, keys: list, cursor=None,
+                   page_size=LOG_PAGE_SIZE) -> dict:
+    """
+    Như _lay_trang nhưng gộp nhiều file DB (đọc song song): sắp theo vị trí
+    (created_at, thứ tự file, id) giảm dần, cursor mang cả vị trí đó.
+    """
+    direction, anchor = _giai_vi_tri(cursor, len(keys)) if cursor else ("b", None)
+    conds = [sql for sql, _ in filters]
+    params = [p for _, p in filters]
+    where = ("WHERE " + " AND ".join(conds)) if conds else ""
+    op = "<" if direction == "b" else ">"
+    order = "DESC" if direction == "b" else "ASC"
+
+    def load(source):
+        page_conds = list(conds)
+        page_params = list(params)
+        if anchor is not None:
+            created_at, anchor_source, anchor_id = anchor
+            if source == anchor_source:
+                page_conds.append(f"(created_at {op} ? OR (created_at = ? AND id {op} ?))")
+                page_params += [created_at, created_at, anchor_id]
+            elif (source < anchor_source) == (direction == "b"):
+                page_conds.append(f"created_at {op}= ?")
+                page_params.append(created_at)
+            else:
+                page_conds.append(f"created_at {op} ?")
+                page_params.append(created_at)
+        page_where = ("WHERE " + " AND ".join(page_conds)) if page_conds else ""
+        cached = _dem_dong_cache(table, where, params, keys[source])
+        conn = get_db(keys[source], readonly=True)
+        c = conn.cursor()
+        c.execute(
+            f"SELECT {columns} FROM {table} {page_where} ORDER BY created_at {order}, id {order} LIMIT ?",
+            (*page_params, page_size + 1),
+        )
+        rows = [((r["created_at"] or "", source, r["id"]), r) for r in c.fetchall()]
+        total = _dem_dong(c, table, where, params, cached)
+        conn.close()
+        return rows, total
+
+    parts = fan_out(load, range(len(keys)))
+    merged = sorted((item for rows, _ in parts for item in rows), key=lambda item: item[0],
+                    reverse=direction == "b")
+    has_more = len(merged) > page_size
+    merged = merged[:page_size]
+    if direction == "a":
+        merged.reverse()
+
+    next_cursor = prev_cursor = None
+    if merged:
+        if has_more or direction == "a":
+            next_cursor = _ma_vi_tri("b", merged[-1][0])
+        if (has_more and direction == "a") or (anchor is not None and direction == "b"):
+            prev_cursor = _ma_vi_tri("a", merged[0][0])
+    return {
+        "rows": [row for _, row in merged],
+        "next_cursor": next_cursor,
+        "prev_cursor": prev_cursor,
+        "total": sum(total for _, total in parts),
+    }
+
+
+LOGIN_LOG_COLUMNS = "id, username, ip, user_agent, location, time"
+
+
+def loc_nhat_ky(action=None, user_name=None, record_id=None, so=None, field=None,
+                tu_ngay=None, den_ngay=None) -> list:
+    """Điều kiện lọc bảng logs: [(sql, param), ...]. Ngày sai thì raise ValueError."""
+    filters = []
+    if action:
+        filters.append(("action = ?", action))
+    if user_name:
+        filters.append(("user_name = ?", user_name))
+    if record_id is not None:
+        filters.append(("record_id = ?", int(record_id)))
+    if so:
+        filters.append(("so = ?", so))
+    if field:
+        filters.append(("field = ?", field))
+    return filters + _loc_thoi_gian(tu_ngay, den_ngay)
+
+
+def loc_log_dang_nhap(username=None, tu_ngay=None, den_ngay=None) -> list:
+    """Điều kiện lọc bảng login_logs: [(sql, param), ...]."""
+    filters = []
+    if username:
+        filters.append(("username = ?", username))
+    return filters + _loc_thoi_gian(tu_ngay, den_ngay)
+
+
+def lay_trang_nhat_ky(cursor=None, action=None, user_name=None, record_id=None,
+                      tu_ngay=None, den_ngay=None, page_size=LOG_PAGE_SIZE, so=None, field=None) -> dict:
+    """1 trang nhật ký thao tác, lọc theo action / user_name / record_id / sở / cột / khoảng ngày."""
+    filters = loc_nhat_ky(action, user_name, record_id, so, field, tu_ngay, den_ngay)
+    keys = _nguon("logs", so)
+    if len(keys) > 1:
+        return _lay_trang_gop("logs", LOG_COLUMNS, filters, keys, cursor, page_size)
+    return _lay_trang("logs", LOG_COLUMNS, filters, cursor, page_size, keys[0])
+
+
+def lay_trang_log_dang_nhap(cursor=None, username=None, tu_ngay=None, den_ngay=None,
+                            page_size=LOG_PAGE_SIZE) -> dict:
+    """1 trang log đăng nhập, lọc theo username / khoảng ngày."""
+    filters = loc_log_dang_nhap(username, tu_ngay, den_ngay)
+    return _lay_trang("login_logs", LOGIN_LOG_COLUMNS, filters, cursor, page_size)
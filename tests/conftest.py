@@ -0,0 +1,72 @@
+# tests/conftest.py
+"""
+Chạy test trên DB SQLite tạm (không đụng database.db / database/*.db trong repo).
+Mỗi test dùng fixture `db` được 1 thư mục DB mới đã init_db().
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ.pop("DATABASE_URL", None)
+os.environ.pop("DATABASE_READ_URL", None)
+# Không chạy thread lưu trữ nền; cache kết quả hết hạn ngay (mỗi test 1 DB mới, version lại từ 0)
+os.environ["LOG_ARCHIVE_INTERVAL"] = "0"
+os.environ["RESULT_CACHE_TTL"] = "1e-9"
+os.environ["AUDIT_LOG_SYNC"] = "1"
+
+_WORK = tempfile.mkdtemp(prefix="test-db-")
+os.chdir(_WORK)
+
+import cache  # noqa: E402
+import database  # noqa: E402
+import hangdoighi  # noqa: E402
+import luutru  # noqa: E402
+
+database.SHARD_DIR = os.path.join(_WORK, "database")
+luutru.ARCHIVE_DIR = os.path.join(_WORK, "database", "archive")
+
+
+def reset_connections():
+    """Bỏ pool / thread ghi / version đã đọc của DB cũ (đổi thư mục DB giữa các test)."""
+    database.close_pool()
+    database._pools.clear()
+    hangdoighi._queues.clear()
+    cache._versions.clear()
+    cache._local_gen.clear()
+    cache._versions_checked_at = 0.0
+
+
+def use_dir(path, monkeypatch):
+    monkeypatch.chdir(path)
+    monkeypatch.setattr(database, "SHARD_DIR", os.path.join(str(path), "database"))
+    monkeypatch.setattr(luutru, "ARCHIVE_DIR", os.path.join(str(path), "database", "archive"))
+    reset_connections()
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Thư mục DB mới (catalog + shard theo sở) đã migrate."""
+    use_dir(tmp_path, monkeypatch)
+    database.init_db()
+    yield tmp_path
+    reset_connections()
+
+
+@pytest.fixture
+def client(db):
+    """Flask test client đã đăng nhập admin (sở TRU)."""
+    import time
+
+    from app import app
+
+    app.config["TESTING"] = True
+    c = app.test_client()
+    with c.session_transaction() as s:
+        s.update(login=True, username="admin", role="admin", so_allowed="ALL", current_so="TRU",
+                 last_active=time.time())
+    return c
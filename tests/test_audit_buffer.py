@@ -0,0 +1,62 @@
+import pytest
+
+import hangdoighi
+import nhatky
+from database import get_db
+
+
+@pytest.fixture
+def buffered(db, monkeypatch):
+    """Bật bộ đệm nhật ký nhưng không chạy thread nền: log chỉ được ghi khi flush_nhat_ky()."""
+    monkeypatch.setattr(nhatky, "AUDIT_LOG_SYNC", False)
+    monkeypatch.setattr(nhatky, "_ensure_writer", lambda: None)
+    monkeypatch.setattr(nhatky, "_buffer", [])
+    jobs = []
+    ghi = hangdoighi.ghi
+
+    def spy(job, so=None, **kwargs):
+        jobs.append(so)
+        return ghi(job, so, **kwargs)
+
+    monkeypatch.setattr(hangdoighi, "ghi", spy)
+    return jobs
+
+
+def _actions(key):
+    conn = get_db(key)
+    rows = [r["action"] for r in conn.cursor().execute("SELECT action FROM logs ORDER BY id")]
+    conn.close()
+    return rows
+
+
+def test_buffered_logs_written_in_one_batch_per_file(buffered):
+    nhatky.them_nhieu_nhat_ky([("ADD", 1, "u", "a", "TRU"), ("EDIT", 1, "u", "b", "TRU")])
+    nhatky.them_nhat_ky("CREATE_ACCOUNT", None, "admin", "Tạo tài khoản x")
+    nhatky.them_nhat_ky("ADD", 2, "u", "c", so="TRU")
+    assert _actions("TRU") == [] and buffered == []
+
+    assert nhatky.flush_nhat_ky()
+    # 1 job (1 executemany + 1 commit) cho mỗi file DB
+    assert sorted(buffered, key=str) == sorted(["TRU", None], key=str)
+    assert _actions("TRU") == ["ADD", "EDIT", "ADD"]
+    assert _actions(None) == ["CREATE_ACCOUNT"]
+    assert nhatky._buffer == []
+
+
+def test_failed_batch_kept_for_retry_and_buffer_capped(buffered, monkeypatch):
+    monkeypatch.setattr(nhatky, "AUDIT_BUFFER_MAX", 2)
+    nhatky.them_nhieu_nhat_ky([("A", None, "u", "1", "TRU"), ("B", None, "u", "2", "TRU"), ("C", None, "u", "3", "TRU")])
+    assert [r[0] for r in nhatky._buffer] == ["A", "B"]
+
+    ghi = hangdoighi.ghi
+
+    def fail(job, so=None, **kwargs):
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(hangdoighi, "ghi", fail)
+    assert not nhatky.flush_nhat_ky()
+    assert [r[0] for r in nhatky._buffer] == ["A", "B"]
+
+    monkeypatch.setattr(hangdoighi, "ghi", ghi)
+    assert nhatky.flush_nhat_ky()
+    assert _actions("TRU") == ["A", "B"]
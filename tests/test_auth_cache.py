@@ -0,0 +1,67 @@
+import time
+
+import app as app_module
+import cache
+from database import get_db
+
+
+def _login(username, role="editer"):
+    c = app_module.app.test_client()
+    with c.session_transaction() as s:
+        s.update(login=True, username=username, role=role, so_allowed="TRU", current_so="TRU",
+                 last_active=time.time())
+    return c
+
+
+def _spy_loads(monkeypatch) -> list:
+    calls = []
+    load = app_module._load_auth_user
+
+    def spy(username):
+        calls.append(username)
+        return load(username)
+
+    monkeypatch.setattr(app_module, "_load_auth_user", spy)
+    app_module._auth_cache.clear()
+    return calls
+
+
+def _add_user(username, role="editer", so="TRU") -> int:
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("INSERT INTO users(username, password, role, so_allowed) VALUES(?, 'x', ?, ?)", (username, role, so))
+        return c.lastrowid
+
+
+def test_session_check_reads_user_once_until_version_changes(client, monkeypatch):
+    _add_user("u1")
+    calls = _spy_loads(monkeypatch)
+    user = _login("u1")
+    for _ in range(3):
+        user.get("/api/users")
+    assert calls == ["u1"]
+
+    # Worker khác đổi quyền: bump version "users" trong DB, worker này thấy ở lần poll kế tiếp
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("UPDATE users SET so_allowed='LS' WHERE username='u1'")
+        c.execute("UPDATE cache_versions SET version = version + 1 WHERE name = 'users'")
+        if not c.rowcount:
+            c.execute("INSERT INTO cache_versions(name, version) VALUES('users', 1)")
+    monkeypatch.setattr(cache, "_versions_checked_at", 0.0)
+    user.get("/api/users")
+    assert calls == ["u1", "u1"]
+    with user.session_transaction() as s:
+        assert s["so_allowed"] == "LS"
+
+
+def test_deleted_user_is_logged_out_immediately(client, monkeypatch):
+    uid = _add_user("u2")
+    user = _login("u2")
+    assert user.get("/api/users").get_json()["error"] == "Không có quyền (chỉ admin)"
+
+    assert client.delete(f"/api/users/{uid}").get_json()["success"]
+    # Cùng worker: bump_version bỏ cache ngay, không chờ chu kỳ poll
+    r = user.get("/api/users")
+    assert r.status_code == 403
+    assert r.get_json()["error"] == "Tài khoản không tồn tại hoặc đã bị xoá"
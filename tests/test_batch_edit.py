@@ -0,0 +1,32 @@
+import json
+
+from database import get_db
+from nhatky import lay_nhat_ky
+
+
+def test_batch_edit_writes_one_log_per_row(client):
+    for name in ("a", "b"):
+        client.post("/dashboard?so=TRU", data={"chuc_vu": "Cảnh sát viên", "name": name, "xa_1_4": "1"})
+    conn = get_db("TRU")
+    a, b = [r["id"] for r in conn.cursor().execute("SELECT id FROM records ORDER BY id").fetchall()]
+    conn.close()
+
+    r = client.post("/api/records/batch_edit", json={"edits": [
+        {"id": a, "field": "xa_1_4", "value": "4"},
+        {"id": a, "field": "giao_thong", "value": "2"},
+        {"id": a, "field": "an_sai", "value": "1"},
+        {"id": b, "field": "xa_5_6", "value": "3"},
+    ]}).get_json()
+    assert r["success"] and not r["errors"]
+
+    logs = {log["record_id"]: log for log in lay_nhat_ky(record_id=a) + lay_nhat_ky(record_id=b)
+            if log["action"] == "INLINE_EDIT"}
+    assert len(lay_nhat_ky(record_id=a)) == 2  # ADD + 1 log sửa gộp
+    row_a = logs[a]
+    assert row_a["field"] == "xa_1_4,giao_thong,an_sai"
+    assert json.loads(row_a["old_value"]) == {"xa_1_4": 1, "giao_thong": 0, "an_sai": 0}
+    assert json.loads(row_a["new_value"]) == {"xa_1_4": 4, "giao_thong": 2, "an_sai": 1}
+    assert "xa_1_4: 1 → 4" in row_a["details"]
+
+    row_b = logs[b]
+    assert (row_b["field"], row_b["old_value"], row_b["new_value"]) == ("xa_5_6", "0", "3")
@@ -0,0 +1,30 @@
+import caidat
+from database import get_db
+
+
+def test_settings_loaded_once_and_reloaded_after_write(db, monkeypatch):
+    calls = []
+    load = caidat._load_all_settings
+
+    def spy():
+        calls.append(1)
+        return load()
+
+    monkeypatch.setattr(caidat, "_load_all_settings", spy)
+    caidat._settings_cache.clear()
+
+    with get_db() as conn:
+        caidat.set_settings(conn.cursor(), {"monthly_title_TRU": "Tháng 1", "empty": ""})
+    assert caidat.get_setting("monthly_title_TRU") == "Tháng 1"
+    assert caidat.get_setting("missing", "x") == "x"
+    assert caidat.get_settings(["monthly_title_TRU", "empty", "missing"], {"empty": "mặc định"}) == {
+        "monthly_title_TRU": "Tháng 1",
+        "empty": "mặc định",
+        "missing": "",
+    }
+    assert len(calls) == 1
+
+    with get_db() as conn:
+        caidat.set_settings(conn.cursor(), {"monthly_title_TRU": "Tháng 2"})
+    assert caidat.get_setting("monthly_title_TRU") == "Tháng 2"
+    assert len(calls) == 2
@@ -0,0 +1,25 @@
+from datetime import datetime
+
+from database import get_db
+from thongke import thong_ke_theo_thang
+
+
+def test_close_month_keeps_stats_of_earlier_months(client):
+    client.post("/dashboard?so=TRU", data={"chuc_vu": "Cảnh sát viên", "name": "a", "xa_1_4": "3", "xa_5_6": "1"})
+    client.post("/dashboard?so=TRU", data={"chuc_vu": "Thực tập", "name": "b", "xa_1_4": "2"})
+    last_year = datetime.now().year - 1
+    with get_db("TRU") as conn:
+        conn.cursor().execute("UPDATE records SET created_at = ?", (f"{last_year}-01-15 08:00:00",))
+
+    before = thong_ke_theo_thang(nam=last_year, so="TRU")
+    assert before[0] == {"month": "Tháng 1", "value": 6}
+
+    r = client.post("/api/main/close_month", json={"month": datetime.now().strftime("%Y-%m")})
+    assert r.get_json()["success"]
+    conn = get_db("TRU")
+    assert conn.cursor().execute("SELECT SUM(tong_an) AS n FROM records").fetchone()["n"] == 0
+    conn.close()
+
+    assert thong_ke_theo_thang(nam=last_year, so="TRU") == before
+    current = thong_ke_theo_thang(so="TRU")
+    assert current[-1]["value"] == 6
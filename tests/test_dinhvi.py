@@ -0,0 +1,77 @@
+import ipaddress
+
+import pytest
+
+import dinhvi
+from cache import DictBackend
+from database import get_db
+
+
+class _Resolver:
+    def __init__(self, answers):
+        self.answers = answers
+        self.calls = []
+
+    def lookup(self, ip):
+        self.calls.append(str(ip))
+        answer = self.answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+
+@pytest.fixture
+def geo(monkeypatch):
+    monkeypatch.setattr(dinhvi, "_geo_cache", DictBackend(16))
+
+    def use(*resolvers):
+        monkeypatch.setattr(dinhvi, "_resolvers", list(resolvers))
+
+    return use
+
+
+def test_found_location_is_cached_and_resolvers_chain(geo):
+    first, second = _Resolver([None]), _Resolver(["Hà Nội, VN"])
+    geo(first, second)
+    assert dinhvi.tra_vi_tri("8.8.8.8") == "Hà Nội, VN"
+    assert dinhvi.tra_vi_tri(" 8.8.8.8 ") == "Hà Nội, VN"
+    assert first.calls == second.calls == ["8.8.8.8"]
+    # IP nội bộ / sai định dạng: không tra
+    assert dinhvi.tra_vi_tri("192.168.1.2") == "" and dinhvi.tra_vi_tri("abc") == ""
+    assert len(second.calls) == 1
+
+
+def test_miss_and_error_cached_briefly(geo, monkeypatch):
+    ttls = []
+    cache = dinhvi._geo_cache
+    set_ = cache.set
+    monkeypatch.setattr(cache, "set", lambda key, value, ttl: (ttls.append(ttl), set_(key, value, ttl)))
+    geo(_Resolver([RuntimeError("mạng lỗi"), "HCM, VN"]))
+    assert dinhvi.tra_vi_tri("1.1.1.1") == ""
+    assert ttls == [dinhvi.GEOIP_MISS_TTL]
+
+    # Hết GEOIP_MISS_TTL thì tra lại
+    cache._data.clear()
+    assert dinhvi.tra_vi_tri("1.1.1.1") == "HCM, VN"
+    assert ttls[-1] == dinhvi.GEOIP_CACHE_TTL
+
+
+def test_cidr_resolver(tmp_path):
+    path = tmp_path / "geo.csv"
+    path.write_text("network,city,region,country\n1.2.3.0/24,Huế,,VN\n2001:db8::/32,Đà Nẵng,,VN\n", encoding="utf-8")
+    resolver = dinhvi.CidrResolver(str(path))
+    assert resolver.lookup(ipaddress.ip_address("1.2.3.200")) == "Huế, VN"
+    assert resolver.lookup(ipaddress.ip_address("1.2.4.1")) is None
+    assert resolver.lookup(ipaddress.ip_address("2001:db8::1")) == "Đà Nẵng, VN"
+
+
+def test_queued_login_logs_flushed(db, geo, monkeypatch):
+    geo(_Resolver(["Huế, VN"]))
+    # Không chạy thread nền: log nằm lại trong hàng đợi cho tới khi flush (như lúc tắt process)
+    monkeypatch.setattr(dinhvi, "_ensure_worker", lambda: None)
+    assert dinhvi.ghi_log_dang_nhap("u1", "8.8.4.4", "ua")
+    assert dinhvi.flush_log_dang_nhap()
+    conn = get_db()
+    rows = [tuple(r) for r in conn.cursor().execute("SELECT username, ip, location FROM login_logs")]
+    conn.close()
+    assert rows == [("u1", "8.8.4.4", "Huế, VN")]
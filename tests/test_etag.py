@@ -0,0 +1,50 @@
+import time
+
+import app as app_module
+import cache
+import nhatky
+
+
+def _no_db(*args, **kwargs):
+    raise AssertionError("không được query DB khi trả 304")
+
+
+def _get(client, path, etag=None):
+    return client.get(path, headers={"If-None-Match": etag} if etag else {})
+
+
+def test_users_etag(client, monkeypatch):
+    first = _get(client, "/api/users")
+    etag = first.headers["ETag"].strip('"')
+    assert first.status_code == 200
+
+    # Quyết định 304 chỉ dựa vào version đã poll trong process
+    with monkeypatch.context() as m:
+        m.setattr(cache, "_versions_checked_at", time.monotonic())
+        m.setattr(cache, "get_db", _no_db)
+        m.setattr(app_module, "get_db", _no_db)
+        assert _get(client, "/api/users", etag).status_code == 304
+
+    client.post("/api/addaccount", json={"username": "etag_user", "password": "x", "role": "user"})
+    changed = _get(client, "/api/users", etag)
+    assert changed.status_code == 200
+    assert "etag_user" in [u["username"] for u in changed.get_json()["users"]]
+
+
+def test_logs_etag(client, monkeypatch):
+    nhatky.them_nhat_ky("ADD", None, "admin", "Thêm record: a", so="TRU")
+    first = _get(client, "/api/logs?so=TRU")
+    etag = first.headers["ETag"].strip('"')
+    assert first.status_code == 200 and first.get_json()["logs"]
+
+    with monkeypatch.context() as m:
+        m.setattr(cache, "_versions_checked_at", time.monotonic())
+        m.setattr(cache, "get_db", _no_db)
+        m.setattr(nhatky, "get_db", _no_db)
+        assert _get(client, "/api/logs?so=TRU", etag).status_code == 304
+    # Tham số khác -> ETag khác
+    assert _get(client, "/api/logs?so=LS", etag).status_code == 200
+
+    # Log mới ở file khác (catalog) cũng làm ETag đổi
+    nhatky.them_nhat_ky("CREATE_ACCOUNT", None, "admin", "Tạo tài khoản x")
+    assert _get(client, "/api/logs?so=TRU", etag).status_code == 200
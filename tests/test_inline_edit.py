@@ -0,0 +1,46 @@
+import re
+
+import pytest
+
+from app import INLINE_ALLOWED_FIELDS, _build_inline_edit
+from database import get_db
+
+
+def _set_targets(sql: str) -> list:
+    """Các cột được gán trong phần SET (tách theo dấu phẩy ngoài ngoặc)."""
+    set_part = re.search(r"\bSET\b(.*)\bWHERE\b", sql, re.S).group(1)
+    targets, depth, start = [], 0, 0
+    for i, ch in enumerate(set_part + ","):
+        if ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        elif ch == "," and depth == 0:
+            targets.append(set_part[start:i].split("=", 1)[0].strip())
+            start = i + 1
+    return targets
+
+
+@pytest.mark.parametrize("field", sorted(INLINE_ALLOWED_FIELDS))
+def test_inline_edit_sql_assigns_each_column_once(db, field):
+    value = "Đội phó" if field == "chuc_vu" else ("x" if field == "name" else 3)
+    sql, params = _build_inline_edit(field, value, "TRU")
+    targets = _set_targets(sql)
+    assert field in targets
+    assert len(targets) == len(set(targets)), targets
+    assert sql.count("?") == len(params) + 2
+
+
+@pytest.mark.parametrize("field", ["giam_sat_1_5", "giam_sat_6"])
+def test_inline_edit_supervision_columns(client, field):
+    client.post("/dashboard?so=TRU", data={"chuc_vu": "Cảnh sát viên", "name": "a"})
+    conn = get_db("TRU")
+    rid = conn.cursor().execute("SELECT MAX(id) AS id FROM records").fetchone()["id"]
+    conn.close()
+
+    r = client.post("/inline_edit", json={"id": rid, "field": field, "value": "2"}).get_json()
+    assert r["success"] and r[field] == 2
+    # Thực tập không tính giám sát -> ép về 0
+    client.post("/inline_edit", json={"id": rid, "field": "chuc_vu", "value": "Thực tập"})
+    r = client.post("/inline_edit", json={"id": rid, "field": field, "value": "4"}).get_json()
+    assert r["success"] and r[field] == 0
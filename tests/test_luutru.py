@@ -0,0 +1,59 @@
+import json
+import os
+
+import luutru
+from database import get_db
+
+
+def _add_logs(key, rows):
+    with get_db(key) as conn:
+        conn.cursor().executemany(
+            "INSERT INTO logs(action, user_name, details, so, time, created_at) VALUES(?, 'u', '', ?, '', ?)",
+            rows,
+        )
+
+
+def _count(key, table="logs"):
+    conn = get_db(key)
+    n = conn.cursor().execute(f"SELECT COUNT(1) FROM {table}").fetchone()[0]
+    conn.close()
+    return n
+
+
+def _archived(table, thang):
+    return [json.loads(line)["action" if table == "logs" else "username"] for line in luutru.doc_luu_tru(table, thang)]
+
+
+def test_old_logs_archived_and_deleted(db, monkeypatch):
+    _add_logs("TRU", [("A1", "TRU", "2020-01-05 08:00:00"), ("A2", "TRU", "2020-01-06 08:00:00"),
+                      ("A3", "TRU", "2020-02-01 08:00:00"), ("NEW", "TRU", "2999-01-01 00:00:00")])
+    _add_logs(None, [("C1", None, "2020-01-07 08:00:00")])
+    with get_db() as conn:
+        conn.cursor().execute(
+            "INSERT INTO login_logs(username, ip, time, created_at) VALUES('u1', '1.2.3.4', '', '2020-01-08 00:00:00')"
+        )
+
+    assert luutru.chay_luu_tru(force=True) == {"logs": 4, "login_logs": 1}
+    assert _count("TRU") == 1 and _count(None) == 0 and _count(None, "login_logs") == 0
+    assert sorted(_archived("logs", "2020-01")) == ["A1", "A2", "C1"]
+    assert _archived("logs", "2020-02") == ["A3"]
+    assert _archived("login_logs", "2020-01") == ["u1"]
+    assert [m["month"] for m in luutru.ds_luu_tru("logs")] == ["2020-02", "2020-01"]
+    # Đã chạy gần đây: lần gọi định kỳ bỏ qua
+    monkeypatch.setattr(luutru, "LOG_ARCHIVE_INTERVAL", 3600)
+    assert luutru.chay_luu_tru() is None
+
+
+def test_uncommitted_tail_is_dropped(db, monkeypatch):
+    _add_logs("TRU", [("A1", "TRU", "2020-01-05 08:00:00")])
+    luutru.luu_tru_bang("logs", 30)
+    # Chết sau khi ghi nối file nhưng trước khi commit lệnh xoá: phần đuôi vượt kích thước đã commit
+    path = os.path.join(luutru.ARCHIVE_DIR, "logs-2020-01.jsonl.gz")
+    with open(path, "ab") as f:
+        f.write(b"rac chua commit")
+    assert _archived("logs", "2020-01") == ["A1"]
+
+    monkeypatch.setattr(luutru, "LOG_ARCHIVE_PAUSE", 0)
+    _add_logs("TRU", [("A2", "TRU", "2020-01-06 08:00:00"), ("A3", "TRU", "2020-01-07 08:00:00")])
+    assert luutru.luu_tru_bang("logs", 30, chunk=1) == 2
+    assert _archived("logs", "2020-01") == ["A1", "A2", "A3"]
@@ -0,0 +1,118 @@
+import pytest
+
+import database
+from conftest import reset_connections, use_dir
+from database import get_db
+
+_LOGS = [
+    ("INLINE_EDIT", 1, "Chỉnh sửa xa_1_4 = 5"),
+    ("INLINE_EDIT", 1, "Chỉnh sửa xa_1_4 = 5, an_sai = 1"),
+    ("INLINE_EDIT", 1, "Chỉnh sửa name = Trần B"),
+    ("ADD", 2, "Thêm record: Nguyễn A"),
+    ("DELETE", 2, "Xóa record: Nguyễn A"),
+    ("RESET_SCORES", None, "Reset điểm so=LS"),
+    ("SCORING_RULES", None, "Quy tắc điểm so=ALL v3"),
+    ("CREATE_ACCOUNT", None, "Tạo tài khoản x"),
+    ("INLINE_EDIT", 999, "Chỉnh sửa foo = 1"),
+]
+
+
+def _migrate_to(version, monkeypatch):
+    monkeypatch.setattr(database, "MIGRATIONS", [m for m in database.MIGRATIONS if m[0] <= version])
+    database.init_db()
+    reset_connections()
+
+
+def test_migrations_backfill_existing_data(tmp_path, monkeypatch):
+    use_dir(tmp_path, monkeypatch)
+    monkeypatch.setattr(database, "SQLITE_SHARDING", False)
+
+    with monkeypatch.context() as m:
+        _migrate_to(2, m)
+    with get_db() as conn:
+        c = conn.cursor()
+        c.executemany(
+            "INSERT INTO records(id, so, name, chuc_vu, tong_an, diem, created_at) VALUES(?, ?, ?, ?, ?, ?, ?)",
+            [
+                (1, "LS", "a", "Đội phó", 3, 9, "2025-01-10 08:00:00"),
+                (3, None, "a", "Đội phó", 1, 2, "2025-01-20 08:00:00"),
+                (4, "LS", "c", "Thực tập", 2, 4, "2025-02-01 08:00:00"),
+            ],
+        )
+        c.executemany(
+            "INSERT INTO logs(action, record_id, user_name, details, time) VALUES(?, ?, 'u', ?, '01-01-2025 00:00:00')",
+            _LOGS,
+        )
+    with monkeypatch.context() as m:
+        _migrate_to(7, m)
+    with get_db() as conn:
+        conn.cursor().execute("INSERT INTO records_deleted(so, record_id, change_version) VALUES('PS', 2, 1)")
+    database.init_db()
+
+    conn = get_db()
+    c = conn.cursor()
+    monthly = c.execute("SELECT so, nam, thang, tong_an, tong_diem, so_luong FROM records_monthly ORDER BY so, thang")
+    assert [tuple(r) for r in monthly.fetchall()] == [("LS", 2025, 1, 3, 9, 1), ("LS", 2025, 2, 2, 4, 1),
+                                                      ("TRU", 2025, 1, 1, 2, 1)]
+    board = c.execute("SELECT so, name, chuc_vu, tong_diem, so_luong FROM records_leaderboard ORDER BY so, name")
+    assert [tuple(r) for r in board.fetchall()] == [("LS", "a", "Đội phó", 9, 1), ("LS", "c", "Thực tập", 4, 1),
+                                                    ("TRU", "a", "Đội phó", 2, 1)]
+    logs = c.execute("SELECT so, field, old_value, new_value FROM logs ORDER BY id").fetchall()
+    created = {r[0] for r in c.execute("SELECT created_at FROM logs")}
+    conn.close()
+    assert created == {"2025-01-01 00:00:00"}
+    assert [tuple(r) for r in logs] == [
+        ("LS", "xa_1_4", None, "5"),
+        ("LS", None, None, None),
+        ("LS", "name", None, "Trần B"),
+        ("PS", None, None, "Nguyễn A"),
+        ("PS", None, "Nguyễn A", None),
+        ("LS", None, None, None),
+        ("ALL", None, None, None),
+        (None, None, None, None),
+        (None, None, None, None),
+    ]
+
+
+def test_log_backfill_runs_in_resumable_chunks(tmp_path, monkeypatch):
+    use_dir(tmp_path, monkeypatch)
+    monkeypatch.setattr(database, "SQLITE_SHARDING", False)
+    with monkeypatch.context() as m:
+        _migrate_to(7, m)
+    with get_db() as conn:
+        conn.cursor().executemany(
+            "INSERT INTO logs(action, record_id, user_name, details, time) VALUES('ADD', NULL, 'u', ?, '')",
+            [(f"Thêm record: r{i}",) for i in range(5)],
+        )
+
+    fill = dict((name, fn) for name, _, fn in database.BACKFILLS)["logs_structured"]
+    calls = []
+
+    def failing(cur, last_id, chunk):
+        calls.append(last_id)
+        if len(calls) == 2:
+            raise RuntimeError("dừng giữa chừng")
+        return fill(cur, last_id, chunk)
+
+    monkeypatch.setattr(database, "LOG_BACKFILL_CHUNK", 2)
+    monkeypatch.setattr(database, "BACKFILLS", [("logs_structured", 8, failing)])
+    with pytest.raises(RuntimeError):
+        database.init_db()
+    conn = get_db()
+    c = conn.cursor()
+    # Lô đầu đã commit cùng mốc tiến độ, phần còn lại chưa đụng tới
+    assert [r["new_value"] for r in c.execute("SELECT new_value FROM logs ORDER BY id")] == \
+        ["r0", "r1", None, None, None]
+    assert c.execute("SELECT version FROM cache_versions WHERE name = 'backfill:logs_structured'").fetchone()[0] == 2
+    conn.close()
+
+    database.init_db()
+    assert calls == [0, 2, 2, 4, 5]
+    conn = get_db()
+    c = conn.cursor()
+    assert [r["new_value"] for r in c.execute("SELECT new_value FROM logs ORDER BY id")] == \
+        ["r0", "r1", "r2", "r3", "r4"]
+    conn.close()
+    # Đã xong: lần khởi động sau không quét lại
+    database.init_db()
+    assert calls == [0, 2, 2, 4, 5]
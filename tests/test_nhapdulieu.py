@@ -0,0 +1,58 @@
+import io
+
+import nhapdulieu
+import tinhdiem
+from database import get_db
+
+_CSV = (
+    "\ufeffid,name,chuc_vu,xa_1_4,giam_sat_6,tien_khoan_1_2,diem\n"
+    "9,Nguyễn A,Đội phó,2,1,3,999\n"
+    ",Trần B,,1,4,,\n"
+    ",Lê C,Tướng,1,,,\n"
+    ",Phạm D,Thực tập,-1,,,\n"
+    ",Nguyễn A,Đội phó,1,,,\n"
+    ",,,,,,\n"
+    ",,Đội phó,1,,,\n"
+)
+
+
+def _post(client, body=_CSV, name="ds.csv", query=""):
+    return client.post(f"/api/records/import{query}", data={"file": (io.BytesIO(body.encode()), name)})
+
+
+def _records():
+    conn = get_db("TRU")
+    rows = [dict(r) for r in conn.cursor().execute("SELECT * FROM records WHERE so='TRU' ORDER BY id")]
+    conn.close()
+    return rows
+
+
+def test_dry_run_then_import(client, monkeypatch):
+    monkeypatch.setattr(nhapdulieu, "IMPORT_BATCH", 1)
+    dry = _post(client, query="?dry_run=1").get_json()
+    assert dry["dry_run"] and dry["valid"] == 2 and dry["inserted"] == 0
+    assert [e["row"] for e in dry["errors"]] == [4, 5, 6, 8]
+    assert _records() == []
+
+    r = _post(client).get_json()
+    assert r["inserted"] == 2 and r["error_count"] == 4
+    rows = _records()
+    assert [(row["name"], row["chuc_vu"]) for row in rows] == [("Nguyễn A", "Đội phó"), ("Trần B", "Thực tập")]
+    rules = tinhdiem.get_rules("TRU")
+    for row in rows:
+        # Cột dẫn xuất tính theo bộ quy tắc, không lấy cột diem của file
+        expected = tinhdiem.tinh_diem(row, rules)
+        assert {k: row[k] for k in expected} == expected
+    assert rows[1]["giam_sat_6"] == 0  # Thực tập không tính giám sát
+
+    # Nhập lại cùng file: trùng tên trong sở, không tạo bản sao
+    again = _post(client).get_json()
+    assert again["inserted"] == 0 and again["error_count"] == 6
+    assert len(_records()) == 2
+
+
+def test_rejected_files(client):
+    assert _post(client, "ten,chuc_vu\na,Đội phó\n").get_json()["error"] == "Thiếu cột name"
+    assert _post(client, name="ds.txt").status_code == 400
+    assert _post(client, "").status_code == 400
+    assert client.post("/api/records/import").status_code == 400
@@ -0,0 +1,35 @@
+import cache
+import database
+import nhatky
+
+
+def test_count_cache_check_does_not_hold_two_connections(db, monkeypatch):
+    """Kiểm tra version của cache số dòng không được mượn connection khi trang log còn giữ 1 cái."""
+    held, borrowed_while_held = [0], []
+
+    def page_get_db(*args, **kwargs):
+        conn = database.get_db(*args, **kwargs)
+        held[0] += 1
+        close = conn.close
+
+        def closing():
+            held[0] -= 1
+            close()
+
+        conn.close = closing
+        return conn
+
+    def cache_get_db(*args, **kwargs):
+        borrowed_while_held.append(held[0] > 0)
+        return database.get_db(*args, **kwargs)
+
+    monkeypatch.setattr(nhatky, "get_db", page_get_db)
+    monkeypatch.setattr(cache, "get_db", cache_get_db)
+    nhatky._count_cache.clear()
+    # Buộc lần kiểm tra version kế tiếp phải đọc lại cache_versions
+    monkeypatch.setattr(cache, "_versions_checked_at", 0.0)
+
+    page = nhatky._lay_trang("logs", "id", [], key="TRU")
+    assert page["total"] == 0
+    assert borrowed_while_held and not any(borrowed_while_held)
+    assert held[0] == 0
@@ -0,0 +1,86 @@
+import threading
+
+import pytest
+
+import database
+from database import get_db
+
+
+class _FakeConn:
+    """Connection giả cho _PostgresPool: đếm rollback, có thể đánh dấu đã đóng."""
+
+    def __init__(self):
+        self.closed = 0
+        self.rollbacks = 0
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = 1
+
+
+def _pool(max_size=2):
+    opened = []
+
+    def connect():
+        opened.append(_FakeConn())
+        return opened[-1]
+
+    return database._PostgresPool(connect, max_size), opened
+
+
+def test_postgres_pool_reuses_released_connection():
+    pool, opened = _pool()
+    slot = pool.acquire()
+    pool.release(slot)
+    assert pool.acquire() is slot
+    assert len(opened) == 1
+    # Trả về pool luôn rollback phần chưa commit
+    assert opened[0].rollbacks == 1
+
+
+def test_postgres_pool_drops_closed_connection():
+    pool, opened = _pool()
+    slot = pool.acquire()
+    slot.raw.close()
+    pool.release(slot)
+    assert pool.acquire() is not slot
+    assert len(opened) == 2
+
+
+def test_postgres_pool_waits_then_times_out(monkeypatch):
+    monkeypatch.setattr(database, "DB_POOL_TIMEOUT", 0.05)
+    pool, opened = _pool(max_size=1)
+    slot = pool.acquire()
+    with pytest.raises(TimeoutError):
+        pool.acquire()
+
+    # Connection được trả trong lúc chờ thì thread đang chờ nhận luôn
+    monkeypatch.setattr(database, "DB_POOL_TIMEOUT", 5)
+    timer = threading.Timer(0.05, pool.release, (slot,))
+    timer.start()
+    assert pool.acquire() is slot
+    timer.join()
+    assert len(opened) == 1
+
+
+def test_sqlite_get_db_reuses_thread_connection(db):
+    conn = get_db()
+    raw = conn.raw
+    # Lồng nhau trong cùng thread: dùng chung connection (không tự khoá file)
+    inner = get_db()
+    assert inner.raw is raw
+    inner.close()
+    conn.close()
+    assert conn.closed
+    with pytest.raises(RuntimeError):
+        conn.cursor()
+
+    with get_db() as again:
+        assert again.raw is raw
+        again.cursor().execute("INSERT INTO settings(key, value) VALUES('pool_test', '1')")
+    # with: commit khi thành công
+    conn = get_db()
+    assert conn.cursor().execute("SELECT value FROM settings WHERE key='pool_test'").fetchone()[0] == "1"
+    conn.close()
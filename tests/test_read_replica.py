@@ -0,0 +1,98 @@
+import sqlite3
+import time
+
+import pytest
+from flask import session
+
+import app as app_module
+import database
+import hangdoighi
+from conftest import reset_connections
+
+
+def _fake_postgres(tmp_path, monkeypatch, replica_up: bool) -> list:
+    """Giả lập Postgres + replica bằng 2 file SQLite; trả danh sách URL đã mở connection."""
+    opened = []
+
+    def connect(url=None):
+        url = url or database.DATABASE_URL
+        opened.append(url)
+        if url == "replica" and not replica_up:
+            raise OSError("replica down")
+        conn = sqlite3.connect(str(tmp_path / f"{url}.db"), check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    monkeypatch.setattr(database, "DATABASE_URL", "primary")
+    monkeypatch.setattr(database, "DATABASE_READ_URL", "replica")
+    monkeypatch.setattr(database, "READ_REPLICA", True)
+    monkeypatch.setattr(database, "_connect_postgres", connect)
+    monkeypatch.setattr(database, "_replica_lag", 0.0)
+    monkeypatch.setattr(database, "_replica_lag_checked_at", 0.0)
+    monkeypatch.setattr(database, "_replica_down_until", 0.0)
+    monkeypatch.setattr(hangdoighi, "SQLITE_WRITE_QUEUE", False)
+    monkeypatch.setattr(app_module, "READ_REPLICA", True)
+    reset_connections()
+    return opened
+
+
+@pytest.fixture
+def replica_down(tmp_path, monkeypatch):
+    yield _fake_postgres(tmp_path, monkeypatch, replica_up=False)
+    reset_connections()
+
+
+@pytest.fixture
+def replica(tmp_path, monkeypatch):
+    yield _fake_postgres(tmp_path, monkeypatch, replica_up=True)
+    reset_connections()
+
+
+def _reads_replica() -> bool:
+    conn = database.get_db(readonly=True)
+    try:
+        return conn.readonly
+    finally:
+        conn.close()
+
+
+def test_readonly_falls_back_to_primary_when_replica_down(replica_down):
+    conn = database.get_db(readonly=True)
+    try:
+        assert not conn.readonly
+        assert conn.cursor().execute("SELECT 1 AS x").fetchone()["x"] == 1
+    finally:
+        conn.close()
+    assert "replica" in replica_down
+
+    # Trong READ_REPLICA_RETRY giây không thử lại replica
+    tries = replica_down.count("replica")
+    assert not _reads_replica()
+    assert replica_down.count("replica") == tries
+
+
+def test_background_writes_do_not_disable_replica(replica):
+    database.doc_tu_primary(False)
+    # Ghi nền (bộ đệm nhật ký, log đăng nhập, hàng đợi ghi) commit trên primary
+    hangdoighi.ghi(lambda c: c.execute("CREATE TABLE IF NOT EXISTS t(x)"))
+    with database.get_db() as conn:
+        conn.cursor().execute("INSERT INTO t VALUES(1)")
+    assert _reads_replica()
+
+
+def test_session_write_reads_primary(replica):
+    with app_module.app.test_request_context("/api/records"):
+        app_module.route_reads_after_write()
+        assert _reads_replica()
+    with app_module.app.test_request_context("/inline_edit", method="POST"):
+        app_module.route_reads_after_write()
+        assert not _reads_replica()
+    with app_module.app.test_request_context("/api/records"):
+        session["wrote_at"] = time.time()
+        app_module.route_reads_after_write()
+        assert not _reads_replica()
+    with app_module.app.test_request_context("/api/records"):
+        session["wrote_at"] = time.time() - database.read_your_writes_window() - 1
+        app_module.route_reads_after_write()
+        assert _reads_replica()
+    database.doc_tu_primary(False)
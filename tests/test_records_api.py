@@ -0,0 +1,47 @@
+import app as app_module
+import dongbo
+
+
+def _add(client, name, chuc_vu="Cảnh sát viên", **fields):
+    client.post("/dashboard?so=TRU", data={"chuc_vu": chuc_vu, "name": name, **fields})
+
+
+def test_dashboard_shell_and_tab_views(client):
+    _add(client, "Nguyễn Tab", xa_1_4="2", giao_thong="1")
+    _add(client, "Trần Tab", chuc_vu="Thực tập", giao_thong="3", xa_5_6="1")
+
+    # Trang chỉ là khung: dữ liệu do từng tab tự tải
+    assert "Nguyễn Tab" not in client.get("/dashboard").get_data(as_text=True)
+
+    main = client.get("/api/records?view=main").get_json()
+    assert main["success"] and main["so"] == "TRU"
+    assert [set(r) for r in main["rows"]] == [set(app_module.RECORD_VIEWS["main"])] * 2
+    assert main["totals"] == {"giao_thong": 4, "hinh_su": 3, "giam_sat": 0,
+                              "diem": sum(r["diem"] for r in main["rows"])}
+
+    tien = client.get("/api/records?view=tien").get_json()
+    assert set(tien["rows"][0]) == set(app_module.RECORD_VIEWS["tien"])
+    assert tien["totals"] == {"tong_tien": sum(r["tong_tien"] or 0 for r in tien["rows"])}
+
+    assert client.get("/api/records?view=khac").status_code == 400
+
+
+def test_changes_since_version(client, monkeypatch):
+    _add(client, "a")
+    _add(client, "b")
+    base = client.get("/api/records?view=main").get_json()
+    ids = {r["name"]: r["id"] for r in base["rows"]}
+
+    assert client.get(f"/api/records/changes?since={base['version']}").get_json()["changed"] == []
+    client.post("/inline_edit", json={"id": ids["a"], "field": "xa_1_4", "value": "4"})
+    client.get(f"/delete/{ids['b']}")
+
+    delta = client.get(f"/api/records/changes?since={base['version']}").get_json()
+    assert not delta["reset"] and delta["version"] > base["version"]
+    assert [(r["id"], r["xa_1_4"]) for r in delta["changed"]] == [(ids["a"], 4)]
+    assert delta["deleted"] == [ids["b"]]
+
+    # Quá nhiều thay đổi (hoặc since quá cũ) -> client tải lại cả bảng
+    monkeypatch.setattr(dongbo, "CHANGES_MAX", 0)
+    assert client.get(f"/api/records/changes?since={base['version']}").get_json()["reset"]
+    assert client.get("/api/records/changes?since=x").status_code == 400
@@ -0,0 +1,70 @@
+import sys
+import threading
+import time
+
+import cache
+
+
+def test_dict_backend_lru_and_ttl(monkeypatch):
+    b = cache.DictBackend(max_size=2)
+    b.set("a", 1, 60)
+    b.set("b", 2, 60)
+    assert b.get("a") == 1
+    b.set("c", 3, 60)
+    # "b" lâu không dùng nhất -> bị bỏ
+    assert (b.get("a"), b.get("b"), b.get("c")) == (1, None, 3)
+    b.set("d", 4, 0)
+    assert b.get("d") is None
+
+
+def test_sqlite_backend_shared_between_instances(tmp_path, monkeypatch):
+    path = str(tmp_path / "cache" / "result.db")
+    monkeypatch.setattr(cache.SqliteBackend, "_EVICT_EVERY", 1)
+    writer, reader = cache.SqliteBackend(path, max_size=2), cache.SqliteBackend(path, max_size=2)
+    writer.set("k1", {"rows": [1, "á"]}, 60)
+    assert reader.get("k1") == {"rows": [1, "á"]}
+    writer.set("k2", 2, 60)
+    time.sleep(0.01)
+    reader.get("k1")
+    writer.set("k3", 3, 60)
+    assert (reader.get("k1"), reader.get("k2"), reader.get("k3")) == ({"rows": [1, "á"]}, None, 3)
+    writer.set("old", 1, -1)
+    assert reader.get("old") is None
+
+
+def test_redis_backend_falls_back_without_package(monkeypatch):
+    monkeypatch.setitem(sys.modules, "redis", None)
+    assert isinstance(cache.make_backend("redis"), cache.DictBackend)
+    assert isinstance(cache.make_backend("khac"), cache.DictBackend)
+
+
+def test_result_cache_reloads_on_new_version():
+    rc = cache.ResultCache("t", ttl=60, backend=cache.DictBackend())
+    calls = []
+
+    def load(v):
+        calls.append(v)
+        return {"v": v}
+
+    assert rc.get_or_load(["x", 1], [1, 2], lambda: load(1)) == {"v": 1}
+    assert rc.get_or_load(["x", 1], (1, 2), lambda: load(2)) == {"v": 1}
+    assert rc.get_or_load(["x", 1], [1, 3], lambda: load(3)) == {"v": 3}
+    assert calls == [1, 3]
+
+
+def test_result_cache_creates_one_backend(monkeypatch):
+    made = []
+
+    def slow_backend():
+        time.sleep(0.01)
+        made.append(cache.DictBackend())
+        return made[-1]
+
+    monkeypatch.setattr(cache, "make_backend", slow_backend)
+    rc = cache.ResultCache("t", ttl=60)
+    threads = [threading.Thread(target=rc.get_or_load, args=(i, 0, lambda: 0)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(made) == 1
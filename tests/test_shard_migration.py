@@ -0,0 +1,53 @@
+import database
+from conftest import reset_connections, use_dir
+from database import get_db
+
+
+def _rows(key, sql, params=()):
+    conn = get_db(key)
+    rows = [dict(r) for r in conn.cursor().execute(sql, params).fetchall()]
+    conn.close()
+    return rows
+
+
+def _legacy_db(tmp_path, monkeypatch):
+    """database.db kiểu cũ (1 file): records + log theo sở và log quản trị không có so."""
+    use_dir(tmp_path, monkeypatch)
+    monkeypatch.setattr(database, "SQLITE_SHARDING", False)
+    database.init_db()
+    with get_db() as conn:
+        c = conn.cursor()
+        c.executemany(
+            "INSERT INTO records(so, name) VALUES(?, ?)",
+            [("TRU", "a"), ("LS", "b"), (None, "c")],
+        )
+        c.executemany(
+            "INSERT INTO logs(action, so, created_at) VALUES(?, ?, ?)",
+            [
+                ("ADD", "TRU", "2026-01-01 00:00:00"),
+                ("ADD", "LS", "2026-01-01 00:00:01"),
+                ("CREATE_ACCOUNT", None, "2026-01-01 00:00:02"),
+                ("EDIT_ROLE", None, "2026-01-01 00:00:03"),
+            ],
+        )
+    reset_connections()
+    monkeypatch.setattr(database, "SQLITE_SHARDING", True)
+
+
+def test_move_to_shard_keeps_unowned_logs_in_catalog(tmp_path, monkeypatch):
+    _legacy_db(tmp_path, monkeypatch)
+    database.init_db()
+
+    assert sorted(r["action"] for r in _rows(None, "SELECT action FROM logs")) == ["CREATE_ACCOUNT", "EDIT_ROLE"]
+    assert _rows("TRU", "SELECT action, so FROM logs") == [{"action": "ADD", "so": "TRU"}]
+    assert _rows("LS", "SELECT action, so FROM logs") == [{"action": "ADD", "so": "LS"}]
+    # records không có so vẫn là của TRU
+    assert sorted(r["name"] for r in _rows("TRU", "SELECT name FROM records")) == ["a", "c"]
+    assert _rows(None, "SELECT COUNT(1) AS n FROM records") == [{"n": 0}]
+
+    # Chạy lại init_db không chuyển / xoá thêm gì
+    reset_connections()
+    database.init_db()
+    assert len(_rows(None, "SELECT id FROM logs")) == 2
+    assert len(_rows("TRU", "SELECT id FROM logs")) == 1
+
@@ -0,0 +1,79 @@
+from datetime import datetime
+
+import thongke
+from database import get_db
+
+
+def _table(so, sql):
+    conn = get_db(so)
+    rows = sorted(tuple(r) for r in conn.cursor().execute(sql))
+    conn.close()
+    return rows
+
+
+def test_monthly_rollup_follows_writes(db):
+    now = datetime.now()
+    this_month = now.strftime("%Y-%m-15 08:00:00")
+    jan = f"{now.year}-01-10 08:00:00"
+    with get_db("TRU") as conn:
+        c = conn.cursor()
+        c.executemany(
+            "INSERT INTO records(so, name, chuc_vu, tong_an, diem, tong_tien, created_at) VALUES('TRU', ?, ?, ?, ?, ?, ?)",
+            [("a", "Đội phó", 3, 6, 1000, jan), ("b", "Thực tập", 2, 4, 0, this_month),
+             ("c", "Thực tập", 5, 1, 0, this_month)],
+        )
+        c.execute("UPDATE records SET tong_an = 7 WHERE name = 'b'")
+        c.execute("DELETE FROM records WHERE name = 'c'")
+
+    sql = "SELECT so, nam, thang, tong_an, tong_diem, tong_tien, so_luong FROM records_monthly"
+    maintained = _table("TRU", sql)
+    with get_db("TRU") as conn:
+        thongke.rebuild_records_monthly(conn.cursor(), "TRU")
+    assert maintained == _table("TRU", sql)
+
+    months = thongke.thong_ke_theo_thang(now.year, "TRU")
+    assert len(months) == now.month
+    assert months[0]["value"] == 3 + (7 if now.month == 1 else 0)
+    assert months[-1]["value"] == 7 + (3 if now.month == 1 else 0)
+
+
+def _version(name):
+    conn = get_db(name.split(":")[1])
+    row = conn.cursor().execute("SELECT version FROM cache_versions WHERE name = ?", (name,)).fetchone()
+    conn.close()
+    return row[0] if row else 0
+
+
+def test_leaderboard_follows_writes(db):
+    for so, rows in (("TRU", [("a", "Đội phó", 5), ("b", "Thực tập", 9), ("a", "Đội phó", 2)]),
+                     ("LS", [("a", "Đội phó", 4), ("c", "Cảnh sát viên", 6)])):
+        with get_db(so) as conn:
+            conn.cursor().executemany(
+                "INSERT INTO records(so, name, chuc_vu, diem) VALUES(?, ?, ?, ?)", [(so, *r) for r in rows]
+            )
+
+    assert thongke.top_nguoi_diem_cao(2, "TRU") == [{"name": "b", "score": 9}, {"name": "a", "score": 7}]
+    # ALL cộng dồn qua các sở; lọc theo chức vụ
+    assert thongke.top_nguoi_diem_cao(3) == [{"name": "a", "score": 11}, {"name": "b", "score": 9},
+                                             {"name": "c", "score": 6}]
+    assert thongke.top_nguoi_diem_cao(3, chuc_vu=["Cảnh sát viên", "Thực tập"]) == [
+        {"name": "b", "score": 9}, {"name": "c", "score": 6}]
+
+    # Đổi cột không liên quan: không bump version; đổi điểm / chức vụ: bump
+    before = _version("leaderboard:TRU")
+    with get_db("TRU") as conn:
+        conn.cursor().execute("UPDATE records SET tong_tien = 1 WHERE name = 'b'")
+    assert _version("leaderboard:TRU") == before
+    with get_db("TRU") as conn:
+        c = conn.cursor()
+        c.execute("UPDATE records SET diem = 1 WHERE name = 'b'")
+        c.execute("UPDATE records SET chuc_vu = 'Thực tập' WHERE name = 'a' AND diem = 2")
+    assert _version("leaderboard:TRU") > before
+    assert thongke.top_nguoi_diem_cao(3, "TRU", chuc_vu=["Thực tập"]) == [
+        {"name": "a", "score": 2}, {"name": "b", "score": 1}]
+
+    sql = "SELECT so, name, chuc_vu, tong_diem, so_luong FROM records_leaderboard"
+    maintained = _table("TRU", sql)
+    with get_db("TRU") as conn:
+        thongke.rebuild_records_leaderboard(conn.cursor(), "TRU")
+    assert maintained == _table("TRU", sql)
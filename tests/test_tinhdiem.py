@@ -0,0 +1,56 @@
+import copy
+
+import tinhdiem
+from database import get_db
+
+_INPUT = tinhdiem.DIEM_FIELDS + tinhdiem.TIEN_FIELDS
+_DERIVED = ("giam_sat_1_5", "giam_sat_6", "giam_sat", "tong_an", "diem", "tong_tien")
+
+
+def _insert(so, rows):
+    with get_db(so) as conn:
+        conn.cursor().executemany(
+            f"INSERT INTO records(so, name, chuc_vu, {', '.join(_INPUT)}) "
+            f"VALUES(?, ?, ?, {', '.join('?' for _ in _INPUT)})",
+            [(so, f"n{i}", cv, *values) for i, (cv, values) in enumerate(rows)],
+        )
+
+
+def _rows(so):
+    conn = get_db(so)
+    rows = [dict(r) for r in conn.cursor().execute("SELECT * FROM records WHERE so=? ORDER BY id", (so,))]
+    conn.close()
+    return rows
+
+
+def test_rescore_sql_matches_python_scoring(client):
+    rules = copy.deepcopy(tinhdiem.DEFAULT_RULES)
+    rules["diem"]["Đội phó"] = {"xa_1_4": 3, "giam_sat_6": 1, "an_sai": -2}
+    rules["tien"]["tien_khoan_1_2"] = 5000
+    _insert("TRU", [
+        ("Thực tập", (1, 2, 3, 4, 5, 1, 1, 1, 1)),
+        ("Cảnh sát viên", (0, 2, 1, 3, 2, 0, 2, 0, 1)),
+        ("Đội phó", (0, 4, 0, 1, 7, 2, 0, 3, 0)),
+    ])
+    _insert("LS", [("Đội phó", (0, 4, 0, 1, 7, 2, 0, 3, 0))])
+
+    r = client.post("/api/scoring", json={"so": "TRU", "rules": rules, "rescore": True}).get_json()
+    assert r["success"] and r["affected"] == 3
+    assert tinhdiem.get_active_rules("TRU")["so"] == "TRU"
+    for row in _rows("TRU"):
+        expected = tinhdiem.tinh_diem(row, rules)
+        assert {k: row[k] for k in _DERIVED} == expected
+    # Sở khác vẫn dùng bộ mặc định (ALL)
+    assert tinhdiem.get_active_rules("LS")["version"] == 0
+    ls = _rows("LS")[0]
+    assert ls["diem"] in (None, 0)
+
+
+def test_invalid_rules_rejected(client):
+    bad = copy.deepcopy(tinhdiem.DEFAULT_RULES)
+    bad["diem"]["*"]["xa_1_4"] = 1.5
+    r = client.post("/api/scoring", json={"so": "TRU", "rules": bad})
+    assert r.status_code == 400
+    del bad["diem"]["*"]
+    assert client.post("/api/scoring", json={"so": "TRU", "rules": bad}).status_code == 400
+    assert tinhdiem.get_active_rules("TRU")["version"] == 0
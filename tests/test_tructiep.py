@@ -0,0 +1,56 @@
+import pytest
+
+import tructiep
+from database import get_db
+
+
+@pytest.fixture
+def hub(monkeypatch):
+    """Không chạy thread hub thật; test tự gọi _check_versions."""
+    monkeypatch.setattr(tructiep, "_ensure_hub", lambda: None)
+    monkeypatch.setattr(tructiep, "_subscribers", {})
+    return {}
+
+
+def _drain(q) -> list:
+    items = []
+    while not q.empty():
+        items.append(q.get_nowait()[0])
+    return items
+
+
+def test_version_change_fans_out_to_subscribers_of_that_so(db, hub):
+    tru_a, tru_b, ls = tructiep.subscribe("TRU"), tructiep.subscribe("TRU"), tructiep.subscribe("LS")
+    tructiep._check_versions(hub)
+    assert _drain(tru_a) == []
+
+    with get_db("TRU") as conn:
+        conn.cursor().execute("INSERT INTO records(so, name, chuc_vu, diem) VALUES('TRU', 'a', 'Đội phó', 3)")
+    tructiep._check_versions(hub)
+    assert _drain(tru_a) == ["records", "thongke", "top"]
+    assert _drain(tru_b) == ["records", "thongke", "top"]
+    assert _drain(ls) == []
+
+    tructiep.unsubscribe("TRU", tru_b)
+    with get_db("TRU") as conn:
+        conn.cursor().execute("UPDATE records SET tong_tien = 5")
+    tructiep._check_versions(hub)
+    assert _drain(tru_a) == ["records", "thongke"]
+    assert _drain(tru_b) == []
+
+
+def test_connection_cap_and_stream_cleanup(client, hub, monkeypatch):
+    monkeypatch.setattr(tructiep, "SSE_MAX_CONNECTIONS", 1)
+    q = tructiep.subscribe("LS")
+    r = client.get("/api/stream")
+    assert r.status_code == 503 and r.headers["Retry-After"] == "60"
+
+    stream = tructiep.stream("LS", q)
+    assert next(stream).startswith("retry:")
+    assert next(stream).startswith("event: hello")
+    q.put_nowait(("records", {"version": 2}))
+    assert next(stream) == 'event: records\ndata: {"version": 2}\n\n'
+    # Client ngắt: generator đóng thì hủy đăng ký, chỗ trống dùng lại được
+    stream.close()
+    assert tructiep._connection_count() == 0
+    assert tructiep.subscribe("TRU") is not None
@@ -0,0 +1,65 @@
+import io
+from contextlib import contextmanager
+
+import hangdoighi
+from database import get_db
+
+
+def _spy(monkeypatch) -> list:
+    """Ghi lại các lần app gửi job vào hàng đợi ghi (vẫn chạy job thật)."""
+    calls = []
+    ghi = hangdoighi.ghi
+
+    def spy(job, so=None, **kwargs):
+        calls.append(so)
+        return ghi(job, so, **kwargs)
+
+    monkeypatch.setattr(hangdoighi, "ghi", spy)
+    return calls
+
+
+@contextmanager
+def _queued(calls, so="TRU"):
+    start = len(calls)
+    yield
+    assert so in calls[start:], calls[start:]
+
+
+def _count(sql="SELECT COUNT(1) AS n FROM records"):
+    conn = get_db("TRU")
+    n = conn.cursor().execute(sql).fetchone()["n"]
+    conn.close()
+    return n
+
+
+def test_write_endpoints_go_through_queue(client, monkeypatch):
+    client.post("/dashboard?so=TRU", data={"chuc_vu": "Cảnh sát viên", "name": "a", "xa_1_4": "2"})
+    calls = _spy(monkeypatch)
+
+    csv = "name,chuc_vu,xa_1_4\nb,Cảnh sát viên,1\na,Cảnh sát viên,1\n"
+    with _queued(calls):
+        r = client.post("/api/records/import", data={"file": (io.BytesIO(csv.encode()), "x.csv")}).get_json()
+    assert r["inserted"] == 1 and r["error_count"] == 1
+
+    rid = _count("SELECT id AS n FROM records WHERE name='b'")
+    with _queued(calls):
+        r = client.post("/api/records/batch_edit", json={"edits": [{"id": rid, "field": "xa_1_4", "value": 5},
+                                                                   {"id": 999999, "field": "xa_1_4", "value": 1}]})
+    body = r.get_json()
+    assert body["success"] and body["rows"][0]["xa_1_4"] == 5
+    assert [e["id"] for e in body["errors"]] == [999999]
+
+    with _queued(calls):
+        assert client.post("/api/scoring/rescore").get_json()["affected"] == 2
+    with _queued(calls):
+        assert client.post("/api/main/reset_scores").get_json()["affected"] == 2
+    assert _count("SELECT SUM(xa_1_4) AS n FROM records") == 0
+    with _queued(calls, None):
+        client.post("/api/settings/monthly_title", json={"title": "T", "so": "TRU"})
+
+    with _queued(calls):
+        client.get(f"/delete/{rid}")
+    assert _count() == 1
+    with _queued(calls):
+        assert client.post("/api/main/reset_all").get_json()["affected"] == 1
+    assert _count() == 0
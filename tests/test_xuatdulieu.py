@@ -0,0 +1,59 @@
+import gzip
+import json
+
+import nhatky
+import xuatdulieu
+
+
+def _add(client, name, so="TRU"):
+    client.post(f"/dashboard?so={so}", data={"chuc_vu": "Cảnh sát viên", "name": name, "xa_1_4": "1"})
+
+
+def test_records_csv_and_gzip_ndjson(client):
+    _add(client, "Nguyễn A")
+    _add(client, "Trần B")
+    _add(client, "Lê C", so="LS")
+    client.get("/dashboard?so=TRU")
+
+    r = client.get("/api/export/records?format=csv")
+    assert r.status_code == 200 and r.mimetype == "text/csv"
+    lines = r.get_data(as_text=True).splitlines()
+    assert lines[0].startswith("\ufeffid,so,chuc_vu,name")
+    assert [line.split(",")[3] for line in lines[1:]] == ["Nguyễn A", "Trần B"]
+
+    r = client.get("/api/export/records?format=ndjson&so=LS", headers={"Accept-Encoding": "gzip"})
+    assert r.headers["Content-Encoding"] == "gzip"
+    rows = [json.loads(line) for line in gzip.decompress(r.get_data()).decode().splitlines()]
+    assert [(row["so"], row["name"]) for row in rows] == [("LS", "Lê C")]
+
+    assert client.get("/api/export/records?format=pdf").status_code == 400
+    assert client.get("/api/export/khac").status_code == 404
+
+
+def test_export_streams_from_readonly_connections(client, monkeypatch):
+    nhatky.them_nhat_ky("ADD", None, "admin", "Thêm record: a", so="TRU")
+    nhatky.them_nhat_ky("ADD", None, "admin", "Thêm record: b", so="LS")
+    nhatky.them_nhat_ky("CREATE_ACCOUNT", None, "admin", "Tạo tài khoản x")
+    opened = []
+    get_db = xuatdulieu.get_db
+
+    def spy(key=None, readonly=False):
+        opened.append((key, readonly))
+        return get_db(key, readonly=readonly)
+
+    monkeypatch.setattr(xuatdulieu, "get_db", spy)
+    monkeypatch.setattr(xuatdulieu, "EXPORT_CHUNK", 1)
+
+    chunks, mimetype, name = xuatdulieu.xuat("logs", "ndjson")
+    assert opened == []  # chưa đọc gì cho tới khi response chạy generator
+    parts = list(chunks)
+    assert len(parts) == 3 and name == "logs.ndjson"
+    assert sorted(json.loads(p)["action"] for p in parts) == ["ADD", "ADD", "CREATE_ACCOUNT"]
+    # Logs không lọc sở: đọc lần lượt mọi file DB, luôn bằng connection chỉ đọc
+    assert sorted(opened, key=str) == sorted(((k, True) for k in xuatdulieu.db_keys()), key=str)
+
+
+def test_xlsx_needs_openpyxl(client, monkeypatch):
+    monkeypatch.setattr(xuatdulieu, "xlsx_supported", lambda: False)
+    r = client.get("/api/export/records?format=xlsx")
+    assert r.status_code == 400 and "openpyxl" in r.get_json()["error"]
@@ -1,134 +1,221 @@
 # thongke.py
+import heapq
 from datetime import datetime
-from database import get_db, is_postgres
 
+from cache import ResultCache, read_versions
+from database import fan_out, get_db, is_postgres
 
-def thong_ke_theo_thang(nam=None, so=None):
-    if not nam:
-        nam = datetime.now().year
+ALL_SO = ("TRU", "LS", "PS")
+# Kết quả thống kê / top theo tham số + version records:<sở> / leaderboard:<sở>
+_thongke_cache = ResultCache("thongke")
+_top_cache = ResultCache("top")
 
-    conn = get_db()
-    c = conn.cursor()
 
+def rebuild_records_monthly(c, so=None):
+    """
+    Tính lại bảng tổng hợp records_monthly từ records (1 sở hoặc tất cả).
+    Dùng khi nghi ngờ lệch số liệu (`python thongke.py rebuild`). Caller tự commit.
+    """
     if is_postgres():
-        if so in ("TRU", "LS", "PS"):
-            c.execute(
-                """
-                SELECT
-                    LPAD(EXTRACT(MONTH FROM created_at)::text, 2, '0') AS thang,
-                    SUM(tong_an) AS tong_ps
-                FROM records
-                WHERE EXTRACT(YEAR FROM created_at) = ?
-                  AND so = ?
-                GROUP BY thang
-                ORDER BY thang
-                """,
-                (int(nam), so),
-            )
-        else:
-            c.execute(
-                """
-                SELECT
-                    LPAD(EXTRACT(MONTH FROM created_at)::text, 2, '0') AS thang,
-                    SUM(tong_an) AS tong_ps
-                FROM records
-                WHERE EXTRACT(YEAR FROM created_at) = ?
-                GROUP BY thang
-                ORDER BY thang
-                """,
-                (int(nam),),
-            )
+        nam_sql = "COALESCE(EXTRACT(YEAR FROM created_at)::int, 0)"
+        thang_sql = "COALESCE(EXTRACT(MONTH FROM created_at)::int, 0)"
     else:
-        if so in ("TRU", "LS", "PS"):
-            c.execute(
-                """
-                SELECT
-                    strftime('%m', created_at) AS thang,
-                    SUM(tong_an) AS tong_ps
-                FROM records
-                WHERE strftime('%Y', created_at) = ?
-                  AND so = ?
-                GROUP BY thang
-                ORDER BY thang
-                """,
-                (str(nam), so),
-            )
-        else:
-            c.execute(
-                """
-                SELECT
-                    strftime('%m', created_at) AS thang,
-                    SUM(tong_an) AS tong_ps
-                FROM records
-                WHERE strftime('%Y', created_at) = ?
-                GROUP BY thang
-                ORDER BY thang
-                """,
-                (str(nam),),
-            )
+        nam_sql = "COALESCE(CAST(strftime('%Y', created_at) AS INTEGER), 0)"
+        thang_sql = "COALESCE(CAST(strftime('%m', created_at) AS INTEGER), 0)"
 
-    rows = c.fetchall()
+    where = ""
+    params = ()
+    if so:
+        where = "WHERE COALESCE(so, 'TRU') = ?"
+        params = (so,)
+        c.execute("DELETE FROM records_monthly WHERE so = ?", params)
+    else:
+        c.execute("DELETE FROM records_monthly")
+    c.execute(
+        f"""
+        INSERT INTO records_monthly(so, nam, thang, tong_an, tong_diem, tong_tien, so_luong)
+        SELECT
+            COALESCE(so, 'TRU'),
+            {nam_sql},
+            {thang_sql},
+            COALESCE(SUM(tong_an), 0),
+            COALESCE(SUM(diem), 0),
+            COALESCE(SUM(tong_tien), 0),
+            COUNT(1)
+        FROM records
+        {where}
+        GROUP BY 1, 2, 3
+        """,
+        params,
+    )
+
+
+def thong_ke_theo_thang(nam=None, so=None, version=None):
+    """
+    Tổng hồ sơ án theo tháng của 1 năm, đọc từ bảng tổng hợp records_monthly
+    (tối đa 12 dòng / sở, không quét records). Tháng đã chốt lấy từ records_closes.
+    Kết quả cache theo version records + closes của sở; truyền `version` nếu đã đọc sẵn (vd. khi làm ETag).
+    """
+    if not nam:
+        nam = datetime.now().year
+    so_list = [so] if so in ALL_SO else list(ALL_SO)
+    if version is None:
+        keys = [f"records:{s}" for s in so_list] + [f"closes:{s}" for s in so_list]
+        version = list(read_versions(keys).values())
+    key = [so if so in ALL_SO else "ALL", int(nam), datetime.now().month]
+    return _thongke_cache.get_or_load(key, version, lambda: _thong_ke_theo_thang(nam, so))
+
+
+def _doc_thang(so):
+    conn = get_db(so, readonly=True)
+    c = conn.cursor()
+    c.execute("SELECT so, nam, thang, tong_an FROM records_monthly WHERE so = ?", (so,))
+    monthly = c.fetchall()
+    c.execute("SELECT so, nam, thang, tong_an FROM records_closes WHERE so = ?", (so,))
+    closes = c.fetchall()
+    c.execute("SELECT so, nam, thang, tong_an FROM records_monthly_frozen WHERE so = ?", (so,))
+    frozen = c.fetchall()
     conn.close()
+    return monthly, closes, frozen
+
+
+def _thong_ke_theo_thang(nam, so):
+    so_list = [so] if so in ALL_SO else list(ALL_SO)
+    # Mỗi sở đọc từ file của sở đó (shard SQLite: song song)
+    parts = fan_out(_doc_thang, so_list)
+    monthly = [row for rows, _, _ in parts for row in rows]
+    closes = [row for _, rows, _ in parts for row in rows]
+    frozen = [row for _, _, rows in parts for row in rows]
 
-    result = []
     # Lấy tháng hiện tại
-    current_month = datetime.now().month
-    
+    now = datetime.now()
+    current_month = now.month
+
+    # Sở đã từng chốt: tháng đã chốt lấy tổng hợp lúc chốt, tháng hiện tại = số liệu đang chạy
+    # (mọi dòng records, vì đã reset ở lần chốt trước), tháng từ lần chốt đầu về sau chưa chốt = 0.
+    # Tháng trước lần chốt đầu tiên giữ cách tính cũ (records_monthly theo created_at), đọc từ bản sao
+    # lúc chốt lần đầu (records_monthly_frozen) vì chốt đưa records về 0 làm trigger trừ ngược các tháng đó.
+    closed = {}
+    first_close = {}
+    for row in closes:
+        k = (int(row["nam"]), int(row["thang"]))
+        closed[(row["so"], *k)] = int(row["tong_an"] or 0)
+        first_close[row["so"]] = min(first_close.get(row["so"], k), k)
+    live = {}
+    for row in monthly:
+        live[row["so"]] = live.get(row["so"], 0) + int(row["tong_an"] or 0)
+    frozen_so = {row["so"] for row in frozen}
+    by_month = {}
+    for row in frozen + [r for r in monthly if r["so"] not in frozen_so]:
+        if int(row["nam"] or 0) == int(nam):
+            k = (row["so"], int(row["thang"] or 0))
+            by_month[k] = by_month.get(k, 0) + int(row["tong_an"] or 0)
+
     # Tạo dữ liệu từ tháng 1 đến tháng hiện tại
-    months_data = {}
-    for i in range(1, current_month + 1):
-        months_data[str(i).zfill(2)] = 0
-    
-    for row in rows:
-        thang = row['thang'] if hasattr(row, 'keys') else row[0]
-        ps = row['tong_ps'] if hasattr(row, 'keys') else row[1]
-        if thang and thang in months_data:
-            months_data[thang] = ps or 0
-    
-    for thang in sorted(months_data.keys()):
+    result = []
+    for thang in range(1, current_month + 1):
+        value = 0
+        for s in so_list:
+            if (s, int(nam), thang) in closed:
+                value += closed[(s, int(nam), thang)]
+            elif s not in first_close or (int(nam), thang) < first_close[s]:
+                value += by_month.get((s, thang), 0)
+            elif (int(nam), thang) == (now.year, now.month):
+                value += live.get(s, 0)
         result.append({
-            "month": f"Tháng {int(thang)}",
-            "value": months_data[thang]
+            "month": f"Tháng {thang}",
+            "value": value
         })
 
     return result
 
 
-def top_nguoi_diem_cao(limit=3, so=None):
-    conn = get_db()
-    c = conn.cursor()
-
-    if so in ("TRU", "LS", "PS"):
-        c.execute(
-            """
-            SELECT name, SUM(diem) AS tong_diem
-            FROM records
-            WHERE so = ?
-            GROUP BY name
-            ORDER BY tong_diem DESC
-            LIMIT ?
-            """,
-            (so, limit),
-        )
+def rebuild_records_leaderboard(c, so=None):
+    """
+    Tính lại bảng records_leaderboard (tổng điểm theo sở/tên/chức vụ) từ records.
+    Caller tự commit.
+    """
+    where = ""
+    params = ()
+    if so:
+        where = "WHERE COALESCE(so, 'TRU') = ?"
+        params = (so,)
+        c.execute("DELETE FROM records_leaderboard WHERE so = ?", params)
     else:
-        c.execute(
-            """
-            SELECT name, SUM(diem) AS tong_diem
-            FROM records
-            GROUP BY name
-            ORDER BY tong_diem DESC
-            LIMIT ?
-            """,
-            (limit,),
-        )
+        c.execute("DELETE FROM records_leaderboard")
+    c.execute(
+        f"""
+        INSERT INTO records_leaderboard(so, name, chuc_vu, tong_diem, so_luong)
+        SELECT
+            COALESCE(so, 'TRU'),
+            COALESCE(name, ''),
+            COALESCE(chuc_vu, ''),
+            COALESCE(SUM(diem), 0),
+            COUNT(1)
+        FROM records
+        {where}
+        GROUP BY 1, 2, 3
+        """,
+        params,
+    )
+
+
+# Số người tối đa trả về cho 1 lần xem bảng xếp hạng
+TOP_LIMIT_MAX = 50
+
 
+def _doc_leaderboard(so):
+    conn = get_db(so, readonly=True)
+    c = conn.cursor()
+    c.execute("SELECT name, chuc_vu, tong_diem FROM records_leaderboard WHERE so = ?", (so,))
     rows = c.fetchall()
     conn.close()
+    return rows
 
-    result = []
-    for row in rows:
-        name = row['name'] if hasattr(row, 'keys') else row[0]
-        score = row['tong_diem'] if hasattr(row, 'keys') else row[1]
-        result.append({"name": name, "score": score or 0})
-    
-    return result
+
+def _load_leaderboard(so_list, chuc_vu):
+    totals = {}
+    for r in (row for rows in fan_out(_doc_leaderboard, so_list) for row in rows):
+        if chuc_vu is not None and r["chuc_vu"] not in chuc_vu:
+            continue
+        totals[r["name"]] = totals.get(r["name"], 0) + int(r["tong_diem"] or 0)
+    return totals
+
+
+def top_nguoi_diem_cao(limit=3, so=None, chuc_vu=None, version=None):
+    """
+    Top `limit` người điểm cao nhất (có thể lọc theo danh sách chức vụ).
+    Đọc tổng điểm từng người trong records_leaderboard (số dòng = số người, không quét records);
+    kết quả cache theo version leaderboard của sở (trigger bump khi điểm / tên / chức vụ đổi).
+    """
+    limit = max(1, min(int(limit or 3), TOP_LIMIT_MAX))
+    so_list = [so] if so in ALL_SO else list(ALL_SO)
+    chuc_vu = sorted(set(chuc_vu)) if chuc_vu else None
+    if version is None:
+        version = list(read_versions([f"leaderboard:{s}" for s in so_list]).values())
+
+    def load():
+        totals = _load_leaderboard(so_list, set(chuc_vu) if chuc_vu else None)
+        top = heapq.nsmallest(limit, totals.items(), key=lambda kv: (-kv[1], kv[0]))
+        return [{"name": name, "score": score} for name, score in top]
+
+    key = [so if so in ALL_SO else "ALL", limit, chuc_vu]
+    return _top_cache.get_or_load(key, version, load)
+
+
+if __name__ == "__main__":
+    # python thongke.py rebuild [TRU|LS|PS]  -> tính lại bảng records_monthly + records_leaderboard
+    import sys
+
+    if len(sys.argv) >= 2 and sys.argv[1] == "rebuild":
+        target_so = sys.argv[2].strip().upper() if len(sys.argv) >= 3 else None
+        for s in [target_so] if target_so else ALL_SO:
+            # Ghi thẳng, không qua hangdoighi: hàng đợi ghi chỉ tuần tự hoá trong 1 process, lệnh CLI
+            # chạy ở process riêng nên chỉ dựa vào khoá file SQLite (busy_timeout) như mọi process khác
+            with get_db(s) as conn:
+                c = conn.cursor()
+                rebuild_records_monthly(c, s)
+                rebuild_records_leaderboard(c, s)
+        print(f"Đã tính lại records_monthly, records_leaderboard ({target_so or 'ALL'})")
+    else:
+        print("Cách dùng: python thongke.py rebuild [TRU|LS|PS]")
@@ -0,0 +1,244 @@
+# tinhdiem.py
+"""
+Công thức tính điểm / tiền xử án.
+
+Bộ quy tắc (rules) là dữ liệu, lưu theo version trong bảng scoring_rules
+(mỗi sở TRU/LS/PS có thể có bộ riêng, "ALL" là bộ dùng chung).
+Cùng 1 bộ quy tắc dùng cho:
+- tinh_diem(): tính trong Python (thêm record mới)
+- recompute_set_sql(): phần SET của câu UPDATE (inline edit, sửa hàng loạt)
+- rescore(): tính lại toàn bộ records của 1 sở bằng 1 câu UPDATE
+"""
+import copy
+import datetime
+import json
+import os
+import re
+
+from cache import TTLCache, bump_version
+from database import get_db
+
+CHUC_VU_OPTIONS = ("Thực tập", "Cảnh sát viên", "Sĩ quan dự bị", "Đội phó")
+
+# Các cột số nhập tay (dùng để tính điểm / tiền)
+DIEM_FIELDS = ("giao_thong", "xa_1_4", "xa_5_6", "giam_sat_1_5", "giam_sat_6", "an_sai")
+TIEN_FIELDS = ("tien_khoan_1_2", "tien_khoan_3_5", "tien_khoan_6_truy_na")
+# Các cột recompute_set_sql() gán lại (giám sát bị ép 0 theo chức vụ nên cũng nằm trong đây)
+RECOMPUTED_FIELDS = ("giam_sat_1_5", "giam_sat_6", "giam_sat", "tong_an", "diem", "tong_tien")
+
+# Bộ quy tắc mặc định (version 0):
+# - Thực tập: giao thông +1, án 1-5 +2, án 6 +4, giám sát không tính (ép = 0)
+# - Cảnh sát viên / Sĩ quan dự bị / Đội phó ("*"): án 1-5 +2, án 6 +4, giám sát 1-5 +2, giám sát 6 +6
+# - Án sai: -5 điểm
+# - Tiền xử án: 1-2 (3.000) + 3-5 (6.000) + 6 & truy nã đỏ (10.000)
+DEFAULT_RULES = {
+    "diem": {
+        "Thực tập": {"giao_thong": 1, "xa_1_4": 2, "xa_5_6": 4, "an_sai": -5},
+        "*": {"xa_1_4": 2, "xa_5_6": 4, "giam_sat_1_5": 2, "giam_sat_6": 6, "an_sai": -5},
+    },
+    "khong_giam_sat": ["Thực tập"],
+    "tien": {"tien_khoan_1_2": 3000, "tien_khoan_3_5": 6000, "tien_khoan_6_truy_na": 10000},
+}
+
+SCORING_CACHE_TTL = float(os.environ.get("SCORING_CACHE_TTL", "300") or 300)
+_rules_cache = TTLCache("scoring", SCORING_CACHE_TTL, max_size=16)
+
+
+def validate_rules(rules) -> dict:
+    """Kiểm tra bộ quy tắc, trả bản chuẩn hoá. Sai thì raise ValueError."""
+    if not isinstance(rules, dict):
+        raise ValueError("Bộ quy tắc phải là object")
+    diem = rules.get("diem")
+    if not isinstance(diem, dict) or "*" not in diem:
+        raise ValueError("Thiếu quy tắc điểm mặc định ('*')")
+    out = {"diem": {}, "khong_giam_sat": [], "tien": {}}
+    for chuc_vu, weights in diem.items():
+        if chuc_vu != "*" and chuc_vu not in CHUC_VU_OPTIONS:
+            raise ValueError(f"Chức vụ không hợp lệ: {chuc_vu}")
+        if not isinstance(weights, dict):
+            raise ValueError(f"Trọng số của {chuc_vu} phải là object")
+        out["diem"][chuc_vu] = {}
+        for field, w in weights.items():
+            if field not in DIEM_FIELDS:
+                raise ValueError(f"Cột không hợp lệ: {field}")
+            if isinstance(w, bool) or not isinstance(w, int):
+                raise ValueError(f"Trọng số {chuc_vu}.{field} phải là số nguyên")
+            out["diem"][chuc_vu][field] = w
+    for chuc_vu in rules.get("khong_giam_sat") or []:
+        if chuc_vu not in CHUC_VU_OPTIONS:
+            raise ValueError(f"Chức vụ không hợp lệ: {chuc_vu}")
+        out["khong_giam_sat"].append(chuc_vu)
+    for field, w in (rules.get("tien") or {}).items():
+        if field not in TIEN_FIELDS:
+            raise ValueError(f"Cột không hợp lệ: {field}")
+        if isinstance(w, bool) or not isinstance(w, int):
+            raise ValueError(f"Đơn giá {field} phải là số nguyên")
+        out["tien"][field] = w
+    return out
+
+
+def _load_rules(so: str) -> dict:
+    conn = get_db()
+    c = conn.cursor()
+    c.execute(
+        """
+        SELECT so, version, rules FROM scoring_rules
+        WHERE so IN (?, 'ALL')
+        ORDER BY CASE WHEN so = ? THEN 0 ELSE 1 END, version DESC
+        LIMIT 1
+        """,
+        (so, so),
+    )
+    row = c.fetchone()
+    conn.close()
+    if not row:
+        return {"so": "ALL", "version": 0, "rules": copy.deepcopy(DEFAULT_RULES)}
+    try:
+        rules = validate_rules(json.loads(row["rules"]))
+    except (ValueError, TypeError):
+        # Dữ liệu hỏng thì dùng mặc định để không chặn việc nhập liệu
+        rules = copy.deepcopy(DEFAULT_RULES)
+    return {"so": row["so"], "version": int(row["version"]), "rules": rules}
+
+
+def get_active_rules(so: str) -> dict:
+    """{"so", "version", "rules"} đang áp dụng cho sở `so` (qua cache)."""
+    return _rules_cache.get_or_load(so, lambda: _load_rules(so))
+
+
+def get_rules(so: str) -> dict:
+    return get_active_rules(so)["rules"]
+
+
+def save_rules(c, so: str, rules: dict, created_by: str | None = None) -> int:
+    """Lưu bộ quy tắc mới cho `so` (version tăng dần), trả version mới. Caller tự commit."""
+    rules = validate_rules(rules)
+    c.execute("SELECT COALESCE(MAX(version), 0) AS v FROM scoring_rules WHERE so=?", (so,))
+    row = c.fetchone()
+    version = int(row["v"] or 0) + 1
+    c.execute(
+        "INSERT INTO scoring_rules(so, version, rules, created_by, created_at) VALUES(?,?,?,?,?)",
+        (
+            so,
+            version,
+            json.dumps(rules, ensure_ascii=False),
+            created_by or "System",
+            datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S"),
+        ),
+    )
+    bump_version(c, "scoring")
+    return version
+
+
+def _weights_for(rules: dict, chuc_vu) -> dict:
+    return rules["diem"].get(chuc_vu) or rules["diem"]["*"]
+
+
+def tinh_diem(values: dict, rules: dict) -> dict:
+    """
+    Tính các cột dẫn xuất từ 1 record (dict).
+    Trả: giam_sat_1_5, giam_sat_6, giam_sat, tong_an, diem, tong_tien.
+    """
+    chuc_vu = values.get("chuc_vu")
+    v = {f: int(values.get(f) or 0) for f in DIEM_FIELDS + TIEN_FIELDS}
+    if chuc_vu in rules.get("khong_giam_sat", []):
+        v["giam_sat_1_5"] = 0
+        v["giam_sat_6"] = 0
+    giam_sat = v["giam_sat_1_5"] + v["giam_sat_6"]
+    weights = _weights_for(rules, chuc_vu)
+    return {
+        "giam_sat_1_5": v["giam_sat_1_5"],
+        "giam_sat_6": v["giam_sat_6"],
+        "giam_sat": giam_sat,
+        # Tổng hồ sơ án = án 1-5 + án 6 + giám sát 1-5 + giám sát 6
+        "tong_an": v["xa_1_4"] + v["xa_5_6"] + giam_sat,
+        "diem": sum(v[f] * w for f, w in weights.items()),
+        "tong_tien": sum(v[f] * w for f, w in rules.get("tien", {}).items()),
+    }
+
+
+def _sql_literal(chuc_vu: str) -> str:
+    # Chức vụ đã qua validate_rules (chỉ nằm trong CHUC_VU_OPTIONS)
+    return "'" + chuc_vu.replace("'", "''") + "'"
+
+
+def _sum_sql(weights: dict, col) -> str:
+    terms = [f"{col(f)} * {int(w)}" for f, w in weights.items() if w]
+    return " + ".join(terms) if terms else "0"
+
+
+def _recompute_exprs(rules: dict, field: str | None = None) -> list:
+    """[(cột dẫn xuất, biểu thức SQL)]; cột `field` (nếu có) được thay bằng chỗ trống {field}."""
+    def expr(name):
+        if name == field:
+            return "{" + name + "}"
+        return name if name == "chuc_vu" else f"COALESCE({name}, 0)"
+
+    no_gs = rules.get("khong_giam_sat") or []
+    if no_gs:
+        cond = f"{expr('chuc_vu')} IN ({', '.join(_sql_literal(x) for x in no_gs)})"
+        gs15 = f"CASE WHEN {cond} THEN 0 ELSE {expr('giam_sat_1_5')} END"
+        gs6 = f"CASE WHEN {cond} THEN 0 ELSE {expr('giam_sat_6')} END"
+    else:
+        gs15 = expr("giam_sat_1_5")
+        gs6 = expr("giam_sat_6")
+
+    def col(name):
+        if name == "giam_sat_1_5":
+            return f"({gs15})"
+        if name == "giam_sat_6":
+            return f"({gs6})"
+        return expr(name)
+
+    diem_cases = [
+        f"WHEN {expr('chuc_vu')} = {_sql_literal(cv)} THEN {_sum_sql(w, col)}"
+        for cv, w in rules["diem"].items()
+        if cv != "*"
+    ]
+    diem_default = _sum_sql(rules["diem"]["*"], col)
+    diem_sql = f"CASE {' '.join(diem_cases)} ELSE {diem_default} END" if diem_cases else diem_default
+
+    return [
+        ("giam_sat_1_5", gs15),
+        ("giam_sat_6", gs6),
+        ("giam_sat", f"({gs15}) + ({gs6})"),
+        ("tong_an", f"{col('xa_1_4')} + {col('xa_5_6')} + ({gs15}) + ({gs6})"),
+        ("diem", diem_sql),
+        ("tong_tien", _sum_sql(rules.get("tien", {}), col)),
+    ]
+
+
+def recompute_set_sql(rules: dict, field: str | None = None, value=None) -> tuple[str, list]:
+    """
+    Dựng phần SET tính lại giam_sat/tong_an/diem/tong_tien, trả (sql, params) theo đúng thứ tự dấu ?.
+    - field=None: tính từ giá trị đang có trong bảng.
+    - field="xa_1_4", value=3: tính như thể cột đó đã mang giá trị mới (dùng trong cùng câu UPDATE).
+    Trọng số là số nguyên đã validate nên nhúng thẳng vào SQL.
+    """
+    template = ", ".join(f"{name} = {expr}" for name, expr in _recompute_exprs(rules, field))
+
+    params: list = []
+
+    def bind(m):
+        params.append(value)
+        return "?"
+
+    sql = re.sub(r"\{(\w+)\}", bind, template)
+    return sql, params
+
+
+def recompute_select_sql(rules: dict) -> list:
+    """
+    [(cột dẫn xuất, biểu thức SQL)] tính từ các cột nhập tay cùng tên, dùng trong SELECT
+    (VD: INSERT ... SELECT từ 1 bảng VALUES) để tính điểm cho nhiều dòng trong 1 câu lệnh.
+    """
+    return _recompute_exprs(rules)
+
+
+def rescore(c, so: str, rules: dict | None = None) -> int:
+    """Tính lại toàn bộ records của 1 sở bằng 1 câu UPDATE (set-based). Trả số dòng."""
+    if rules is None:
+        rules = get_rules(so)
+    set_sql, params = recompute_set_sql(rules)
+    c.execute(f"UPDATE records SET {set_sql} WHERE so = ?", (*params, so))
+    return c.rowcount if c.rowcount is not None else 0
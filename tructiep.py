@@ -0,0 +1,168 @@
+# tructiep.py
+"""
+Kênh Server-Sent Events (/api/stream) đẩy thay đổi theo sở cho dashboard.
+
+Mỗi process có 1 thread "hub":
+- Postgres: LISTEN records_changes (trigger NOTIFY sau mỗi câu lệnh ghi records),
+  thức dậy ngay khi có commit; vẫn kiểm tra định kỳ phòng mất kết nối.
+- SQLite: đọc bảng cache_versions mỗi SSE_POLL_INTERVAL giây (chỉ khi có người nghe).
+Hub so version 'records:<sở>' / 'leaderboard:<sở>' với lần trước rồi đẩy sự kiện
+records / thongke / top vào hàng đợi của từng kết nối. Client nhận sự kiện thì tự gọi
+/api/records/changes, /api/thongke, /api/top.
+
+Số kết nối SSE mỗi process bị giới hạn (SSE_MAX_CONNECTIONS); mỗi kết nối tự đóng sau
+SSE_MAX_DURATION giây, EventSource sẽ kết nối lại. Kết nối SSE không giữ connection nào
+của pool: chỉ thread hub mượn ngắn để đọc version, LISTEN dùng connection riêng ngoài pool.
+"""
+import json
+import os
+import queue
+import select
+import threading
+import time
+
+from cache import read_versions
+from database import DATABASE_URL
+
+SSE_MAX_CONNECTIONS = int(os.environ.get("SSE_MAX_CONNECTIONS", "8") or 8)
+SSE_MAX_DURATION = float(os.environ.get("SSE_MAX_DURATION", "300") or 300)
+SSE_HEARTBEAT = float(os.environ.get("SSE_HEARTBEAT", "15") or 15)
+SSE_POLL_INTERVAL = float(os.environ.get("SSE_POLL_INTERVAL", "1") or 1)
+NOTIFY_CHANNEL = "records_changes"
+
+_lock = threading.Lock()
+_subscribers: dict[str, set] = {}
+_hub_pid = None
+
+
+def _connection_count() -> int:
+    return sum(len(s) for s in _subscribers.values())
+
+
+def subscribe(so: str):
+    """Đăng ký nghe sở `so`. Trả hàng đợi, hoặc None nếu process đã đủ kết nối."""
+    with _lock:
+        if _connection_count() >= SSE_MAX_CONNECTIONS:
+            return None
+        q = queue.Queue(maxsize=64)
+        _subscribers.setdefault(so, set()).add(q)
+    _ensure_hub()
+    return q
+
+
+def unsubscribe(so: str, q):
+    with _lock:
+        subs = _subscribers.get(so)
+        if subs:
+            subs.discard(q)
+            if not subs:
+                _subscribers.pop(so, None)
+
+
+def publish(so: str, event: str, data: dict):
+    with _lock:
+        targets = list(_subscribers.get(so, ()))
+    for q in targets:
+        try:
+            q.put_nowait((event, data))
+        except queue.Full:
+            # Client chậm: bỏ sự kiện, sự kiện sau vẫn kích hoạt đồng bộ đầy đủ
+            pass
+
+
+def _read_versions(so_list) -> dict:
+    # Shard SQLite: mỗi sở đọc từ file của sở đó (cache.read_versions tự chia theo file)
+    return read_versions([f"{kind}:{so}" for so in so_list for kind in ("records", "leaderboard")])
+
+
+def _check_versions(last: dict):
+    with _lock:
+        so_list = list(_subscribers)
+    if not so_list:
+        return
+    versions = _read_versions(so_list)
+    for so in so_list:
+        rec = versions.get(f"records:{so}", 0)
+        top = versions.get(f"leaderboard:{so}", 0)
+        prev_rec = last.get(f"records:{so}")
+        prev_top = last.get(f"leaderboard:{so}")
+        if prev_rec is not None and rec != prev_rec:
+            publish(so, "records", {"version": rec})
+            # Bảng tổng hợp tháng đổi cùng transaction với records
+            publish(so, "thongke", {"version": rec})
+        if prev_top is not None and top != prev_top:
+            publish(so, "top", {"version": top})
+        last[f"records:{so}"] = rec
+        last[f"leaderboard:{so}"] = top
+
+
+def _listen_connection():
+    import psycopg2
+    import psycopg2.extensions
+
+    raw = psycopg2.connect(DATABASE_URL, sslmode="require")
+    raw.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    raw.cursor().execute(f"LISTEN {NOTIFY_CHANNEL}")
+    return raw
+
+
+def _hub_loop():
+    last: dict = {}
+    listen = None
+    while True:
+        try:
+            if DATABASE_URL:
+                if listen is None:
+                    listen = _listen_connection()
+                # Chờ NOTIFY (hoặc hết giờ thì vẫn kiểm tra version 1 lần)
+                if select.select([listen], [], [], SSE_HEARTBEAT) != ([], [], []):
+                    listen.poll()
+                    listen.notifies.clear()
+            else:
+                time.sleep(SSE_POLL_INTERVAL)
+            _check_versions(last)
+        except Exception:
+            if listen is not None:
+                try:
+                    listen.close()
+                except Exception:
+                    pass
+                listen = None
+            time.sleep(SSE_POLL_INTERVAL)
+
+
+def _ensure_hub():
+    """Khởi động thread hub (1 lần / process, kể cả sau khi gunicorn fork)."""
+    global _hub_pid
+    pid = os.getpid()
+    if _hub_pid == pid:
+        return
+    with _lock:
+        if _hub_pid == pid:
+            return
+        _hub_pid = pid
+    threading.Thread(target=_hub_loop, name="sse-hub", daemon=True).start()
+
+
+def _format(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream(so: str, q):
+    """Generator cho Response SSE; luôn hủy đăng ký khi client ngắt hoặc hết SSE_MAX_DURATION."""
+    deadline = time.monotonic() + SSE_MAX_DURATION
+    try:
+        yield "retry: 5000\n\n"
+        yield _format("hello", {"so": so})
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                event, data = q.get(timeout=min(SSE_HEARTBEAT, remaining))
+            except queue.Empty:
+                yield ": ping\n\n"
+                continue
+            yield _format(event, data)
+    finally:
+        unsubscribe(so, q)
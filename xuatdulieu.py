@@ -0,0 +1,177 @@
+# xuatdulieu.py
+"""
+Xuất dữ liệu (records theo sở / tháng, logs, login_logs) ra CSV / NDJSON / XLSX.
+
+Dữ liệu đi theo dòng chảy: server-side cursor (database.iter_rows) -> ghi từng lô EXPORT_CHUNK dòng
+-> (tuỳ chọn) nén gzip ngay trên luồng -> response. Không bao giờ giữ cả kết quả trong RAM.
+XLSX cần openpyxl (chế độ write_only, ghi ra file tạm rồi đọc dần); không cài thì chỉ có CSV / NDJSON.
+Shard SQLite: logs không lọc sở thì đọc lần lượt từng file (catalog rồi từng sở).
+"""
+import csv
+import datetime
+import io
+import json
+import os
+import tempfile
+import zlib
+
+from database import db_key, db_keys, get_db, iter_rows
+from nhatky import LOG_COLUMNS, LOGIN_LOG_COLUMNS, loc_log_dang_nhap, loc_nhat_ky
+
+EXPORT_CHUNK = int(os.environ.get("EXPORT_CHUNK", "1000") or 1000)
+EXPORT_FORMATS = ("csv", "ndjson", "xlsx")
+
+RECORD_EXPORT_COLUMNS = (
+    "id, so, chuc_vu, name, giao_thong, xa_1_4, xa_5_6, giam_sat_1_5, giam_sat_6, giam_sat, an_sai, "
+    "tong_an, diem, tien_khoan_1_2, tien_khoan_3_5, tien_khoan_6_truy_na, tong_tien, created_at"
+)
+
+MIMETYPES = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+
+
+def _columns(spec: str) -> list:
+    return [c.strip() for c in spec.split(",")]
+
+
+def _rows(table: str, columns: str, filters: list, keys=(None,)):
+    """
+    Generator các dòng của `table` theo id tăng dần trong từng file DB `keys`;
+    connection trả về pool khi hết / client ngắt.
+    """
+    where = ("WHERE " + " AND ".join(sql for sql, _ in filters)) if filters else ""
+    for key in keys:
+        conn = get_db(key, readonly=True)
+        try:
+            yield from iter_rows(
+                conn,
+                f"SELECT {columns} FROM {table} {where} ORDER BY id",
+                [p for _, p in filters],
+                EXPORT_CHUNK,
+            )
+        finally:
+            conn.close()
+
+
+def _value(v):
+    # datetime của Postgres -> chuỗi ISO giống SQLite
+    if isinstance(v, (datetime.datetime, datetime.date)):
+        return v.isoformat(sep=" ") if isinstance(v, datetime.datetime) else v.isoformat()
+    return v
+
+
+def _csv_chunks(columns: list, rows):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    # BOM để Excel mở đúng tiếng Việt
+    buf.write("\ufeff")
+    writer.writerow(columns)
+    n = 0
+    for row in rows:
+        writer.writerow([_value(row[c]) for c in columns])
+        n += 1
+        if n % EXPORT_CHUNK == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+def _ndjson_chunks(columns: list, rows):
+    lines = []
+    for row in rows:
+        lines.append(json.dumps({c: _value(row[c]) for c in columns}, ensure_ascii=False))
+        if len(lines) >= EXPORT_CHUNK:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+
+def _xlsx_chunks(columns: list, rows, title: str):
+    from openpyxl import Workbook  # type: ignore[import]
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title[:31])
+    ws.append(columns)
+    for row in rows:
+        ws.append([_value(row[c]) for c in columns])
+    with tempfile.TemporaryFile() as f:
+        wb.save(f)
+        f.seek(0)
+        while True:
+            data = f.read(64 * 1024)
+            if not data:
+                return
+            yield data
+
+
+def _gzip_chunks(chunks):
+    z = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = z.compress(chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield z.flush()
+
+
+def xlsx_supported() -> bool:
+    try:
+        import openpyxl  # type: ignore[import]  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _month_filter(thang: str) -> list:
+    try:
+        start = datetime.datetime.strptime(thang, "%Y-%m")
+    except ValueError:
+        raise ValueError("Tháng không hợp lệ (YYYY-MM)")
+    end = (start + datetime.timedelta(days=32)).replace(day=1)
+    return [("created_at >= ?", start.strftime("%Y-%m-%d")), ("created_at < ?", end.strftime("%Y-%m-%d"))]
+
+
+def xuat(kind: str, fmt: str, gzip: bool = False, **loc) -> tuple:
+    """
+    Dựng luồng xuất. kind: records | logs | login_logs; loc: điều kiện lọc theo kind
+    (records: so, thang; logs: như nhatky.loc_nhat_ky; login_logs: như nhatky.loc_log_dang_nhap).
+    Trả (generator bytes/str, mimetype, tên file). Tham số sai thì raise ValueError.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError("Định dạng không hợp lệ (csv | ndjson | xlsx)")
+    if fmt == "xlsx" and not xlsx_supported():
+        raise ValueError("Máy chủ chưa cài openpyxl, hãy xuất CSV / NDJSON")
+
+    keys = [None]
+    if kind == "records":
+        so = loc["so"]
+        filters = [("so = ?", so)]
+        keys = [db_key(so)]
+        if loc.get("thang"):
+            filters += _month_filter(loc["thang"])
+        table, spec = "records", RECORD_EXPORT_COLUMNS
+        name = f"records-{so}" + (f"-{loc['thang']}" if loc.get("thang") else "")
+    elif kind == "logs":
+        table, spec, filters, name = "logs", LOG_COLUMNS, loc_nhat_ky(**loc), "logs"
+        keys = [db_key(loc["so"])] if loc.get("so") else db_keys()
+    elif kind == "login_logs":
+        table, spec, filters, name = "login_logs", LOGIN_LOG_COLUMNS, loc_log_dang_nhap(**loc), "login_logs"
+    else:
+        raise ValueError("Loại dữ liệu không hợp lệ")
+
+    columns = _columns(spec)
+    rows = _rows(table, spec, filters, keys)
+    if fmt == "csv":
+        chunks = _csv_chunks(columns, rows)
+    elif fmt == "ndjson":
+        chunks = _ndjson_chunks(columns, rows)
+    else:
+        # xlsx vốn đã là file zip, không nén thêm
+        return _xlsx_chunks(columns, rows, name), MIMETYPES[fmt], f"{name}.xlsx"
+    if gzip:
+        chunks = _gzip_chunks(chunks)
+    return chunks, MIMETYPES[fmt], f"{name}.{fmt}"